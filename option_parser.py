@@ -2,6 +2,32 @@
 
 from optparse import OptionParser
 
+## @brief Reads the ratios given with --ratios
+#
+#  @return a dictionary like @c STOCK_RATIOS, with the ratios as @c float keys and their names as values
+#
+def ParseRatios(ratios):
+	ratios_new = [x.split(':') for x in ratios.split('|')]
+	new_ratios = {}
+	for i in ratios_new:
+		try:
+			new_ratios[float(i[0])/float(i[1])] = i[2]
+		except ZeroDivisionError:
+			pass
+	return new_ratios
+
+## @brief Reads the resolutions given with --res, in place, into a @c list of @c WIDTHxHEIGHT strings
+#
+#  @exception TypeError if they're not in a proper format
+#
+def ParseResolutions(options):
+	if len(options.get('res_separator')) > 1:
+		options['res_separator'] = 'x'
+	if options.get('resolutions').count(options.get('res_separator')[0]) == 0:
+		raise TypeError('Resolutions are not in a proper format')
+	if isinstance(options.get('resolutions'),str):
+		options['resolutions'] = [resolution for resolution in options.get('resolutions').split(':') if resolution]
+
 def CreateParser(usage = 'python %prog [OPTIONS] TARGET1 [TARGET2 TARGET3 ...]'):
 
 	parser = OptionParser(usage=usage)
@@ -19,6 +45,45 @@ def CreateParser(usage = 'python %prog [OPTIONS] TARGET1 [TARGET2 TARGET3 ...]')
 	parser.add_option('-q','--quiet',action='store_true',dest='quiet',help='prints as little as possible',default=False)
 	parser.add_option('-t','--threshold',action='store',type='str',dest='threshold',help='Specifies how far the program deviates to considerate an image belongs to one ratio. Bear in mind that a high threshold (above 0.01) could lead to false positives, thus misplacing the images. Defaults to 0.0001',default='0.0001')
 	parser.add_option('--no-overwrite',action='store_false',dest='overwrite',help='Do not overwrite files. Defaults to True (overwrites)',default=True)
+	parser.add_option('--index',type='str',action='store',dest='index',help='SQLite file used to keep track of the images already probed. Images that did not change since the last run are not read again',default=None)
+	parser.add_option('--prune-index',action='store_true',dest='prune_index',help='removes from the index the files that no longer exist. Requires --index, and TARGET can be omitted',default=False)
+	parser.add_option('-j','--jobs',type='int',action='store',dest='jobs',help='number of files probed at the same time when loading TARGET. Useful on network storage, where reading each file takes a while. Defaults to 1',default=1)
+	parser.add_option('--stream',action='store_true',dest='stream',help='relocates the images as they are found, instead of loading the whole TARGET first. Defaults to False',default=False)
+	parser.add_option('--plan',action='store_true',dest='plan',help='works out every relocation first, then creates the destination folders all at once, and finally relocates the images. Cannot be used along with --stream. Defaults to False',default=False)
+	parser.add_option('--link',type='choice',choices=['hard','reflink'],action='store',dest='link',help='along with --nd, links the images instead of copying them: "hard" for hard links, "reflink" for copy-on-write clones. Falls back to copying when the link cannot be made',default=None)
+	parser.add_option('--copy-jobs',type='int',action='store',dest='copy_jobs',help='number of files copied at the same time between different devices along with --plan. Defaults to 4',default=4)
+	parser.add_option('--concurrent-targets',action='store_true',dest='concurrent_targets',help='loads and processes the TARGETs at the same time, each in its own thread, as many at a time on each device as --device-jobs allows. TARGETs writing to the same files are still processed in order. Defaults to False',default=False)
+	parser.add_option('--stats',action='store_true',dest='stats',help='prints a summary of what was done, and the time spent on it, at the end. Defaults to False',default=False)
+	parser.add_option('--stats-json',type='str',action='store',dest='stats_json',help='saves the summary printed by --stats to the given file, as JSON',default=None)
+	parser.add_option('--stats-prom',type='str',action='store',dest='stats_prom',help='saves the summary printed by --stats to the given file, in the Prometheus textfile format',default=None)
+	parser.add_option('--profile',type='str',action='store',dest='profile',help='profiles the run with cProfile, and saves the profile to the given file. Along with --stats, the top functions are printed as well',default=None)
+	parser.add_option('--dedup',type='choice',choices=['skip','link','report'],action='store',dest='dedup',help='looks for images with the exact same contents as one processed before: "skip" leaves them where they are, "link" hard links them to the one relocated first, "report" only reports them. Only the images with the same size and dimensions are hashed',default=None)
+	parser.add_option('--similar',type='int',action='store',dest='similar',help='along with --plan, groups the images that look the same (even at different resolutions), and keeps only the biggest one of each group in its place. The value is how different they can be, from 0 to 64. 6 is a good start. Requires PIL',default=None)
+	parser.add_option('--similar-action',type='choice',choices=['aside','keep'],action='store',dest='similar_action',help='what to do with the smaller images of a group found by --similar: "aside" moves them to --similar-folder, "keep" leaves them where they are. Defaults to aside',default='aside')
+	parser.add_option('--similar-folder',type='str',action='store',dest='similar_folder',help='folder, inside the destination, where --similar puts the smaller images aside. Defaults to "Similar"',default='Similar')
+	parser.add_option('--watch',action='store_true',dest='watch',help='keeps running after processing the TARGETs, and sorts every image dropped in them as soon as it has been written. Uses inotify on Linux, and polls the directories every second otherwise. Defaults to False',default=False)
+	parser.add_option('--journal',type='str',action='store',dest='journal',help='records every relocation in the given file before doing it, so an interrupted run can be resumed with --resume, and a run can be reversed with --undo',default=None)
+	parser.add_option('--resume',action='store_true',dest='resume',help='along with --journal, finishes the relocations left by the last run, if it was interrupted, before processing the TARGETs (if any). Defaults to False',default=False)
+	parser.add_option('--undo',action='store_true',dest='undo',help='along with --journal, reverses the relocations of the last run, and exits. Defaults to False',default=False)
+	parser.add_option('--pipeline',action='store_true',dest='pipeline',help='processes the TARGETs in stages (listing, probing, classifying and relocating), each one with its own threads, so many files are handled at the same time. Meant for network filesystems, where each call waits for the server. Defaults to False',default=False)
+	parser.add_option('--pipeline-jobs',type='str',action='store',dest='pipeline_jobs',help='number of threads listing, probing and relocating along with --pipeline. The format is "LIST:PROBE:RELOCATE". Defaults to 4:16:4',default='4:16:4')
+	parser.add_option('--plan-file',type='str',action='store',dest='plan_file',help='along with --spider, saves the relocations to the given file, so they can be applied later with --apply-plan',default=None)
+	parser.add_option('--apply-plan',type='str',action='store',dest='apply_plan',help='applies the relocations saved with --plan-file, without scanning the TARGETs again. The files changed since the plan was made are left alone',default=None)
+	parser.add_option('--thumbnails',type='str',action='store',dest='thumbnails',help='makes a thumbnail of each image sorted in the given cache folder, named after the SHA-1 of the image. Thumbnails already made are used again as long as the image does not change. Requires PIL',default=None)
+	parser.add_option('--thumbnail-size',type='int',action='store',dest='thumbnail_size',help='largest width or height of the thumbnails, in pixels. Defaults to 256',default=256)
+	parser.add_option('--thumbnail-limit',type='int',action='store',dest='thumbnail_limit',help='largest size of the thumbnail cache, in MiB. The thumbnails used least recently are removed first. Defaults to 1024',default=1024)
+	parser.add_option('--thumbnail-jobs',type='int',action='store',dest='thumbnail_jobs',help='number of processes making thumbnails. Defaults to one per core',default=None)
+	parser.add_option('--device-jobs',type='int',action='store',dest='device_jobs',help='along with --concurrent-targets, number of TARGETs processed at the same time on each device (counting the destination as well). 1 keeps hard disks from seeking back and forth; SSDs and network shares can take more. Defaults to 1',default=1)
+	parser.add_option('--device-limit',type='str',action='append',dest='device_limits',help='along with --concurrent-targets, overrides --device-jobs for the device holding a path. The format is "PATH:JOBS". Can be given several times',default=None)
+	parser.add_option('--snapshot',type='str',action='store',dest='snapshot',help='saves the TARGETs, as loaded, to the given file, and loads them from it on the next run: only the folders modified since are listed again. Cannot be used along with --stream or --pipeline',default=None)
+	parser.add_option('--query',type='str',action='store',dest='query',help='reports on the images matching the given conditions, without relocating anything. The conditions are separated by commas, each one a field (width, height, ratio or size), an operator (<, <=, >, >= or =) and a value. E.g.: "size<2560x1440,ratio>=16:10". Ratios can be given as W:H, and sizes as WxH. Goes through --index when there are no TARGETs',default=None)
+	parser.add_option('--report',type='choice',choices=['count','ratios','resolutions','directories','files'],action='append',dest='reports',help='what to report about the images matching --query (all of them if not set): "count", "ratios" (how many per ratio, or per resolution with --res), "resolutions", "directories" (the ones with the most images) or "files". Can be given several times. Defaults to count',default=None)
+	parser.add_option('--top',type='int',action='store',dest='top',help='number of resolutions and directories reported by --report. Defaults to 10',default=10)
+	parser.add_option('--rules',type='str',action='store',dest='rules',help='JSON file (or TOML, if the toml module is installed) with the rules deciding where each image goes, by ratio, resolution, orientation, format and file size. The first rule an image meets sends it to its destination. Cannot be used along with --res',default=None)
+	parser.add_option('--progress',action='store_true',dest='progress',help='shows a progress line, with the images per second, the bytes copied and the time left, instead of a line per image and directory. Defaults to False',default=False)
+	parser.add_option('--log',type='str',action='store',dest='log',help='writes everything printed to the given file as well, including the lines per image and directory left out by --quiet or --progress',default=None)
+	parser.add_option('--log-size',type='int',action='store',dest='log_size',help='size, in MiB, past which the log is rotated (FILE.1, FILE.2...). Defaults to 10',default=10)
+	parser.add_option('--log-count',type='int',action='store',dest='log_count',help='number of rotated logs kept. Defaults to 3',default=3)
 	parser.add_option('--ratios',type='str',dest='ratios',help='aspect ratios to be extracted. The format is "W:H:folder_name|W:H:folder_name"   E.g.: "16:10:Wide Screen|16:9:HD" Unlike --res, --dest is not required, since the root working folder will be used if not provided. However, it\'s recommended if you plan on selecting a special subset of wallpapers. The default ratios are 16:9, 16:10 and 4:3',default=None)
 	return parser
 
@@ -28,39 +93,36 @@ def ParseOptions(parser):
 		raise TypeError('Wrong data type for ParseOptions(). Requested OptionParser, got ',type(parser))
 	else:
 		(options,args) = parser.parse_args()
+		# The threshold applies to every ratio, custom or stock
+		try:
+			options.threshold = float(options.threshold)
+		except ValueError:
+			options.threshold = 0.0001
 		if len(args) < 1:
+			# Pruning the index, resuming, undoing and applying a plan are the only things that can be done
+			# without a TARGET, along with queries going through the index instead of the TARGETs
+			if (options.prune_index and options.index) or ((options.resume or options.undo) and options.journal) \
+				or options.apply_plan or ((options.query != None or options.reports) and options.index):
+				options = options.__dict__
+				# Read the same as with TARGETs, as the images may still be classified
+				ratios = None
+				if options.get('resolutions') != None:
+					ParseResolutions(options)
+				elif options.get('ratios') != None:
+					ratios = ParseRatios(options.get('ratios'))
+				return (options,[],ratios)
 			raise ValueError('No arguments passed.')
 		options = options.__dict__
 		from os import path
+		ratios = None
 		if options.get('resolutions') != None:
-			if len(options.get('res_separator')) > 1:
-				options['res_separator'] = 'x'
-			if options.get('resolutions').count(options.get('res_separator')[0]) == 0:
-				raise TypeError('Resolutions are not in a proper format')
-			if isinstance(options.get('resolutions'),str):
-				options['resolutions'] = str(options.get('resolutions')).split(':')
-				try:
-					while(1):
-						options['resolutions'].remove('')
-				except ValueError:
-					pass
-			try:
-				options['threshold'] = float(options.get('threshold'))
-			except ValueError:
-				options['threshold'] = 0.0001
+			ParseResolutions(options)
 			if options.get('destination') and len(options.get('destination')) >= 1:
 				options['destination'] = [options.get('destination')[0],]
 			else:
 				raise ValueError('No TARGET specified for the resolutions')
 		elif options.get('ratios') != None:
-			ratios_new = [x.split(':') for x in options.get('ratios').split('|')]
-			new_ratios = {}
-			for i in ratios_new:
-				try:
-			 		new_ratios[float(i[0])/float(i[1])] = i[2]
-				except ZeroDivisionError:
-					pass
-			ratios = new_ratios
+			ratios = ParseRatios(options.get('ratios'))
 		else: # We don't get to process specific ratios or resolutions, so we just use the stock ratios
 			  # defines in wp_class.py
 			ratios = None
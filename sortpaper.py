@@ -39,52 +39,181 @@
 #                        0.0001
 
 import os
+import sys
+import atexit
 from wp_class import *
 from option_parser import *
+from wp_index import MetadataIndex
+from wp_walk import WalkImages, ScanDir
+from wp_batch import ImageBatch
+from wp_classify import RatioClassifier, ResolutionClassifier
+from wp_rules import RulesClassifier, LoadRules
+from wp_plan import MovePlan
+from wp_planfile import PlanWriter
+from wp_dedup import DuplicateFinder
+from wp_similar import SimilarFinder
+from wp_thumbs import ThumbnailCache
+from wp_prune import EntryCounter
+from wp_schedule import DeviceScheduler, GetChains
+from wp_snapshot import Snapshot, SaveSnapshot
+from wp_query import QueryIndex, IndexQuery, ParseQuery, BatchFromTrees
+from wp_transfer import LinkFile
+from wp_output import Output, Progress, RotatingLog
+from wp_stats import STATS, Timed
 
+## @var UNCLASSIFIED
+#  @brief Default @a result of ProcessImage(), meaning the image is yet to be classified
+#
+#  @details @c None can't be used, since it's the result for the images not meeting any criteria.
+#
+UNCLASSIFIED = False
+
+## @brief Prints a message about an image or a directory, unless --quiet or --progress are set
+#
+#  @details It's logged either way, with --log. See @c Output.
+#
 def PrintMsg(msg):
-	if not options.get('quiet'):
-		print msg
+	output.Message(msg)
 
-def ProcessImage(images,tld):
+## @brief Prints whatever is left to print and puts @c sys.stdout back, at the end of the run
+def CloseOutput():
+	sys.stdout = output.stream
+	output.Close()
+
+@Timed('ProcessImage')
+def ProcessImage(images,tld,result = UNCLASSIFIED):
 	def MeetsCriteria(tld):
-		result = None
-		try:
-			# We're checking either for resolutions
-			if options.get('resolutions'):
-				# We get the resolution of the current image.
-				res = images.GetResolution(options.get('res_separator'))
-				result = options['resolutions'][options.get('resolutions').index(res)]
-			# Or for ratios
-			else:
-				result = ratios[images.ratio]
-		except (ValueError,KeyError):
-			result = None
-		return result
-	def MoveImage(destination):
+		# We're checking either for resolutions, for ratios or for the rules, depending on the classifier
+		return classifier.Classify(images.width,images.height,images.path)
+	def MoveImage(destination,link_to = None):
 		from os import path
 		result = True
 		dest = BuildDirTree(destination.get('dir_tree'),destination.get('dest')[0])
 		prev_path = images.path
-		if not options.get('spider'):
-			result = images.Relocate(dest,copy = options.get('delete_f'),overwrite = options.get('overwrite'))
+		dest_file = path.join(dest,images.filename)
+		# Only --dedup skip and link get rid of the duplicate, and only if it could be overwritten anyway
+		remove_same = not options.get('delete_f') and options.get('dedup') in ('skip','link') and options.get('overwrite')
+		same_action = None
+		if dedup != None:
+			same_action = remove_same and 'remove' or 'keep'
+		if dedup != None and dest != images.dir_path and path.lexists(dest_file) and not path.samefile(prev_path,dest_file) \
+			and dedup.SameContent(prev_path,dest_file):
+			PrintMsg(prev_path+' is already in '+dest)
+			if not options.get('spider') and remove_same:
+				if journal != None:
+					journal.DedupRemove(prev_path,dest_file)
+				os.remove(prev_path)
+				images.path = dest_file
+			return
+		if link_to != None:
+			if dest == images.dir_path or (path.lexists(dest_file) and not options.get('overwrite')):
+				return
+			if not options.get('spider'):
+				if journal != None:
+					# Once the original is removed, it's been moved as far as the journal is concerned
+					journal.Intent(prev_path,dest_file,options.get('delete_f') and 'link' or 'move','hard',options.get('overwrite'),
+						same_action)
+				try:
+					# Kept, so the run can be undone
+					if journal != None and path.lexists(dest_file) and not path.samefile(link_to.path,dest_file):
+						journal.Backup(dest_file)
+					LinkFile(link_to.path,dest_file,'hard')
+					if not options.get('delete_f'):
+						os.remove(prev_path)
+					images.path = dest_file
+				except EnvironmentError,err:
+					print 'ProcessImage(): Error linking '+prev_path+':',err.strerror or err
+					if journal != None:
+						journal.Cancel(prev_path)
+					return
+				if journal != None:
+					journal.Done(prev_path)
+				if index != None:
+					index.Relocated(prev_path,images.path,moved = not options.get('delete_f'))
+			elif plan_writer != None:
+				plan_writer.Add(images,dest,link_to)
+			PrintMsg('Linking '+prev_path+' to '+link_to.path+' in '+dest)
+			return
+		if options.get('spider'):
+			if plan_writer != None and dest != images.dir_path:
+				plan_writer.Add(images,dest)
+		else:
+			if journal != None:
+				if not options.get('delete_f'):
+					mode = 'move'
+				elif options.get('link'):
+					mode = 'link'
+				else:
+					mode = 'copy'
+				journal.Intent(prev_path,dest_file,mode,options.get('link') or 'hard',options.get('overwrite'),same_action)
+				# What's about to be overwritten is kept, so the run can be undone
+				if options.get('overwrite') and path.lexists(dest_file) and not path.samefile(dest,images.dir_path):
+					try:
+						journal.Backup(dest_file)
+					except EnvironmentError,err:
+						print 'ProcessImage(): Error moving '+dest_file+' out of the way:',err.strerror or err
+						journal.Cancel(prev_path)
+						return
+			result = images.Relocate(dest,copy = options.get('delete_f'),overwrite = options.get('overwrite'),link = options.get('link'))
+			if journal != None:
+				if result:
+					journal.Done(prev_path)
+				else:
+					journal.Cancel(prev_path)
+			if result and index != None:
+				index.Relocated(prev_path,images.path,moved = not options.get('delete_f'))
 		if result:
 			PrintMsg('Relocating '+prev_path+' to '+path.join(dest,images.filename))
 	
 	destination = None
-	# We get the type of image according to our criteria
-	result = MeetsCriteria(tld)
+	# We get the type of image according to our criteria, unless it's been done already
+	if result == UNCLASSIFIED:
+		result = MeetsCriteria(tld)
+	if result != None:
+		STATS.Count('classified',label = result)
+	else:
+		STATS.Count('classified',label = STOCK_RATIOS[None])
+	link_to = None
+	if dedup != None and (not options.get('resolutions') or result):
+		original = dedup.Check(images)
+		if original != None:
+			STATS.Count('duplicates')
+			PrintMsg('Duplicate of '+original.path+': '+images.path)
+			if options.get('dedup') == 'skip':
+				return
+			elif options.get('dedup') == 'link':
+				link_to = original
 	# We only want to move to Non-Matching if we're not dealing with resolutions
-	if not options.get('resolutions') or result:
+	if (not options.get('resolutions') or result) and plan != None:
+		# When planning, the image is only added to the plan. Every image of a directory with
+		# the same result goes to the same place, so the destination is worked out once
+		key = (tld,images.dir_path,result)
+		dest = planned_destinations.get(key)
+		if dest == None:
+			destination = images.GetDestination(result,tld,options.get('similar_folder'))
+			dest = os.path.join(os.path.abspath(options.get('destination')[0]),*destination.get('dir_tree'))
+			planned_destinations[key] = dest
+		plan.Add(images,dest,link_to)
+		if similar != None and link_to == None:
+			similar.Add(images)
+		if thumbnails != None:
+			# Made once the plan is executed, so the image isn't moved while it's being read
+			planned_images.append(images)
+	elif not options.get('resolutions') or result:
 		# We build a destination according to the results of the testing
 		# This step is needed, because it gets us the directory tree,
 		# along with the dictionary
-		destination = images.GetDestination(result,tld)
+		destination = images.GetDestination(result,tld,options.get('similar_folder'))
 		# If we so desire another destination, we change it accordingly
 		if options.get('destination'):
 			destination['dest'] = options.get('destination')
 		# And finally move the image.
-		MoveImage(destination)
+		source = images.dir_path
+		MoveImage(destination,link_to)
+		if remaining != None and images.dir_path != source and not options.get('delete_f'):
+			remaining.Release(source)
+		if thumbnails != None:
+			thumbnails.Add(images.path)
 
 def ProcessFolder(directorio,tld=None):
 	if tld == None:
@@ -95,19 +224,449 @@ def ProcessFolder(directorio,tld=None):
 
 		PrintMsg('Processing directory '+directorio.path)
 		if files != None:
-			for images in directorio.GetDictionary('files').values():
-				ProcessImage(images,tld)
+			# The whole directory is classified in one go
+			images_list = files.values()
+			widths,heights = ImageBatch(images_list).GetColumns()
+			results = classifier.ClassifyBatch(widths,heights,[images.path for images in images_list])
+			for images,result in zip(images_list,results):
+				ProcessImage(images,tld,result)
 
 		if directories != None:
 			for dirs in directorio.GetDictionary('directories').values():
 				ProcessFolder(dirs,tld)
-				if dirs.IsEmpty():
-					PrintMsg('Removing '+dirs.dir_name+' since it\'s empty')
-					if not options.get('spider'):
-						directorio.RemoveDir(dirs)
 	else:
 		raise TypeError('ProcessFolder(): Argument must be an instance of Directory')
 
+## @brief Removes, bottom-up, the directories of the @a targets emptied by the relocations
+#
+#  @details Only the directories whose count of entries in @c remaining reached zero are looked at.
+#  The @a targets themselves are left when copying, or watching them.
+#
+#  @param targets the @c Directory of each @a TARGET
+#
+def PruneTargets(targets):
+	roots = set(directorio.path for directorio in targets)
+	def Remove(directory):
+		if directory in roots and (options.get('delete_f') or options.get('watch')):
+			return False
+		try:
+			# Listed again only now, in case something else was put in it meanwhile
+			if os.listdir(directory) != []:
+				return False
+			PrintMsg('Removing '+os.path.split(directory)[1]+' since it\'s empty')
+			if options.get('spider'):
+				return False
+			os.rmdir(directory)
+		except OSError,err:
+			print 'PruneTargets(): Error removing '+directory+':',err.strerror
+			return False
+		return True
+	remaining.Prune(Remove)
+
+## @brief Makes sure PIL is installed, since @a option needs it
+#
+#  @exception ValueError if it's not
+#
+def RequirePIL(option):
+	try:
+		__import__('Image')
+	except ImportError:
+		raise ValueError(option+' requires PIL')
+
+## @brief Changes the destination of the images of the plan looking like a bigger one, as requested by --similar
+#
+#  @details They're moved to --similar-folder, keeping the folders they were going to (or already are in)
+#  inside the destination, or left where they are. On the next run, GetDestination() leaves
+#  --similar-folder out, so they're not nested any deeper.
+#
+def GroupSimilar(plan):
+	root = os.path.abspath(options.get('destination')[0])
+	planned = dict((image,dest) for image,dest,link_to in plan.moves)
+	destinations = {}
+	for group in similar.GetGroups(pool):
+		for images in group[1:]:
+			PrintMsg(images.path+' looks like '+group[0].path)
+			if options.get('similar_action') == 'keep':
+				destinations[images] = None
+				continue
+			relative = os.path.relpath(planned.get(images,images.dir_path),root)
+			if relative.startswith(os.pardir):
+				relative = ''
+			destinations[images] = os.path.normpath(os.path.join(root,options.get('similar_folder'),relative))
+	plan.Redirect(destinations)
+
+## @brief Relocates the images of the @c MovePlan @a plan
+#
+#  @details The destination directories are created first, all at once, and then the images are
+#  moved (or copied). In spider mode, the relocations are only printed.
+#
+#  @return the number of images relocated
+#
+def ExecutePlan(plan):
+	def Relocated(images,prev_path):
+		if index != None:
+			index.Relocated(prev_path,images.path,moved = not options.get('delete_f'))
+		PrintMsg('Relocating '+prev_path+' to '+images.path)
+	if options.get('spider'):
+		for images,dest,link_to in plan.moves:
+			if plan_writer != None:
+				plan_writer.Add(images,dest,link_to)
+			if link_to != None:
+				PrintMsg('Linking '+images.path+' to '+link_to.path+' in '+dest)
+			else:
+				PrintMsg('Relocating '+images.path+' to '+os.path.join(dest,images.filename))
+		return len(plan)
+	else:
+		same_content = None
+		if dedup != None:
+			same_content = dedup.SameContent
+		def Same(images,dest_file):
+			PrintMsg(images.path+' is already in '+os.path.dirname(dest_file))
+		plan.CreateDirectories()
+		sources = [(images,images.dir_path) for images,dest,link_to in plan.moves]
+		relocated = plan.Execute(copy = options.get('delete_f'),overwrite = options.get('overwrite'),done = Relocated,
+			link = options.get('link'),jobs = options.get('copy_jobs'),same_content = same_content,journal = journal,
+			remove_same = options.get('dedup') in ('skip','link'),same = Same)
+		if remaining != None and not options.get('delete_f'):
+			# Including the images only removed, since their destination already held them
+			for images,source in sources:
+				if images.dir_path != source:
+					remaining.Release(source)
+		return relocated
+
+## @brief Loads the @c Directory of the @a TARGET at @a path
+#
+#  @details With --snapshot, the directories that didn't change since the last run are taken from it.
+#
+def LoadTarget(path):
+	if snapshot != None:
+		directorio = snapshot.Load(path,index,pool)
+		if directorio != None:
+			return directorio
+	return Directory(path,options.get('top_level'),index,pool,snapshot)
+
+## @brief Processes a @a TARGET, either a @c Directory or a path when streaming
+def ProcessTarget(directorio):
+	if options.get('stream'):
+		target = directorio
+	else:
+		target = directorio.path
+	try:
+		## Using the @a path of the directory as the top level directory
+		#
+		if options.get('stream'):
+			ProcessStream(target,tld=target)
+		else:
+			ProcessFolder(directorio,tld=target)
+	## It may happen that though the folder exists, the @a path is not accessible,
+	#  thus we throw a @c ValueError exception and catch it here
+	#
+	except ValueError,err:
+		print 'main: '+str(err)
+	## And finally, if the directory we just processed got emptied, we remove it. The trees loaded
+	#  beforehand are pruned once every TARGET is done, see PruneTargets()
+	#
+	if options.get('stream') and not options.get('watch'):
+		RemoveTarget(target)
+
+## @brief Gets the paths the @a target touches: its own, and the destination, if it's somewhere else
+def GetTargetPaths(target):
+	paths = [getattr(target,'path',target)]
+	if options.get('destination'):
+		paths.append(options.get('destination')[0])
+	return paths
+
+## @brief Puts together the @a targets that can't be processed at the same time
+#
+#  @details A TARGET inside another one shares its files. With --dest, two TARGETs holding a file with
+#  the same name at the same place (under the folder of its ratio) write to the same destination file,
+#  and which one gets there first makes a difference. Those are processed in the order they were given,
+#  as they would one after another. Streamed TARGETs have no listing to tell, so with --dest they're
+#  all processed in order. So are all of them with --dedup and --similar, since the first image seen is
+#  the one kept as the original.
+#
+#  @return the chains of TARGETs, see DeviceScheduler.Run()
+#
+def ChainTargets(targets):
+	paths = [os.path.abspath(getattr(target,'path',target)) for target in targets]
+	given = set(paths)
+	keys = []
+	for target,path in zip(targets,paths):
+		target_keys = set([('tree',path)])
+		if dedup != None or similar != None:
+			target_keys.add(('originals',))
+		parent = os.path.dirname(path)
+		while parent != os.path.dirname(parent):
+			if parent in given:
+				target_keys.add(('tree',parent))
+			parent = os.path.dirname(parent)
+		if options.get('destination'):
+			if isinstance(target,Directory):
+				for images in target.GetImages():
+					# The folder of the ratio is left out, the images could end up in any of them
+					dir_tree = images.GetDestination(None,target.path,options.get('similar_folder')).get('dir_tree')[1:]
+					target_keys.add(('file',os.path.join(*dir_tree+[images.filename])))
+			else:
+				target_keys.add(('destination',))
+		keys.append(target_keys)
+	return GetChains(keys)
+
+## @brief Calls @a function with each of the @a targets
+#
+#  @details With --concurrent-targets, the calls run at the same time, each in its own thread, as many
+#  at a time on each device as --device-jobs allows.
+#
+#  @param chained whether the @a targets depending on each other have to be processed in order (see
+#  ChainTargets()), because @a function relocates their images
+#
+#  @return the results of the calls, in the same order as @a targets
+#
+#  @exception Exception whatever a call raised, as if they had run one after another
+#
+def RunTargets(function,targets,chained = False):
+	if scheduler == None or len(targets) < 2:
+		return map(function,targets)
+	chains = None
+	if chained:
+		chains = ChainTargets(targets)
+	return scheduler.Run(function,targets,GetTargetPaths,chains)
+
+## @brief Prints and saves the figures of the run, as requested by --stats, --stats-json and --stats-prom
+#
+#  @param profiler the @c cProfile.Profile of the run, if --profile was set
+#
+def ReportStats(profiler = None):
+	if profiler != None:
+		profiler.disable()
+		profiler.dump_stats(options.get('profile'))
+	if options.get('stats'):
+		print STATS.GetSummary()
+		if profiler != None:
+			import pstats
+			print
+			pstats.Stats(profiler,stream = sys.stdout).sort_stats('cumulative').print_stats(25)
+	if options.get('stats_json'):
+		STATS.SaveJSON(options.get('stats_json'))
+	if options.get('stats_prom'):
+		STATS.SavePrometheus(options.get('stats_prom'))
+
+## @brief Removes the @a target directory if it got emptied
+def RemoveTarget(target):
+	if os.listdir(target) == [] and not options.get('delete_f'):
+		PrintMsg('Removing'+os.path.split(target)[1]+'since it\'s empty')
+		if not options.get('spider'):
+			## We remove it
+			#
+			os.rmdir(target)
+
+## @brief Processes the images of the directory at @a path as they're found
+#
+#  @details Unlike ProcessFolder(), there's no @c Directory loaded beforehand: the tree is walked
+#  by WalkImages(), and each image is relocated as soon as it's been probed. The subdirectories
+#  emptied along the way are removed once they've been walked.
+#
+#  @param path the directory to process
+#  @param tld the top level directory, used to build the destinations
+#
+def ProcessStream(path,tld=None):
+	if tld == None:
+		raise ValueError('ProcessStream(): Path provided is not accessible')
+	def EnterDirectory(directory):
+		PrintMsg('Processing directory '+directory)
+	def LeaveDirectory(directory):
+		if directory != path and os.listdir(directory) == []:
+			PrintMsg('Removing '+os.path.split(directory)[1]+' since it\'s empty')
+			if not options.get('spider'):
+				os.rmdir(directory)
+	for images in WalkImages(path,options.get('top_level'),index,pool,EnterDirectory,LeaveDirectory):
+		ProcessImage(images,tld)
+
+## @brief Watches the @a targets, and processes each image dropped in them as soon as it's complete
+#
+#  @details Each new file goes through ProcessImage() on its own, and the directories it was dropped in
+#  are removed if that left them empty. It goes on until interrupted with Ctrl+C, or terminated: a file
+#  that can't be loaded or relocated (removed or renamed right after it was written, say) is only reported.
+#
+def WatchTargets(targets):
+	import signal
+	from wp_watch import CreateWatcher
+	def Terminate(number,frame):
+		raise KeyboardInterrupt()
+	signal.signal(signal.SIGTERM,Terminate)
+	watcher = CreateWatcher(options.get('top_level'))
+	roots = []
+	for target in targets:
+		watcher.Add(target)
+		roots.append((os.path.abspath(target)+os.sep,target))
+	# The innermost TARGET holding a file is its top level directory
+	roots.sort(reverse = True)
+	tops = set(root for root,target in roots)
+	if index != None:
+		probe = index.Probe
+	else:
+		probe = None
+	PrintMsg('Watching '+', '.join(target for root,target in roots))
+	try:
+		while True:
+			for path in watcher.Wait():
+				tld = None
+				for root,target in roots:
+					if path.startswith(root):
+						tld = target
+						break
+				try:
+					images,err = LoadImage(path,probe)
+					if images == None:
+						ReportLoadError(os.path.split(path)[1],err)
+						continue
+					ProcessImage(images,tld)
+					if images.path != path:
+						# It's been relocated, and it's already sorted. Only a watched directory would tell
+						# about it, anywhere else it would never be dropped from the files ignored
+						if any(images.path.startswith(root) for root in tops):
+							watcher.Ignore(images.path)
+						directory = os.path.split(path)[0]
+						while directory+os.sep not in tops and os.path.isdir(directory) and os.listdir(directory) == []:
+							PrintMsg('Removing '+os.path.split(directory)[1]+' since it\'s empty')
+							os.rmdir(directory)
+							directory = os.path.split(directory)[0]
+				except EnvironmentError,err:
+					ReportLoadError(os.path.split(path)[1],err)
+				except AttributeError,err:
+					# How ImageFile.CopyMove() reports a relocation that failed
+					print 'WatchTargets():',err
+			if index != None:
+				index.Commit()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		watcher.Close()
+
+## @brief Processes the @a targets through a @c Pipeline, as requested by --pipeline
+#
+#  @details The directories are listed, the files probed and the images relocated by separate pools of
+#  threads, sized with --pipeline-jobs, and only classifying is done by a single thread. The directories
+#  emptied along the way are removed at the end, deepest first.
+#
+def RunPipeline(targets):
+	from wp_pipeline import Pipeline
+	list_jobs,probe_jobs,relocate_jobs = options.get('pipeline_jobs')
+	if index != None:
+		probe = index.Probe
+	else:
+		probe = None
+	walked = []
+	def List(item,emit):
+		directory,tld = item
+		try:
+			entries = ScanDir(directory)
+		except OSError,err:
+			print 'RunPipeline():',err
+			return
+		STATS.Count('directories_scanned')
+		PrintMsg('Processing directory '+directory)
+		walked.append(directory)
+		for name,is_dir in entries:
+			path = os.path.join(directory,name)
+			if not is_dir:
+				emit((path,tld))
+			elif options.get('top_level'):
+				listing.Put((path,tld))
+	def Probe(item,emit):
+		path,tld = item
+		images,err = LoadImage(path,probe)
+		if images != None:
+			emit((images,tld))
+		else:
+			ReportLoadError(os.path.split(path)[1],err)
+	def Classify(item,emit):
+		images,tld = item
+		emit((images,tld,classifier.Classify(images.width,images.height,images.path)))
+	def Relocate(item,emit):
+		ProcessImage(*item)
+	pipeline = Pipeline()
+	# Directories are put back into the listing by the listing itself, so its queue can't be bounded
+	listing = pipeline.AddStage('list',List,list_jobs)
+	pipeline.AddStage('probe',Probe,probe_jobs,probe_jobs*4)
+	pipeline.AddStage('classify',Classify,1,256)
+	pipeline.AddStage('relocate',Relocate,relocate_jobs,relocate_jobs*4)
+	pipeline.Run([(os.path.abspath(target),target) for target in targets])
+	RemoveEmptied(walked,targets)
+	if not options.get('watch'):
+		for target in targets:
+			RemoveTarget(target)
+
+## @brief Applies the plan saved to @a filename by a dry run, as requested by --apply-plan
+#
+#  @details The plan is applied with the options it was made with; the TARGETs are not scanned again,
+#  and the images are not probed again either. The directories emptied are removed afterwards.
+#
+def ApplyPlan(filename):
+	from wp_planfile import LoadPlan
+	plan,saved,skipped = LoadPlan(filename,PrintMsg)
+	options['delete_f'] = saved.get('copy')
+	options['overwrite'] = saved.get('overwrite')
+	options['link'] = saved.get('link')
+	sources = set(images.dir_path for images,dest,link_to in plan.moves)
+	relocated = ExecutePlan(plan)
+	RemoveEmptied(sources,saved.get('targets'))
+	PrintMsg('Applied '+str(relocated)+' relocations from '+filename+', skipped '+str(skipped))
+
+## @brief Prints the reports asked with --report about the images matching --query
+#
+#  @details Nothing is relocated.
+#
+#  @param trees the @c Directory of each TARGET, or @c None to go through the index
+#
+@Timed('RunQuery')
+def RunQuery(trees = None):
+	if trees == None:
+		query = IndexQuery(index)
+	else:
+		query = QueryIndex(BatchFromTrees(trees))
+	selection = query.Select(ParseQuery(options.get('query') or '',options.get('threshold')))
+	matches = query.Count(selection)
+	top = options.get('top')
+	for report in options.get('reports') or ['count']:
+		if report == 'count':
+			print str(matches)+' of '+str(len(query))+' images match'
+		elif report == 'ratios':
+			if options.get('rules'):
+				print 'By destination:'
+			else:
+				print 'By '+(options.get('resolutions') and 'resolution' or 'ratio')+':'
+			for name,count in query.CountRatios(selection,classifier):
+				if name == None:
+					name = STOCK_RATIOS[None]
+				print '  %-24s %8d %6.1f%%' % (name,count,100.0*count/matches)
+		elif report == 'resolutions':
+			print 'Top '+str(top)+' resolutions:'
+			for (width,height),count in query.CountResolutions(selection,top):
+				print '  %-24s %8d %6.1f%%' % (str(width)+'x'+str(height),count,100.0*count/matches)
+		elif report == 'directories':
+			print 'Top '+str(top)+' directories:'
+			for directory,count in query.CountDirectories(selection,top):
+				print '  %8d  %s' % (count,directory)
+		elif report == 'files':
+			for path,width,height in query.GetFiles(selection):
+				print '%s\t%dx%d' % (path,width,height)
+
+## @brief Removes the @a directories emptied by the relocations, and their parents, inside the @a targets
+#
+#  @details The deepest directories are removed first. The @a targets themselves are left alone.
+#
+def RemoveEmptied(directories,targets):
+	roots = set(os.path.abspath(target) for target in targets)
+	for directory in sorted(directories,key = len,reverse = True):
+		while directory not in roots and [root for root in roots if directory.startswith(root+os.sep)]:
+			if not os.path.isdir(directory) or os.listdir(directory) != []:
+				break
+			PrintMsg('Removing '+os.path.split(directory)[1]+' since it\'s empty')
+			if options.get('spider'):
+				break
+			os.rmdir(directory)
+			directory = os.path.split(directory)[0]
+
 ################
 # Main program #
 ################
@@ -129,15 +688,225 @@ if __name__ == '__main__':
 	#
 	parser = CreateParser(usage)
 
+	## @brief the index of the images already probed, set with --index
+	#
+	index = None
+
+	## @brief the pool of workers probing the files, set with --jobs
+	#
+	pool = None
+
+	## @brief the profiler of the run, set with --profile
+	#
+	profiler = None
+
+	## @brief the @c MovePlan of the run, if relocating in two phases (--plan)
+	#
+	plan = None
+
+	## @brief the destinations already worked out for the plan, by top level directory, directory and result
+	#
+	planned_destinations = {}
+
+	## @brief the @c DuplicateFinder of the run, set with --dedup
+	#
+	dedup = None
+
+	## @brief the @c SimilarFinder of the run, set with --similar
+	#
+	similar = None
+
+	## @brief the @c MoveJournal of the run, set with --journal
+	#
+	journal = None
+
+	## @brief the @c PlanWriter saving the relocations of a dry run, set with --plan-file
+	#
+	plan_writer = None
+
+	## @brief the @c EntryCounter of the directories of the TARGETs, when they're loaded beforehand
+	#
+	remaining = None
+
+	## @brief the @c DeviceScheduler running the TARGETs at the same time, set with --concurrent-targets
+	#
+	scheduler = None
+
+	## @brief the @c Snapshot of the last run, set with --snapshot
+	#
+	snapshot = None
+
+	## @brief the @c ThumbnailCache of the run, set with --thumbnails
+	#
+	thumbnails = None
+
+	## @brief the images added to the plan, whose thumbnails are made once it's executed
+	#
+	planned_images = []
+
+	## @brief the @c Output everything is printed through, in the background
+	#
+	output = None
+
+	## @brief the @c Progress shown instead of the messages, set with --progress
+	#
+	progress = None
+
 	try:
 		## the options and the arguments, parsed 
 		#
 		(options,args,ratios) = ParseOptions(parser)
+		log = None
+		if options.get('log'):
+			if options.get('log_size') < 1 or options.get('log_count') < 0:
+				raise ValueError('--log-size must be at least 1, and --log-count at least 0')
+			try:
+				log = RotatingLog(options.get('log'),options.get('log_size') << 20,options.get('log_count'))
+			except IOError,err:
+				raise ValueError('Can\'t open '+options.get('log')+': '+str(err.strerror))
+		if options.get('progress'):
+			progress = Progress()
+		output = Output(sys.stdout,not (options.get('quiet') or options.get('progress')),log,progress)
+		sys.stdout = output
+		atexit.register(CloseOutput)
+		## @brief whether to report on the images instead of relocating them (--query and --report)
+		#
+		querying = options.get('query') != None or bool(options.get('reports'))
 		
 		if ratios == None:
 			ratios = STOCK_RATIOS
+		## @brief the classifier deciding where each image belongs
+		#
+		if options.get('rules') and options.get('resolutions'):
+			raise ValueError('--rules cannot be used along with --res')
+		if options.get('rules'):
+			classifier = RulesClassifier(LoadRules(options.get('rules')),ratios,options.get('threshold'))
+		elif options.get('resolutions'):
+			classifier = ResolutionClassifier(options.get('resolutions'),options.get('res_separator'))
+		else:
+			classifier = RatioClassifier(ratios,options.get('threshold'))
+		if options.get('prune_index') and not options.get('index'):
+			raise ValueError('--prune-index requires --index')
+		if options.get('index'):
+			index = MetadataIndex(options.get('index'))
+			if options.get('prune_index'):
+				PrintMsg('Removed '+str(index.Prune())+' files no longer existing from the index')
+				if len(args) < 1 and not (options.get('resume') or options.get('undo') or options.get('apply_plan') or querying):
+					index.Close()
+					exit(0)
+		if options.get('thumbnails'):
+			RequirePIL('--thumbnails')
+			if options.get('thumbnail_size') < 1 or options.get('thumbnail_limit') < 1:
+				raise ValueError('--thumbnail-size and --thumbnail-limit must be at least 1')
+			if options.get('thumbnail_jobs') != None and options.get('thumbnail_jobs') < 1:
+				raise ValueError('--thumbnail-jobs must be at least 1')
+			# Before any thread is started, since the processes are forked
+			thumbnails = ThumbnailCache(options.get('thumbnails'),options.get('thumbnail_size'),
+				options.get('thumbnail_limit') << 20,options.get('thumbnail_jobs'),index)
+		# Once the thumbnails have forked their processes, and before any other thread is started
+		output.Start()
+		if (options.get('resume') or options.get('undo')) and not options.get('journal'):
+			raise ValueError('--resume and --undo require --journal')
+		if options.get('journal') and not options.get('spider'):
+			from wp_journal import MoveJournal, Resume, Undo
+			journal = MoveJournal(options.get('journal'))
+			if options.get('undo'):
+				undone = Undo(journal,PrintMsg)
+				if undone == None:
+					PrintMsg('There is no run to undo in '+journal.filename)
+				else:
+					PrintMsg('Reversed '+str(undone)+' relocations')
+				journal.Close()
+				if index != None:
+					index.Close()
+				exit(0)
+			if options.get('resume'):
+				PrintMsg('Finished '+str(Resume(journal,PrintMsg))+' relocations left by the last run')
+				if len(args) < 1:
+					journal.Close()
+					if index != None:
+						index.Close()
+					exit(0)
+		if querying:
+			ParseQuery(options.get('query') or '')
+			if len(args) < 1:
+				if index == None:
+					raise ValueError('--query and --report without TARGETs require --index')
+				RunQuery()
+				if journal != None:
+					journal.Close()
+				index.Close()
+				ReportStats(profiler)
+				exit(0)
+		if options.get('apply_plan'):
+			ApplyPlan(options.get('apply_plan'))
+			if journal != None:
+				journal.Close()
+			if index != None:
+				index.Close()
+			ReportStats(profiler)
+			exit(0)
 		if len(args) < 1:
 			raise ValueError('No target directory passed')
+		if options.get('plan_file'):
+			if not options.get('spider'):
+				raise ValueError('--plan-file requires --spider')
+			plan_writer = PlanWriter(options.get('plan_file'),args,copy = options.get('delete_f'),
+				overwrite = options.get('overwrite'),link = options.get('link'))
+		if options.get('dedup'):
+			# The hashes are kept in the index if there's one, so they're not computed again next time
+			dedup = DuplicateFinder(index)
+		if options.get('profile'):
+			import cProfile
+			profiler = cProfile.Profile()
+			profiler.enable()
+		if options.get('plan'):
+			if options.get('stream'):
+				raise ValueError('--plan cannot be used along with --stream')
+			plan = MovePlan()
+			if options.get('watch'):
+				raise ValueError('--plan cannot be used along with --watch')
+		if options.get('similar') != None:
+			if plan == None:
+				raise ValueError('--similar requires --plan')
+			RequirePIL('--similar')
+			similar = SimilarFinder(options.get('similar'),index)
+		if options.get('pipeline'):
+			if options.get('stream') or plan != None:
+				raise ValueError('--pipeline cannot be used along with --stream or --plan')
+			try:
+				options['pipeline_jobs'] = map(int,options.get('pipeline_jobs').split(':'))
+			except ValueError:
+				raise ValueError('--pipeline-jobs must be in the format "LIST:PROBE:RELOCATE"')
+			if len(options.get('pipeline_jobs')) != 3 or min(options.get('pipeline_jobs')) < 1:
+				raise ValueError('--pipeline-jobs needs three numbers, each one at least 1')
+		if options.get('concurrent_targets'):
+			if options.get('device_jobs') < 1:
+				raise ValueError('--device-jobs must be at least 1')
+			scheduler = DeviceScheduler(options.get('device_jobs'))
+			for limit in options.get('device_limits') or []:
+				path,separator,count = limit.rpartition(':')
+				try:
+					count = int(count)
+					device = scheduler.GetDevice(path)
+				except (ValueError,OSError):
+					raise ValueError('--device-limit must be in the format "PATH:JOBS", with PATH an existing path')
+				if count < 1:
+					raise ValueError('--device-limit must allow at least 1 job')
+				scheduler.limits[device] = count
+		if options.get('snapshot'):
+			if options.get('stream') or options.get('pipeline'):
+				raise ValueError('--snapshot cannot be used along with --stream or --pipeline')
+			if os.path.exists(options.get('snapshot')):
+				try:
+					snapshot = Snapshot(options.get('snapshot'),options.get('top_level'))
+				except (ValueError,EnvironmentError),err:
+					PrintMsg('Not using the snapshot: '+str(err))
+		if options.get('jobs') < 1:
+			raise ValueError('--jobs must be at least 1')
+		elif options.get('jobs') > 1:
+			from multiprocessing.pool import ThreadPool
+			pool = ThreadPool(options.get('jobs'))
 	except ValueError,err:
 		print 'main: '+err.message
 		parser.print_help()
@@ -163,9 +932,9 @@ if __name__ == '__main__':
 		# If the argument is valid, that is, a valid and existant directory
 		#
 		if os.path.isdir(argument):
-			## We append a Directory object to the @var directory_to_process
+			## We append it to the @var directory_to_process
 			#
-			directories_to_process.append(Directory(argument,options.get('top_level')))
+			directories_to_process.append(argument)
 		else:
 			## But if it isn't, we increment the @var invalid_arguments by one
 			#
@@ -177,27 +946,74 @@ if __name__ == '__main__':
 		print 'The TARGET or TARGETS must be a path to a directory'
 		exit(BAD_ARGUMENTS)
 
+	## Queries only need the trees, they're reported on and that's it
+	#
+	if querying:
+		RunQuery(RunTargets(LoadTarget,directories_to_process))
+		if snapshot != None:
+			snapshot.Close()
+		if pool != None:
+			pool.close()
+			pool.join()
+		if thumbnails != None:
+			thumbnails.Close()
+		if index != None:
+			index.Close()
+		if journal != None:
+			journal.Close()
+		if plan_writer != None:
+			plan_writer.Close()
+		ReportStats(profiler)
+		exit(0)
+
+	## When streaming, nothing is loaded up front, so we only keep the paths. Otherwise, we load
+	#  a Directory object per @a TARGET
+	#
+	if not options.get('stream') and not options.get('pipeline'):
+		directories_to_process = RunTargets(LoadTarget,directories_to_process)
+		if snapshot != None:
+			snapshot.Close()
+		## The trees are saved as they were found, before anything is relocated: the directories the run
+		#  changes are listed again next time
+		if options.get('snapshot'):
+			SaveSnapshot(options.get('snapshot'),directories_to_process,options.get('top_level'))
+		remaining = EntryCounter()
+		for directorio in directories_to_process:
+			remaining.AddTree(directorio)
+		if progress != None:
+			progress.total = sum(1 for directorio in directories_to_process for images in directorio.GetImages())
+
 	## Now the true main program begins: we start to process each @a TARGET
 	#
+	if options.get('pipeline'):
+		RunPipeline(directories_to_process)
+	else:
+		RunTargets(ProcessTarget,directories_to_process,chained = True)
 
-	for directorio in directories_to_process:
-		try:
-			## Using the @a path of the directory as the top level directory
-			#
-			ProcessFolder(directorio,tld=directorio.path)
-		## It may happen that though the folder exists, the @a path is not accessible,
-		#  thus we throw a @c ValueError exception and catch it here
-		#
-		except ValueError,err:
-			print 'main: '+err
-		## And finally, if the directory we just processed got emptied, 
-		#
-		if directorio.IsEmpty() and not options.get('delete_f'):
-			PrintMsg('Removing'+directorio.dir_name+'since it\'s empty')
-			if not options.get('spider'):
-				## We remove it
-				#
-				os.rmdir(directorio.path)
+	## When planning, nothing has been relocated yet: it's all done now. Then the directories emptied
+	#  are removed
+	if plan != None:
+		if similar != None:
+			GroupSimilar(plan)
+		ExecutePlan(plan)
+		for images in planned_images:
+			thumbnails.Add(images.path)
+	if remaining != None:
+		PruneTargets(directories_to_process)
+	if options.get('watch'):
+		WatchTargets([getattr(directorio,'path',directorio) for directorio in directories_to_process])
+	if pool != None:
+		pool.close()
+		pool.join()
+	if thumbnails != None:
+		thumbnails.Close()
+	if index != None:
+		index.Close()
+	if journal != None:
+		journal.Close()
+	if plan_writer != None:
+		plan_writer.Close()
+	ReportStats(profiler)
 	## @}
 	#
 	exit(0)
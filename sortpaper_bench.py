@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+
+## @file sortpaper_bench.py
+#  @brief Benchmark of the phases of a sortpaper run, over a synthetic wallpaper collection
+#
+#  @details A collection of tiny images is generated in a temporary directory: they're only a few
+#  bytes long, but their headers are valid, so they're probed just like real wallpapers. Then each
+#  phase of a run is timed on its own:
+#  @li @c load: building the @c Directory tree of the collection
+#  @li @c classify: classifying every image, like MeetsCriteria() does
+#  @li @c plan: working out the destinations with GetDestination() and BuildDirTree() (or a @c MovePlan)
+#  @li @c relocate: moving the images with Relocate() (or MovePlan.Execute())
+#
+#  For each phase, the files per second, the calls made to the @c os module per file and the peak
+#  memory of the process are reported, and can be saved as JSON to compare against another version.
+#
+#  Usage: python sortpaper_bench.py [OPTIONS]
+#
+
+import os
+import sys
+import time
+import random
+import struct
+import zlib
+
+from optparse import OptionParser
+from wp_class import *
+from wp_classify import RatioClassifier
+from wp_plan import MovePlan
+
+## @var SYNTHETIC_SIZES
+#  @brief Resolutions generated for each ratio
+#
+#  @details The @c other ratio gets resolutions not matching any of @c STOCK_RATIOS.
+#
+SYNTHETIC_SIZES = {
+	'16:9' : [(1920,1080),(2560,1440),(1366,768),(3840,2160)],
+	'16:10' : [(1920,1200),(1680,1050),(2560,1600),(1440,900)],
+	'4:3' : [(1024,768),(1600,1200),(2048,1536)],
+	'5:4' : [(1280,1024)],
+	'21:9' : [(2560,1080),(3440,1440)],
+	'other' : [(1921,1080),(1000,700),(3000,1000)],
+}
+
+def _PNGChunk(kind,data):
+	return struct.pack('>I',len(data))+kind+data+struct.pack('>I',zlib.crc32(kind+data) & 0xffffffff)
+
+## @brief Tiny, header-valid images of each format, by extension
+#
+#  @details Each function takes the width and height, and returns the contents of the file.
+#
+SYNTHETIC_FORMATS = {
+	'jpg' : lambda width,height: '\xff\xd8\xff\xe0'+struct.pack('>H',16)+'JFIF\x00'+'\x00'*9+
+		'\xff\xc0'+struct.pack('>HBHHB',11,8,height,width,3)+'\x01\x22\x00'*3+'\xff\xd9',
+	'png' : lambda width,height: '\x89PNG\r\n\x1a\n'+_PNGChunk('IHDR',struct.pack('>IIBBBBB',width,height,8,2,0,0,0))+_PNGChunk('IEND',''),
+	'gif' : lambda width,height: 'GIF89a'+struct.pack('<HH',width,height)+'\x00\x00\x00;',
+	'bmp' : lambda width,height: 'BM'+struct.pack('<IHHI',54,0,0,54)+struct.pack('<IiiHHIIiiII',40,width,height,1,24,0,0,0,0,0,0),
+	'webp' : lambda width,height: 'RIFF'+struct.pack('<I',22)+'WEBPVP8X'+struct.pack('<I',10)+'\x00'*4+
+		struct.pack('<I',width-1)[:3]+struct.pack('<I',height-1)[:3],
+}
+
+## @brief Parses a distribution like @c "jpg:0.6,png:0.4" into a @c list of @c (name,weight)
+#
+#  @exception ValueError if @a text is not in the proper format, or a name is not in @a known
+#
+def ParseDistribution(text,known):
+	distribution = []
+	for item in text.split(','):
+		name,weight = item.rsplit(':',1)
+		if name not in known:
+			raise ValueError('ParseDistribution(): unknown '+name+', expected one of '+', '.join(sorted(known)))
+		distribution.append((name,float(weight)))
+	return distribution
+
+def _Pick(generator,distribution):
+	total = sum([weight for name,weight in distribution])
+	point = generator.random()*total
+	for name,weight in distribution:
+		point -= weight
+		if point < 0:
+			return name
+	return distribution[-1][0]
+
+## @brief Generates a synthetic collection of @a files images under @a root
+#
+#  @param root the directory to generate the collection in. It must exist.
+#  @param files the number of images
+#  @param depth how deep the directory tree goes
+#  @param fanout the number of subdirectories of each directory
+#  @param formats the mix of formats, as returned by ParseDistribution()
+#  @param ratios the mix of ratios, as returned by ParseDistribution()
+#  @param seed the seed of the generator, so the same collection can be generated again
+#
+#  @return the number of directories generated, @a root included
+#
+def GenerateCollection(root,files,depth = 2,fanout = 4,formats = (('jpg',1.0),),ratios = (('16:9',1.0),),seed = 0):
+	generator = random.Random(seed)
+	directories = [root]
+	level = [root]
+	for current in range(depth):
+		next_level = []
+		for parent in level:
+			for child in range(fanout):
+				path = os.path.join(parent,'dir%02d' % child)
+				os.mkdir(path)
+				next_level.append(path)
+		directories.extend(next_level)
+		level = next_level
+	for number in range(files):
+		extension = _Pick(generator,formats)
+		width,height = generator.choice(SYNTHETIC_SIZES[_Pick(generator,ratios)])
+		path = os.path.join(directories[number % len(directories)],'wallpaper%07d.%s' % (number,extension))
+		handle = open(path,'wb')
+		handle.write(SYNTHETIC_FORMATS[extension](width,height))
+		handle.close()
+	return len(directories)
+
+## @class SyscallCounter
+#
+#  @brief Counts the calls made to the filesystem functions of the @c os module, and to @c open()
+#
+#  @details The functions are wrapped while the counter is installed. Calls made from C (such as the
+#  ones inside @c scandir) are not seen, so the counts are a lower bound.
+class SyscallCounter(object):
+	FUNCTIONS = ('stat','lstat','fstat','listdir','mkdir','makedirs','rmdir','rename','remove','unlink',
+		'link','open','read','write','close','access','utime','chmod','chown','getcwd','chdir')
+
+	def __init__(self):
+		self.count = 0
+		self.originals = {}
+
+	def _Wrap(self,function):
+		def Counted(*args,**kwargs):
+			self.count += 1
+			return function(*args,**kwargs)
+		return Counted
+
+	def Install(self):
+		import __builtin__
+		for name in self.FUNCTIONS:
+			if hasattr(os,name):
+				self.originals[(os,name)] = getattr(os,name)
+				setattr(os,name,self._Wrap(getattr(os,name)))
+		self.originals[(__builtin__,'open')] = __builtin__.open
+		__builtin__.open = self._Wrap(__builtin__.open)
+
+	def Uninstall(self):
+		for (module,name),function in self.originals.items():
+			setattr(module,name,function)
+		self.originals = {}
+
+## @brief Gets the peak memory of the process so far, in KiB
+def PeakMemory():
+	import resource
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+## @brief Runs each phase of a sort over the collection in @a target, relocating to @a destination
+#
+#  @param target the directory of the collection
+#  @param destination the directory to relocate the images to
+#  @param plan whether to plan and relocate in two phases, with a @c MovePlan
+#  @param jobs the number of threads probing the files while loading
+#  @param threshold the threshold of the classifier
+#
+#  @return a @c dict with the measures of each phase, by name
+#
+def RunPhases(target,destination,plan = False,jobs = 1,threshold = 0.0001):
+	counter = SyscallCounter()
+	phases = {}
+	state = {}
+	def Measure(name,function):
+		start_count = counter.count
+		start = time.time()
+		handled = function()
+		elapsed = time.time()-start
+		phases[name] = {
+			'seconds' : elapsed,
+			'files' : handled,
+			'files_per_sec' : handled/elapsed if elapsed > 0 else None,
+			'syscalls' : counter.count-start_count,
+			'syscalls_per_file' : float(counter.count-start_count)/handled if handled else None,
+			'peak_memory_kb' : PeakMemory(),
+		}
+	def Load():
+		pool = None
+		if jobs > 1:
+			from multiprocessing.pool import ThreadPool
+			pool = ThreadPool(jobs)
+		state['directory'] = Directory(target,True,None,pool)
+		state['images'] = list(state['directory'].GetImages())
+		if pool != None:
+			pool.close()
+		return len(state['images'])
+	def Classify():
+		classifier = RatioClassifier(STOCK_RATIOS,threshold)
+		state['results'] = [classifier.Classify(image.width,image.height) for image in state['images']]
+		return len(state['images'])
+	def Plan():
+		if plan:
+			state['plan'] = MovePlan()
+			known = {}
+			for image,result in zip(state['images'],state['results']):
+				key = (image.dir_path,result)
+				if key not in known:
+					known[key] = os.path.join(destination,*image.GetDestination(result,target).get('dir_tree'))
+				state['plan'].Add(image,known[key])
+			state['plan'].CreateDirectories()
+		else:
+			state['destinations'] = [BuildDirTree(image.GetDestination(result,target).get('dir_tree'),destination)
+				for image,result in zip(state['images'],state['results'])]
+		return len(state['images'])
+	def Relocate():
+		if plan:
+			return state['plan'].Execute()
+		for image,dest in zip(state['images'],state['destinations']):
+			image.Relocate(dest,copy = False,overwrite = True)
+		return len(state['images'])
+	counter.Install()
+	try:
+		for name,function in (('load',Load),('classify',Classify),('plan',Plan),('relocate',Relocate)):
+			Measure(name,function)
+	finally:
+		counter.Uninstall()
+	return phases
+
+## @brief Prints the measures of @a phases as a table, along with the change from @a baseline, if any
+def PrintReport(phases,baseline = None):
+	print '%-10s %10s %10s %14s %12s %12s' % ('phase','files','seconds','files/sec','calls/file','peak KiB')
+	for name in ('load','classify','plan','relocate'):
+		phase = phases[name]
+		line = '%-10s %10d %10.3f %14.1f %12.2f %12d' % (name,phase['files'],phase['seconds'],
+			phase['files_per_sec'] or 0,phase['syscalls_per_file'] or 0,phase['peak_memory_kb'])
+		if baseline != None and name in baseline and baseline[name].get('files_per_sec'):
+			line += '   %+.1f%% files/sec' % (100.0*((phase['files_per_sec'] or 0)/baseline[name]['files_per_sec']-1))
+		print line
+
+def CreateParser():
+	parser = OptionParser(usage='python %prog [OPTIONS]')
+	parser.add_option('-n','--files',type='int',dest='files',help='number of images generated. Defaults to 10000',default=10000)
+	parser.add_option('--depth',type='int',dest='depth',help='depth of the directory tree generated. Defaults to 2',default=2)
+	parser.add_option('--fanout',type='int',dest='fanout',help='subdirectories per directory. Defaults to 4',default=4)
+	parser.add_option('--formats',type='str',dest='formats',help='mix of formats, as "FORMAT:WEIGHT,..." with FORMAT one of jpg, png, gif, bmp, webp. Defaults to "jpg:0.7,png:0.2,gif:0.04,bmp:0.03,webp:0.03"',default='jpg:0.7,png:0.2,gif:0.04,bmp:0.03,webp:0.03')
+	parser.add_option('--ratios',type='str',dest='ratios',help='mix of ratios, as "RATIO:WEIGHT,..." with RATIO one of 16:9, 16:10, 4:3, 5:4, 21:9, other. Defaults to "16:9:0.5,16:10:0.25,4:3:0.1,5:4:0.05,21:9:0.05,other:0.05"',default='16:9:0.5,16:10:0.25,4:3:0.1,5:4:0.05,21:9:0.05,other:0.05')
+	parser.add_option('--seed',type='int',dest='seed',help='seed of the collection generated. Defaults to 0',default=0)
+	parser.add_option('--plan',action='store_true',dest='plan',help='plan and relocate in two phases, like sortpaper.py --plan',default=False)
+	parser.add_option('-j','--jobs',type='int',dest='jobs',help='number of files probed at the same time while loading. Defaults to 1',default=1)
+	parser.add_option('--dir',type='str',dest='work_dir',help='directory to generate the collection in. Defaults to a temporary directory',default=None)
+	parser.add_option('--keep',action='store_true',dest='keep',help='do not remove the generated collection afterwards',default=False)
+	parser.add_option('-o','--output',type='str',dest='output',help='file to save the results to, as JSON',default=None)
+	parser.add_option('--compare',type='str',dest='compare',help='JSON file of a previous run to compare the results against',default=None)
+	return parser
+
+if __name__ == '__main__':
+	import json
+	import shutil
+	import tempfile
+	parser = CreateParser()
+	(options,args) = parser.parse_args()
+	try:
+		formats = ParseDistribution(options.formats,SYNTHETIC_FORMATS)
+		ratios = ParseDistribution(options.ratios,SYNTHETIC_SIZES)
+	except ValueError,err:
+		print 'main: '+str(err)
+		parser.print_help()
+		exit(BAD_ARGUMENTS)
+
+	work_dir = tempfile.mkdtemp(prefix='sortpaper_bench_',dir=options.work_dir)
+	target = os.path.join(work_dir,'collection')
+	destination = os.path.join(work_dir,'sorted')
+	os.mkdir(target)
+	os.mkdir(destination)
+	try:
+		start = time.time()
+		directories = GenerateCollection(target,options.files,options.depth,options.fanout,formats,ratios,options.seed)
+		print 'Generated %d images in %d directories in %.2f seconds' % (options.files,directories,time.time()-start)
+		phases = RunPhases(target,destination,options.plan,options.jobs)
+	finally:
+		if not options.keep:
+			shutil.rmtree(work_dir)
+
+	baseline = None
+	if options.compare:
+		baseline = json.load(open(options.compare)).get('phases')
+	PrintReport(phases,baseline)
+	if options.output:
+		results = {
+			'parameters' : {
+				'files' : options.files,
+				'depth' : options.depth,
+				'fanout' : options.fanout,
+				'formats' : options.formats,
+				'ratios' : options.ratios,
+				'seed' : options.seed,
+				'plan' : options.plan,
+				'jobs' : options.jobs,
+			},
+			'python' : sys.version.split()[0],
+			'timestamp' : time.time(),
+			'phases' : phases,
+		}
+		handle = open(options.output,'w')
+		json.dump(results,handle,indent=1,sort_keys=True)
+		handle.close()
+	exit(0)
@@ -0,0 +1,92 @@
+## @file wp_batch.py
+#  @brief Columnar storage of the metadata of many images
+#
+#  @details When the images are processed as a whole (to classify them in one go, for instance), there's
+#  no need to keep an object per image. @c ImageBatch keeps the widths and heights in flat arrays of
+#  integers, the directories in a table shared by every image, and only the file names as strings.
+#
+
+from array import array
+
+## @var numpy
+#  @brief The @c numpy module, if installed
+#
+#  @details It's only used to hand the columns of an @c ImageBatch as numpy arrays, without copying them.
+#
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+## @class ImageBatch
+#
+#  @brief A batch of images stored column by column
+#
+#  @details Each image is a row, split across the columns @a widths, @a heights and @a directories (an
+#  index into @a dir_table) and @a filenames. Rows are never removed, so their position can be used
+#  to refer to them.
+class ImageBatch(object):
+	__slots__ = ('widths','heights','directories','filenames','dir_table','dir_ids')
+
+	def __init__(self,images = ()):
+		self.widths = array('I')
+		self.heights = array('I')
+		self.directories = array('I')
+		self.filenames = []
+		self.dir_table = []
+		self.dir_ids = {}
+		for image in images:
+			self.Append(image)
+
+	def __len__(self):
+		return len(self.filenames)
+
+	## @brief Adds a row to the batch
+	#
+	#  @param dir_path the directory of the image
+	#  @param filename the name of the image
+	#  @param width the width of the image
+	#  @param height the height of the image
+	#
+	#  @return the position of the row
+	#
+	def Add(self,dir_path,filename,width,height):
+		dir_id = self.dir_ids.get(dir_path)
+		if dir_id == None:
+			dir_id = self.dir_ids[dir_path] = len(self.dir_table)
+			self.dir_table.append(dir_path)
+		self.widths.append(width)
+		self.heights.append(height)
+		self.directories.append(dir_id)
+		self.filenames.append(filename)
+		return len(self.filenames)-1
+
+	## @brief Adds the @c ImageFile @a image to the batch
+	#
+	#  @return the position of the row
+	#
+	def Append(self,image):
+		return self.Add(image.dir_path,image.filename,image.width,image.height)
+
+	## @brief Gets the path of the image in the row @a position
+	def GetPath(self,position):
+		import os
+		return os.path.join(self.dir_table[self.directories[position]],self.filenames[position])
+
+	## @brief Gets the @c ImageFile of the image in the row @a position
+	#
+	#  @details The file is not read again: the object is built from the stored metadata.
+	#
+	def GetImage(self,position):
+		from wp_class import ImageFile
+		return ImageFile.FromMetadata(self.dir_table[self.directories[position]],self.filenames[position],
+			self.widths[position],self.heights[position])
+
+	## @brief Gets the widths and heights of the batch, as numpy arrays if numpy is installed
+	#
+	#  @return a @c tuple @c (widths,heights), sharing memory with the batch when numpy is used
+	#
+	def GetColumns(self):
+		if numpy != None:
+			return (numpy.frombuffer(self.widths,dtype=numpy.uint32),numpy.frombuffer(self.heights,dtype=numpy.uint32))
+		return (self.widths,self.heights)
@@ -1,3 +1,5 @@
+from wp_stats import STATS, Timed
+
 ## @var RECURSIVE
 #  @brief Flag to indicate recursivity when loading the directory trees
 #
@@ -67,11 +69,17 @@ def BuildDirTree(dir_tree,directory):
 	directory = os.path.abspath(directory)
 	if os.path.isdir(directory):
 		if isinstance(dir_tree,(list,tuple)):
+			import errno
 			path = directory
 			for dirs in dir_tree:
 				path = os.path.join(path,dirs)
 				if not os.path.lexists(path):
-					os.mkdir(path)	
+					# Another thread may be building the same tree
+					try:
+						os.mkdir(path)
+					except OSError,err:
+						if err.errno != errno.EEXIST:
+							raise
 			return path
 		else:
 			raise TypeError('BuildDirTree(): Argument dir_tree is not a tuple or list, got '+type(dir_tree).__name__)
@@ -126,16 +134,17 @@ def GetDirTree(top_level_dir,path):
 #  @details This class can handle every kind of image files, with a resolution equal or greater than 640x480
 #  It's got information about the ratio, the resolution, its location on the filesystem and more things.
 #  \n It derives from @c clsObject
+#
+#  @details Since there's one per image, and there can be millions of them, the objects are kept small:
+#  there's no per-instance @c __dict__, only the slots below. The directory of the image is interned, so
+#  every image of a directory shares the same string, and the dimensions are kept as integers. The
+#  @a path, @a size, @a resolution and @a ratio are computed from them when requested; the @a ratio is
+#  kept once computed, since the classifiers don't need it and it's only worked out for the few images
+#  asking for it.
+#
+#  No handle on the file is kept: it's only opened while probing its dimensions, and by Open().
 class ImageFile(object):
-	img = None
-	path = ''
-	dir_path = ''
-	filename = ''
-	size = ()
-	resolution = ()
-	ratio = float(0)
-	destination = None
-	separator = None
+	__slots__ = ('dir_path','filename','width','height','destination','separator','_ratio')
 
 	## @brief the constructor of a @c ImageFile object
 	#
@@ -143,6 +152,8 @@ class ImageFile(object):
 	#  to be used, such as the ratio, the resolution, its path and directory.
 	#
 	#  @param path the path of the image to create an object for
+	#  @param size the @c (width,height) of the image, if already known. If @c None, it's read
+	#  from the file with ProbeDimensions()
 	#
 	#  @return a new instance of @c ImageFile
 	#
@@ -152,30 +163,79 @@ class ImageFile(object):
 	#  @exception ValueError if the image file is too small (less than 640x480), we can't consider it a wallpaper,
 	#  so no @c ImageFile object for it.
 	#
-	def __new__(clsObject,path):
-		import Image
+	def __new__(clsObject,path,size = None):
+		from wp_probe import ProbeDimensions
 		import os
 		base = super(ImageFile,clsObject).__new__(clsObject)
 		path_d = os.path.abspath(path)
 		try:
-			img = Image.open(path_d)
-			if (img.size[0] < 640) or (img.size[1] < 480):
+			if size == None:
+				size = ProbeDimensions(path_d)
+			if (size[0] < 640) or (size[1] < 480):
 				raise ValueError('ImageFile.__init__():	Image '+os.path.split(path_d)[1]+' too small to be a wallpaper')
 		except IOError:
 			base = None
 			return base
 		base.path = path_d
-		base.dir_path = os.path.split(path_d)[0]
-		base.filename = os.path.split(path_d)[1]
-		base.size = img.size
-		base.resolution = map(str,img.size)
-		try:
-			base.ratio = float(img.size[0])/img.size[1]
-		except ZeroDivisionError:
-			base.ratio = 0
-		img = None
+		base.width = int(size[0])
+		base.height = int(size[1])
+		base.destination = None
+		base.separator = None
 		return base
 
+	## @brief Builds the @c ImageFile of an image already known, such as one from the index or a plan
+	#
+	#  @details Neither the file nor the path are checked: @a dir_path is expected to be absolute and
+	#  normalized, and @a width and @a height to be those of a wallpaper.
+	#
+	#  @param dir_path the directory of the image
+	#  @param filename the name of the image
+	#  @param width the width of the image
+	#  @param height the height of the image
+	#
+	@classmethod
+	def FromMetadata(clsObject,dir_path,filename,width,height):
+		base = super(ImageFile,clsObject).__new__(clsObject)
+		if isinstance(dir_path,str):
+			dir_path = intern(dir_path)
+		base.dir_path = dir_path
+		base.filename = filename
+		base.width = int(width)
+		base.height = int(height)
+		base.destination = None
+		base.separator = None
+		return base
+
+	def _GetPath(self):
+		import os
+		return os.path.join(self.dir_path,self.filename)
+
+	def _SetPath(self,path):
+		import os
+		dir_path,self.filename = os.path.split(path)
+		if isinstance(dir_path,str):
+			dir_path = intern(dir_path)
+		self.dir_path = dir_path
+
+	## @brief the absolute path of the image
+	path = property(_GetPath,_SetPath)
+
+	## @brief the @c (width,height) of the image
+	size = property(lambda self: (self.width,self.height))
+
+	## @brief the width and height of the image, as a @c list of strings
+	resolution = property(lambda self: [str(self.width),str(self.height)])
+
+	def _GetRatio(self):
+		try:
+			return self._ratio
+		except AttributeError:
+			self._ratio = self.CalcRatio((self.width,self.height))
+			return self._ratio
+
+	## @brief the aspect ratio of the image, that is, its width divided by its height
+	ratio = property(_GetRatio)
+
 	def GetResolution(self,separator='x'):
 		return self.resolution[0]+separator+self.resolution[1]
 
@@ -233,12 +293,17 @@ class ImageFile(object):
 		else:
 			raise TypeError('SameRatio(): Argument must be a tuple, list, float or string, got '+type(ratio).__name__)
 
-	def Reopen(self):
+	## @brief Opens the image with PIL
+	#
+	#  @details The image is not kept: it's up to the caller to drop it once done, which closes the file.
+	#
+	#  @return the PIL @c Image
+	#
+	#  @exception IOError if the file cannot be read, or it's not an image PIL can identify
+	#
+	def Open(self):
 		import Image
-		try:
-			self.img = Image.open(self.path)
-		except IOError,err:
-			print err.strerror
+		return Image.open(self.path)
 
 	import shutil
 	def CopyMove(self,destination = None,function = shutil.move):
@@ -249,13 +314,25 @@ class ImageFile(object):
 		if self.destination != None:
 			destination = self.destination
 		try:
-			function(self.path,destination)
-		except IOError,err:
-			raise AttributeError('CopyMove(): Error moving/copying '+self.path+': '+err.strerror)
+			# The full path of the destination file is given, so it doesn't need to be worked out again
+			return function(self.path,path.join(destination,self.filename))
+		except EnvironmentError,err:
+			raise AttributeError('CopyMove(): Error moving/copying '+self.path+': '+(err.strerror or str(err)))
 
-	def Relocate(self,destination = None,copy = not COPY_IMAGE, overwrite = not OVERWRITE_FILES):
+	## @brief Moves or copies the image to the directory @a destination
+	#
+	#  @param destination the existing directory to relocate the image to
+	#  @param copy whether to copy the image instead of moving it
+	#  @param overwrite whether to overwrite a file with the same name in @a destination
+	#  @param link when copying, link the image instead (@c 'hard' or @c 'reflink'), if possible
+	#
+	#  @retval True if the image was relocated
+	#  @retval False if it's already in @a destination
+	#
+	@Timed('Relocate')
+	def Relocate(self,destination = None,copy = not COPY_IMAGE, overwrite = not OVERWRITE_FILES, link = None):
 		import os
-		import shutil
+		from wp_transfer import CopyFile, LinkFile, MoveFile
 		if self.destination == None and destination == None:
 			raise ValueError('Relocate(): No destination avaliable')
 		if not isinstance(destination,str):
@@ -274,10 +351,12 @@ class ImageFile(object):
 					os.remove(dest_file)
 					file_exists = False
 				if not file_exists:
-					if copy:
-						self.CopyMove(None,shutil.copy2)
+					if copy and link != None:
+						self.CopyMove(None,lambda source,target: LinkFile(source,target,link))
+					elif copy:
+						self.CopyMove(None,CopyFile)
 					else:
-						self.CopyMove(None,shutil.move)
+						self.CopyMove(None,MoveFile)
 					self.path = os.path.join(destination,self.filename)
 					self.dir_path = destination
 					return True
@@ -287,87 +366,165 @@ class ImageFile(object):
 	def GetDestinationRatio(self,threshold):
 		if not isinstance(threshold,float):
 			raise TypeError('GetDestinationRatio(): argument is not a float, got '+type(threshold).__name__)
-		dest_ratio = None
-		if self.ratio in STOCK_RATIOS:
-			dest_ratio = STOCK_RATIOS[self.ratio]
-		else:
-			try:
-				for ratio in STOCK_RATIOS.keys():
-					if (abs(ratio-self.ratio) < threshold):
-						dest_ratio = STOCK_RATIOS[ratio]
-						raise Exception
-			except Exception,err:
-				print err
-		return dest_ratio
+		from wp_classify import RatioClassifier
+		return RatioClassifier(STOCK_RATIOS,threshold).Classify(self.width,self.height)
 
 	# Pre-cond:	type_ratio tiene que bien estar contenida en las llaves de STOCK_RATIOS, valer None o
 	#		ser una resolucion
 	#		top_level_dir tiene que existir y ser un directorio
 	#		ImageFile.dir_path tiene que contener a top_level_dir
-	def GetDestination(self,type_ratio,top_level_dir):
+	# set_aside es la carpeta, dentro de top_level_dir, donde --similar aparta las imagenes (ver
+	#		--similar-folder). Ya estan ordenadas, asi que se deja fuera del arbol como la de un ratio
+	def GetDestination(self,type_ratio,top_level_dir,set_aside = None):
 		from os import path
 		#We get the directory hierarchy of the image according to the TLD
 		dir_tree = GetDirTree(top_level_dir,self.dir_path)
 
-		# Next we check if the resulting dir_tree's first element has one
-		# of the stock ratios
-		if dir_tree != [] and dir_tree[0] in STOCK_RATIOS.values():
-			dir_tree.pop(0)
-		
-		# And we insert the corresponding folder into the directory tree.
-		# If type_ratio is None, it will insert 'Non-matching'
+		# The images put aside are sorted already, under the folder they'd go to otherwise
+		if set_aside:
+			aside = set_aside.strip(path.sep).split(path.sep)
+			if dir_tree[:len(aside)] == aside:
+				del dir_tree[:len(aside)]
+
+		# The corresponding folder. If type_ratio is None, it will be 'Non-matching'.
+		# The destinations of the rules (see wp_rules) can be several folders deep
 		try:
-			dir_tree.insert(0,STOCK_RATIOS[type_ratio])
+			folders = [STOCK_RATIOS[type_ratio]]
 		except KeyError:
-			dir_tree.insert(0,type_ratio)
+			folders = type_ratio.split('/')
+
+		# Next we check if the resulting dir_tree already starts with those
+		# folders, or with one of the stock ratios
+		if dir_tree[:len(folders)] == folders:
+			del dir_tree[:len(folders)]
+		elif dir_tree != [] and dir_tree[0] in STOCK_RATIOS.values():
+			dir_tree.pop(0)
+		
+		# And we insert them into the directory tree.
+		dir_tree[0:0] = folders
 		
 		# We return the resulting operation as a dictionary
 		result = {'dest' : top_level_dir,'dir_tree': dir_tree }
 		
 		return result
 
+## @brief Probes the file at @a path and builds its @c ImageFile
+#
+#  @details This function never raises: the error found, if any, is handed back instead, so the
+#  caller can report it. That way, it can be run by the workers of the pool passed to @c Directory,
+#  and the errors are still reported in the same order as a serial run.
+#
+#  @param path the absolute path of the file
+#  @param probe the function used to get the dimensions of the file, ProbeDimensions() by default
+#
+#  @return a @c tuple @c (image,error)
+#
+#  @retval (ImageFile,None) if @a path is a wallpaper
+#  @retval (None,None) if @a path is known not to be an image
+#  @retval (None,error) if the @c IOError, @c OSError or @c ValueError @a error was raised. The index
+#  (see @c MetadataIndex.Probe()) raises @c OSError for a file gone since it was listed.
+#
+def LoadImage(path,probe = None):
+	if probe == None:
+		from wp_probe import ProbeDimensions
+		probe = ProbeDimensions
+	STATS.Count('files_probed')
+	try:
+		# The dimensions are read once here, and handed to the ImageFile
+		size = probe(path)
+		if size != None:
+			return (ImageFile(path,size),None)
+	except EnvironmentError,err:
+		STATS.Count('probe_failures')
+		return (None,err)
+	except ValueError,err:
+		STATS.Count('too_small')
+		return (None,err)
+	return (None,None)
+
+## @brief Prints the error LoadImage() found for @a filename, if it's worth reporting
+#
+#  @param filename the name of the file
+#  @param err the error handed back by LoadImage(), or @c None
+#
+def ReportLoadError(filename,err):
+	if isinstance(err,IOError):
+		if err.errno == 13: # Permission denied
+			print 'GetDirectories(): image',filename+':',err.strerror
+		# I've had cases where Image cannot figure out the file type, and throws an IOError
+		# Opening the image with your favorite image processing program, Save As... and 
+		# overwriting it solves the issue, which is beyond the scope of this script.
+		elif err.errno == None: 
+			print 'GetDirectories(): image',filename+':',err
+		else:
+			print 'GetDirectories(): image',filename+':',err.strerror
+	elif isinstance(err,EnvironmentError):
+		# Gone, or renamed, since it was listed
+		print 'GetDirectories(): image',filename+':',err.strerror or err
+	elif isinstance(err,ValueError):
+		print err
+
 class Directory(object):
-	path = None
-	dir_name = None
-	listing = {
-			'directories' : None,
-			'files' : None
-		  }
-
-	def GetDirectories(self,recursivity = RECURSIVE):
+	__slots__ = ('path','dir_name','listing','entries','mtime')
+
+	## @brief Lists the directory, building the @c Directory and @c ImageFile objects of its contents
+	#
+	#  @param recursivity whether to load the subdirectories as well
+	#  @param index the @c MetadataIndex to go through, if any
+	#  @param pool a pool of workers (@c multiprocessing.pool.ThreadPool) to probe the files with. If
+	#  @c None, they're probed one at a time.
+	#  @param snapshot the @c Snapshot of a previous scan, if any. The subdirectories that didn't change
+	#  since are taken from it, instead of being listed again.
+	#
+	#  @details Every path is built from the absolute path of the directory, so the current working
+	#  directory is never changed, and several trees can be loaded at the same time.
+	#
+	@Timed('GetDirectories')
+	def GetDirectories(self,recursivity = RECURSIVE,index = None,pool = None,snapshot = None):
 		import os
+		from wp_probe import ProbeDimensions
+		from wp_walk import ScanDir
+		# Going through the index, files already seen are not read again
+		if index != None:
+			probe = index.Probe
+		else:
+			probe = ProbeDimensions
 		if os.path.isdir(self.path):
+			STATS.Count('directories_scanned')
 			directories = {}
 			filess = {}
 			listing = {}
-			cwd = os.getcwd()
-			os.chdir(self.path)
-			files = os.listdir(os.getcwd())
-			for files in files:
-				filename = os.path.split(files)[1]
-				if os.path.isdir(files) and recursivity:
-					directory = Directory(files)
+			work = []
+			# Taken before listing, so a change made meanwhile shows in the next snapshot (see wp_snapshot.py)
+			self.mtime = os.stat(self.path).st_mtime
+			entries = ScanDir(self.path)
+			# Every entry, images or not, so it's known when the directory is emptied (see wp_prune.py)
+			self.entries = len(entries)
+			for filename,is_dir in entries:
+				if is_dir and recursivity:
+					directory = None
+					if snapshot != None:
+						directory = snapshot.Load(os.path.join(self.path,filename),index,pool)
+					if directory == None:
+						directory = Directory(os.path.join(self.path,filename),recursivity,index,pool,snapshot)
 					if directory.path != None:
 						directories[filename] =  directory
 					else:
 						directory = None
+				elif not is_dir:
+					work.append(filename)
+			# The files are probed by the pool, if any. Either way, the results come back in
+			# the same order as the work
+			paths = [os.path.join(self.path,filename) for filename in work]
+			if pool != None:
+				results = pool.map(lambda path: LoadImage(path,probe),paths)
+			else:
+				results = [LoadImage(path,probe) for path in paths]
+			for filename,(image,err) in zip(work,results):
+				if image != None:
+					filess[filename] = image
 				else:
-					import Image
-					try:
-						im = Image.open(files)
-						im = None
-						filess[filename] = ImageFile(files)
-					except IOError,err:
-						if err.errno == 13: # Permission denied
-							print 'GetDirectories(): image',files+':',err.strerror
-						# I've had cases where Image cannot figure out the file type, and throws an IOError
-						# Opening the image with your favorite image processing program, Save As... and 
-						# overwriting it solves the issue, which is beyond the scope of this script.
-						elif err.errno == None: 
-							print 'GetDirectories(): image',files+':',err
-					except ValueError,err:
-						print err
-			os.chdir(cwd)
+					ReportLoadError(filename,err)
 			if directories != {}:
 				listing['directories'] = directories
 			if filess != {}:
@@ -382,12 +539,15 @@ class Directory(object):
 				pass
 		return None
 
-	def __init__(self,directory,recursive = RECURSIVE):
+	def __init__(self,directory,recursive = RECURSIVE,index = None,pool = None,snapshot = None):
 		from os import path
+		self.listing = None
+		self.entries = 0
+		self.mtime = None
 		self.path = path.abspath(directory)
 		if path.isdir(self.path):
 			try:			
-				self.listing = self.GetDirectories(recursive)
+				self.listing = self.GetDirectories(recursive,index,pool,snapshot)
 			except OSError,err:
 				self.listing = None
 				self.path = None
@@ -398,6 +558,31 @@ class Directory(object):
 		except AttributeError:
 			self.dir_name = None
 
+	## @brief Builds the @c Directory of a directory already listed, such as one from a @c Snapshot
+	#
+	#  @details The directory is not touched.
+	#
+	#  @param path the absolute path of the directory
+	#  @param files a @c dict with the @c ImageFile of each image, by name
+	#  @param directories a @c dict with the @c Directory of each subdirectory, by name
+	#  @param entries the number of entries of the directory, images or not
+	#  @param mtime the modification time of the directory when it was listed
+	#
+	@classmethod
+	def FromListing(clsObject,path,files,directories,entries,mtime):
+		import os
+		base = clsObject.__new__(clsObject)
+		base.path = path
+		base.dir_name = os.path.split(path)[1]
+		base.listing = {}
+		if directories:
+			base.listing['directories'] = directories
+		if files:
+			base.listing['files'] = files
+		base.entries = entries
+		base.mtime = mtime
+		return base
+
 	## Method to print a list of all the directories and files (in that order) on screen
 	#  
 	#  @todo implement logging of this function
@@ -437,8 +622,7 @@ class Directory(object):
 	def RemoveFile(self,image_file):
 		if not isinstance(image_file,str):
 			raise TypeError('RemoveFile(): Argument must be a string, got '+type(image_file).__name__)
-		if image_file in self.self.listing['files']:
-			self.listing['files'].get(image_file).img = None
+		if image_file in self.listing['files']:
 			self.listing['files'].pop(image_file)
 
 	def RemoveDir(self,directorio):
@@ -456,3 +640,18 @@ class Directory(object):
 			raise TypeError('DirHasFile(): Argument must be a string, got '+type(image_file).__name__)
 		return image_file in self.GetDictionary('files')
 
+
+	## @brief Goes through every image of the tree, this directory first
+	#
+	#  @return a generator of the @c ImageFile objects of the tree
+	#
+	def GetImages(self):
+		files = self.GetDictionary('files')
+		if files != None:
+			for image in files.values():
+				yield image
+		directories = self.GetDictionary('directories')
+		if directories != None:
+			for directory in directories.values():
+				for image in directory.GetImages():
+					yield image
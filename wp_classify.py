@@ -0,0 +1,139 @@
+## @file wp_classify.py
+#  @brief Classification of images by aspect ratio or resolution
+#
+#  @details The ratios are kept sorted, so the closest ratio to an image is found with a binary search
+#  instead of going through all of them, and the threshold is applied to the closest one only. The
+#  resolutions are kept in a dictionary keyed by @c (width,height). Both classifiers can also work on
+#  whole columns of widths and heights at once (see @c ImageBatch), which is done with numpy when it's
+#  installed.
+#
+#  Every classifier takes the paths of the images as well, even if only some of them need it (see
+#  @c RulesClassifier in wp_rules.py), so they can all be called the same way.
+#
+
+from bisect import bisect_left
+
+## @var numpy
+#  @brief The @c numpy module, if installed
+#
+try:
+	import numpy
+except ImportError:
+	numpy = None
+
+## @class RatioClassifier
+#
+#  @brief Assigns images to the closest of a set of aspect ratios
+#
+#  @details An image belongs to a ratio if it's the same, or the difference between the two is below the
+#  threshold. When an image is close enough to more than one ratio, the closest one wins.
+class RatioClassifier(object):
+
+	## @brief Builds a classifier for the given @a ratios
+	#
+	#  @param ratios a dictionary like @c STOCK_RATIOS: the ratios as @c float keys, and their names as
+	#  values. The @c None key, if any, is left out.
+	#  @param threshold how far from a ratio an image can be to still belong to it
+	#
+	def __init__(self,ratios,threshold = 0.0):
+		if not isinstance(threshold,float):
+			raise TypeError('RatioClassifier(): threshold is not a float, got '+type(threshold).__name__)
+		self.keys = sorted([ratio for ratio in ratios.keys() if ratio != None])
+		self.names = [ratios[ratio] for ratio in self.keys]
+		self.threshold = threshold
+
+	## @brief Gets the position in @a keys of the ratio @a ratio belongs to
+	#
+	#  @retval -1 if it doesn't belong to any
+	#
+	def Find(self,ratio):
+		keys = self.keys
+		position = bisect_left(keys,ratio)
+		best = -1
+		distance = None
+		# Only the ratios right below and right above can be the closest
+		for candidate in (position-1,position):
+			if 0 <= candidate < len(keys):
+				difference = abs(keys[candidate]-ratio)
+				if difference == 0 or difference < self.threshold:
+					if distance == None or difference < distance:
+						best = candidate
+						distance = difference
+		return best
+
+	## @brief Gets the name of the ratio an image of @a width x @a height belongs to
+	#
+	#  @retval None if it doesn't belong to any
+	#
+	def Classify(self,width,height,path = None):
+		try:
+			ratio = float(width)/height
+		except ZeroDivisionError:
+			ratio = 0
+		position = self.Find(ratio)
+		if position < 0:
+			return None
+		return self.names[position]
+
+	## @brief Classifies a whole batch of images in one go
+	#
+	#  @param widths the widths of the images, as any sequence (or numpy array)
+	#  @param heights the heights of the images, in the same order as @a widths
+	#  @param paths the paths of the images, not needed here
+	#
+	#  @return a @c list with the name of the ratio of each image, or @c None for those not
+	#  belonging to any
+	#
+	def ClassifyBatch(self,widths,heights,paths = None):
+		if numpy == None or len(self.keys) == 0:
+			return [self.Classify(width,height) for width,height in zip(widths,heights)]
+		widths = numpy.asarray(widths,dtype=numpy.float64)
+		heights = numpy.asarray(heights,dtype=numpy.float64)
+		ratios = numpy.zeros(len(widths))
+		numpy.divide(widths,heights,out=ratios,where=(heights != 0))
+		keys = numpy.array(self.keys)
+		positions = numpy.searchsorted(keys,ratios)
+		below = numpy.clip(positions-1,0,len(keys)-1)
+		above = numpy.clip(positions,0,len(keys)-1)
+		distance_below = numpy.abs(keys[below]-ratios)
+		distance_above = numpy.abs(keys[above]-ratios)
+		best = numpy.where(distance_above < distance_below,above,below)
+		distance = numpy.minimum(distance_below,distance_above)
+		matches = (distance == 0) | (distance < self.threshold)
+		names = self.names
+		return [names[position] if match else None for position,match in zip(best.tolist(),matches.tolist())]
+
+## @class ResolutionClassifier
+#
+#  @brief Picks the images with one of a set of resolutions
+class ResolutionClassifier(object):
+
+	## @brief Builds a classifier for the given @a resolutions
+	#
+	#  @param resolutions a @c list of resolutions as strings, like @c "1920x1080"
+	#  @param separator the character separating the width and the height in @a resolutions
+	#
+	#  @exception ValueError if one of the @a resolutions is not two numbers separated by @a separator
+	#
+	def __init__(self,resolutions,separator = 'x'):
+		self.resolutions = {}
+		for resolution in resolutions:
+			size = resolution.split(separator)
+			if len(size) != 2:
+				raise ValueError('ResolutionClassifier(): Not a proper resolution, got '+resolution)
+			self.resolutions[(int(size[0]),int(size[1]))] = resolution
+
+	## @brief Gets the resolution, as it was given, of an image of @a width x @a height
+	#
+	#  @retval None if it's not one of the resolutions
+	#
+	def Classify(self,width,height,path = None):
+		return self.resolutions.get((width,height))
+
+	## @brief Classifies a whole batch of images in one go
+	#
+	#  @return a @c list with the resolution of each image, or @c None for those not matching
+	#
+	def ClassifyBatch(self,widths,heights,paths = None):
+		resolutions = self.resolutions
+		return [resolutions.get(size) for size in zip(widths,heights)]
@@ -0,0 +1,144 @@
+## @file wp_dedup.py
+#  @brief Detection of images with the exact same contents
+#
+#  @details Hashing every file would mean reading the whole collection. But two files can only be the
+#  same if they have the same size in bytes and the same dimensions, so the images are grouped by those
+#  first, and only the ones falling in the same group as another are hashed. Hashes are cached by the
+#  identity of the file (device, inode, size and modification time), so each file is hashed once, even
+#  across runs when the cache is a @c MetadataIndex.
+#
+
+import os
+from wp_stats import STATS
+
+## @var DEDUP_ACTIONS
+#  @brief What can be done with a duplicate: leave it where it is, link it to the original, or just report it
+#
+DEDUP_ACTIONS = ('skip','link','report')
+
+## @var HASH_CHUNK
+#  @brief Number of bytes read at a time while hashing a file
+#
+HASH_CHUNK = 1 << 20
+
+## @brief Gets the identity of a file from its @a stat, used to key the hash caches
+def StatIdentity(stat):
+	return (stat.st_dev,stat.st_ino,stat.st_size,stat.st_mtime)
+
+## @class MemoryHashCache
+#
+#  @brief Cache of hashes kept in memory, for the current run only
+#
+#  @details It has the same interface as the hash cache of @c MetadataIndex, which keeps them on disk.
+class MemoryHashCache(object):
+
+	def __init__(self):
+		self.hashes = {}
+
+	def LookupHash(self,stat,kind = 'content'):
+		return self.hashes.get((kind,)+StatIdentity(stat))
+
+	def StoreHash(self,stat,digest,kind = 'content'):
+		self.hashes[(kind,)+StatIdentity(stat)] = digest
+
+## @brief Gets the SHA-1 of the contents of the file at @a path
+def HashFile(path):
+	import hashlib
+	digest = hashlib.sha1()
+	handle = open(path,'rb')
+	try:
+		while True:
+			data = handle.read(HASH_CHUNK)
+			if not data:
+				break
+			digest.update(data)
+			STATS.Count('bytes_hashed',len(data))
+	finally:
+		handle.close()
+	STATS.Count('files_hashed')
+	return digest.hexdigest()
+
+## @class DuplicateFinder
+#
+#  @brief Finds the images with the same contents as an image seen before
+#
+#  @details The images are checked one at a time, in the order they're processed, so the first one
+#  seen of a set of duplicates is the original. It works the same whether the whole tree was loaded
+#  beforehand or the images are being streamed.
+class DuplicateFinder(object):
+
+	## @param cache where the hashes are cached: a @c MetadataIndex, or a @c MemoryHashCache by default
+	def __init__(self,cache = None):
+		import threading
+		if cache == None:
+			cache = MemoryHashCache()
+		self.cache = cache
+		# By (size,width,height): the only image seen, or the images seen by hash
+		self.groups = {}
+		self.lock = threading.Lock()
+
+	## @brief Gets the hash of the file at @a path, from the cache if it didn't change
+	def GetHash(self,path,stat = None):
+		if stat == None:
+			stat = os.stat(path)
+		digest = self.cache.LookupHash(stat)
+		if digest == None:
+			digest = HashFile(path)
+			self.cache.StoreHash(stat,digest)
+		return digest
+
+	## @brief Checks whether @a image has the same contents as one of the images checked before
+	#
+	#  @param image the @c ImageFile to check
+	#
+	#  @return the @c ImageFile @a image is a duplicate of
+	#
+	#  @retval None if @a image is the first one seen with its contents
+	#
+	def Check(self,image):
+		stat = os.stat(image.path)
+		key = (stat.st_size,image.width,image.height)
+		self.lock.acquire()
+		try:
+			group = self.groups.get(key)
+			if group == None:
+				# Nothing else is like it so far, and there's no need to hash it yet
+				self.groups[key] = image
+				return None
+		finally:
+			self.lock.release()
+		# Hashed without holding the lock, so the images checked by other threads are hashed meanwhile
+		first = None
+		if not isinstance(group,dict):
+			# The first image of the group is only hashed once a second one shows up
+			first = (self.GetHash(group.path),group)
+		digest = self.GetHash(image.path,stat)
+		self.lock.acquire()
+		try:
+			group = self.groups[key]
+			if not isinstance(group,dict):
+				group = self.groups[key] = dict([first])
+			elif first != None:
+				# Another thread got there first, and may have added images since
+				group.setdefault(*first)
+			original = group.get(digest)
+			if original == None or original.path == image.path:
+				# The same file can be checked again, when it's found a second time
+				group[digest] = image
+				return None
+			return original
+		finally:
+			self.lock.release()
+
+	## @brief Tells whether the files at @a path and @a other have the same contents
+	#
+	#  @details They're only hashed when they have the same size.
+	#
+	def SameContent(self,path,other):
+		stat = os.stat(path)
+		other_stat = os.stat(other)
+		if stat.st_size != other_stat.st_size:
+			return False
+		if (stat.st_dev,stat.st_ino) == (other_stat.st_dev,other_stat.st_ino):
+			return True
+		return self.GetHash(path,stat) == self.GetHash(other,other_stat)
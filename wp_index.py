@@ -0,0 +1,318 @@
+## @file wp_index.py
+#  @brief Persistent index of the metadata of the images already seen
+#
+#  @details Every file probed is stored in a small SQLite database, along with the identity of the
+#  file (its size, modification time and inode) at the moment it was probed. On the next run, a file
+#  whose identity hasn't changed is taken from the index instead of being read again, so re-sorting an
+#  already sorted collection only costs a @c stat() per file.
+#
+#  The index can be shared by several threads: the database is only accessed while holding a lock, but
+#  the files themselves are read outside of it.
+#
+
+## @var NOT_AN_IMAGE
+#  @brief Size stored in the index for files that are not images
+#
+#  @details We keep track of them too, otherwise they would be handed to PIL on every single run.
+#
+NOT_AN_IMAGE = (0,0)
+
+## @var COMMIT_EVERY
+#  @brief Number of changes made to the index before they're committed to disk
+#
+COMMIT_EVERY = 1000
+
+## @var HASH_TABLES
+#  @brief Table holding each kind of hash: of the contents of the files, and perceptual (see wp_similar.py)
+#
+HASH_TABLES = {'content' : 'hashes','perceptual' : 'perceptual_hashes'}
+
+## @var QUERY_COLUMNS
+#  @brief Columns of the index the queries of wp_query.py can have conditions on, each one indexed
+#
+QUERY_COLUMNS = ('width','height','ratio')
+
+## @var WALLPAPER
+#  @brief Condition of the rows of wallpapers: like when scanning, the images of at least 640x480
+#
+WALLPAPER = 'width >= 640 AND height >= 480'
+
+## @class MetadataIndex
+#
+#  @brief SQLite database holding the dimensions, ratio and destination of every image probed
+#
+#  @details The rows are keyed on the absolute path of the file, and are only trusted when the
+#  @c (size,mtime,inode) stored matches the current @c stat() of the file. Otherwise the row is
+#  dropped, and the file probed again.
+class MetadataIndex(object):
+	connection = None
+	pending = 0
+	lock = None
+
+	## @brief Opens (or creates) the index stored at @a filename
+	#
+	#  @param filename the path of the SQLite database
+	#
+	def __init__(self,filename):
+		import sqlite3
+		import threading
+		import os
+		self.lock = threading.RLock()
+		self.filename = os.path.abspath(filename)
+		self.connection = sqlite3.connect(self.filename,check_same_thread = False)
+		self.connection.text_factory = str
+		self.connection.create_function('dirname',1,os.path.dirname)
+		self.connection.execute('CREATE TABLE IF NOT EXISTS files ('
+			'path TEXT PRIMARY KEY, size INTEGER, mtime REAL, inode INTEGER, '
+			'width INTEGER, height INTEGER, ratio REAL, destination TEXT)')
+		# So the ranges of a query are looked up instead of going through every row
+		for column in QUERY_COLUMNS:
+			self.connection.execute('CREATE INDEX IF NOT EXISTS files_'+column+' ON files ('+column+')')
+		for table in HASH_TABLES.values():
+			self.connection.execute('CREATE TABLE IF NOT EXISTS '+table+' ('
+				'device INTEGER, inode INTEGER, size INTEGER, mtime REAL, digest TEXT, '
+				'PRIMARY KEY (device,inode))')
+		self.connection.commit()
+		self.pending = 0
+
+	def _Changed(self):
+		self.pending += 1
+		if self.pending >= COMMIT_EVERY:
+			self.Commit()
+
+	## @brief Gets the size of the image at @a path from the index
+	#
+	#  @param path the absolute path of the file
+	#  @param stat the result of @c os.stat() on @a path
+	#
+	#  @return the @c (width,height) stored for @a path
+	#
+	#  @retval None if @a path is not in the index, or it changed since it was stored. In the
+	#  latter case, the stale row is removed.
+	#  @retval NOT_AN_IMAGE if @a path is known not to be an image
+	#
+	def Lookup(self,path,stat):
+		self.lock.acquire()
+		try:
+			row = self.connection.execute('SELECT size,mtime,inode,width,height FROM files WHERE path = ?',(path,)).fetchone()
+			if row == None:
+				return None
+			if row[0] != stat.st_size or row[1] != stat.st_mtime or row[2] != stat.st_ino:
+				self.connection.execute('DELETE FROM files WHERE path = ?',(path,))
+				self._Changed()
+				return None
+			return (row[3],row[4])
+		finally:
+			self.lock.release()
+
+	## @brief Stores the @a size of the file at @a path, along with its identity
+	#
+	#  @param path the absolute path of the file
+	#  @param stat the result of @c os.stat() on @a path
+	#  @param size the @c (width,height) of the image, or @c NOT_AN_IMAGE
+	#
+	def Store(self,path,stat,size):
+		try:
+			ratio = float(size[0])/size[1]
+		except ZeroDivisionError:
+			ratio = 0
+		self.lock.acquire()
+		try:
+			self.connection.execute('INSERT OR REPLACE INTO files (path,size,mtime,inode,width,height,ratio,destination) '
+				'VALUES (?,?,?,?,?,?,?,NULL)',(path,stat.st_size,stat.st_mtime,stat.st_ino,size[0],size[1],ratio))
+			self._Changed()
+		finally:
+			self.lock.release()
+
+	## @brief Drop-in replacement of ProbeDimensions() going through the index
+	#
+	#  @details The file is only read when it's not in the index or it changed since the last time.
+	#
+	#  @param path the path of the file
+	#
+	#  @return the @c (width,height) of the image
+	#
+	#  @retval None if the file is known not to be an image
+	#
+	#  @exception IOError the same as ProbeDimensions()
+	#
+	def Probe(self,path):
+		from wp_probe import ProbeDimensions
+		from wp_stats import STATS
+		import os
+		path = os.path.abspath(path)
+		stat = os.stat(path)
+		size = self.Lookup(path,stat)
+		if size == None:
+			STATS.Count('index_misses')
+			try:
+				size = ProbeDimensions(path)
+			except IOError,err:
+				# Not an image at all, as opposed to not being readable
+				if err.errno == None:
+					self.Store(path,stat,NOT_AN_IMAGE)
+				raise
+			self.Store(path,stat,size)
+		else:
+			STATS.Count('index_hits')
+			if size == NOT_AN_IMAGE:
+				return None
+		return size
+
+	## @brief Gets the @c WHERE clause of the wallpapers within the @a ranges, and its parameters
+	#
+	#  @param ranges a @c list of @c (field,low,high) tuples, as given by wp_query.ParseQuery()
+	#
+	def _Where(self,ranges):
+		conditions = [WALLPAPER]
+		parameters = []
+		for field,low,high in ranges:
+			if field not in QUERY_COLUMNS:
+				raise ValueError('MetadataIndex(): Not a column to query on, got '+str(field))
+			if low != None:
+				conditions.append(field+(low[1] and ' >= ?' or ' > ?'))
+				parameters.append(low[0])
+			if high != None:
+				conditions.append(field+(high[1] and ' <= ?' or ' < ?'))
+				parameters.append(high[0])
+		return (' WHERE '+' AND '.join(conditions),parameters)
+
+	def _Query(self,sql,ranges,suffix = '',limit = None):
+		where,parameters = self._Where(ranges)
+		if limit != None:
+			suffix += ' LIMIT ?'
+			parameters.append(limit)
+		self.lock.acquire()
+		try:
+			return self.connection.execute(sql+where+suffix,parameters).fetchall()
+		finally:
+			self.lock.release()
+
+	## @brief Gets the wallpapers in the index within the @a ranges, sorted by path
+	#
+	#  @param ranges a @c list of @c (field,low,high) tuples, as given by wp_query.ParseQuery()
+	#
+	#  @return a @c list of @c (path,width,height) tuples
+	#
+	def GetImages(self,ranges = ()):
+		return self._Query('SELECT path,width,height FROM files',ranges,' ORDER BY path')
+
+	## @brief Counts the wallpapers in the index within the @a ranges
+	def CountImages(self,ranges = ()):
+		return self._Query('SELECT COUNT(*) FROM files',ranges)[0][0]
+
+	## @brief Counts the wallpapers in the index within the @a ranges by resolution
+	#
+	#  @param top how many resolutions to get, if not all of them
+	#
+	#  @return a @c list of @c ((width,height),count) tuples, the biggest count first, and then by resolution
+	#
+	def CountResolutions(self,ranges = (),top = None):
+		rows = self._Query('SELECT width,height,COUNT(*) FROM files',ranges,
+			' GROUP BY width,height ORDER BY COUNT(*) DESC,width,height',top)
+		return [((width,height),count) for width,height,count in rows]
+
+	## @brief Counts the wallpapers in the index within the @a ranges by directory
+	#
+	#  @param top how many directories to get, if not all of them
+	#
+	#  @return a @c list of @c (directory,count) tuples, the biggest count first, and then by directory
+	#
+	def CountDirectories(self,ranges = (),top = None):
+		rows = self._Query('SELECT dirname(path),COUNT(*) FROM files',ranges,
+			' GROUP BY dirname(path) ORDER BY COUNT(*) DESC,dirname(path)',top)
+		return [(directory,count) for directory,count in rows]
+
+	## @brief Records where the image at @a path was relocated to
+	#
+	#  @param path the absolute path the image had when it was indexed
+	#  @param new_path the absolute path of the image after the relocation
+	#  @param moved @c True if the image was moved, @c False if it was copied. When moved, the row
+	#  follows the file to @a new_path, since a rename keeps its identity.
+	#
+	def Relocated(self,path,new_path,moved = True):
+		import os
+		destination = os.path.split(new_path)[0]
+		self.lock.acquire()
+		try:
+			if moved:
+				self.connection.execute('DELETE FROM files WHERE path = ?',(new_path,))
+				self.connection.execute('UPDATE files SET path = ?, destination = ? WHERE path = ?',(new_path,destination,path))
+			else:
+				self.connection.execute('UPDATE files SET destination = ? WHERE path = ?',(destination,path))
+			self._Changed()
+		finally:
+			self.lock.release()
+
+	## @brief Gets the hash of the file with the given @a stat
+	#
+	#  @details Hashes are keyed on the device and inode of the file, so they follow it when it's
+	#  renamed, and are only trusted if its size and modification time didn't change.
+	#
+	#  @param stat the result of @c os.stat() on the file
+	#  @param kind the kind of hash, one of @c HASH_TABLES
+	#
+	#  @retval None if the hash of the file is not known
+	#
+	def LookupHash(self,stat,kind = 'content'):
+		self.lock.acquire()
+		try:
+			row = self.connection.execute('SELECT size,mtime,digest FROM '+HASH_TABLES[kind]+' WHERE device = ? AND inode = ?',
+				(stat.st_dev,stat.st_ino)).fetchone()
+			if row == None or row[0] != stat.st_size or row[1] != stat.st_mtime:
+				return None
+			return row[2]
+		finally:
+			self.lock.release()
+
+	## @brief Stores the hash @a digest, of the kind @a kind, of the file with the given @a stat
+	def StoreHash(self,stat,digest,kind = 'content'):
+		self.lock.acquire()
+		try:
+			self.connection.execute('INSERT OR REPLACE INTO '+HASH_TABLES[kind]+' (device,inode,size,mtime,digest) VALUES (?,?,?,?,?)',
+				(stat.st_dev,stat.st_ino,stat.st_size,stat.st_mtime,digest))
+			self._Changed()
+		finally:
+			self.lock.release()
+
+	## @brief Removes the rows of the files that no longer exist, and the hashes of the files no longer indexed
+	#
+	#  @return the number of rows removed
+	#
+	def Prune(self):
+		import os
+		self.lock.acquire()
+		try:
+			gone = []
+			# The hashes are kept only for the files still indexed, by the identity they're keyed on
+			kept = set()
+			for (path,) in self.connection.execute('SELECT path FROM files').fetchall():
+				try:
+					stat = os.stat(path)
+					kept.add((stat.st_dev,stat.st_ino))
+				except OSError:
+					if not os.path.lexists(path):
+						gone.append((path,))
+			self.connection.executemany('DELETE FROM files WHERE path = ?',gone)
+			for table in HASH_TABLES.values():
+				stale = [identity for identity in self.connection.execute('SELECT device,inode FROM '+table).fetchall()
+					if identity not in kept]
+				self.connection.executemany('DELETE FROM '+table+' WHERE device = ? AND inode = ?',stale)
+			self.Commit()
+		finally:
+			self.lock.release()
+		return len(gone)
+
+	def Commit(self):
+		self.lock.acquire()
+		try:
+			self.connection.commit()
+			self.pending = 0
+		finally:
+			self.lock.release()
+
+	def Close(self):
+		if self.connection != None:
+			self.Commit()
+			self.connection.close()
+			self.connection = None
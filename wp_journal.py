@@ -0,0 +1,386 @@
+## @file wp_journal.py
+#  @brief Write-ahead journal of the relocations of each run, to resume an interrupted run or undo one
+#
+#  @details The journal is a text file, with a JSON record per line, only ever appended to. Every
+#  relocation is recorded before it's done, and marked as done right after, so if the run is killed
+#  halfway, the journal tells exactly which relocations were left. Along with --plan, the whole plan is
+#  recorded before the first image is moved, so an interrupted run can be finished without scanning
+#  the TARGETs again.
+#
+#  The records are handed to the system as they're written, which is enough to survive the process being
+#  killed. They're only forced to disk (@c fsync()) every @c FSYNC_EVERY records or @c FSYNC_INTERVAL
+#  seconds, since doing it after each one would cost more than the relocations themselves.
+#
+#  The records are:
+#  - @c {"op":"begin","run":RUN,"time":TIME}
+#  - @c {"op":"move","run":RUN,"source":PATH,"target":PATH,"mode":MODE,"link":LINK,"overwrite":BOOL,
+#  "same_content":SAME}, with @c MODE one of @c JOURNAL_MODES, @c LINK the kind of link (@c hard or
+#  @c reflink) when @c MODE is @c link, @c BOOL whether an existing @c TARGET is overwritten, and @c SAME
+#  what's done when @c TARGET already holds the same contents: @c remove the source, @c keep it, or
+#  @c null if that's not checked. Resume() takes the same decisions the run would have.
+#  - @c {"op":"done","run":RUN,"source":PATH}
+#  - @c {"op":"cancel","run":RUN,"source":PATH}, if it turned out there was nothing to do
+#  - @c {"op":"dedup-remove","run":RUN,"source":PATH,"target":PATH}, before removing a file since
+#  @c TARGET already holds the same contents. It's undone by copying @c TARGET back.
+#  - @c {"op":"overwrite","run":RUN,"target":PATH,"backup":PATH}, before moving a file about to be
+#  overwritten to @c BACKUP, in @c FILE.backup/RUN/ next to the journal. It's undone by moving it back,
+#  once the relocations are reversed. Until then, the backups are kept.
+#  - @c {"op":"end","run":RUN}
+#  - @c {"op":"undo","run":RUN}, once the run has been undone
+#
+#  Paths are byte strings, which JSON can't hold as they are: they're stored as if they were Latin-1 text,
+#  which gives back the exact same bytes, whatever the encoding of the filesystem.
+#
+
+import os
+import time
+import json
+import filecmp
+import threading
+from wp_stats import STATS
+from wp_transfer import SameFile
+
+## @var JOURNAL_MODES
+#  @brief How an image can be relocated: moved, copied, or linked (to its original, or to another file)
+#
+JOURNAL_MODES = ('move','copy','link')
+
+## @var FSYNC_EVERY
+#  @brief Number of records written before the journal is forced to disk
+#
+FSYNC_EVERY = 256
+
+## @var FSYNC_INTERVAL
+#  @brief Seconds after which the records written are forced to disk, however few they are
+#
+FSYNC_INTERVAL = 1.0
+
+## @class JournalRun
+#
+#  @brief What the journal says about a run
+class JournalRun(object):
+
+	def __init__(self,run):
+		self.run = run
+		# The relocations by source, in the order they were recorded:
+		# [source,target,mode,done,link,overwrite,same_content]
+		self.moves = []
+		self.sources = {}
+		# The files moved out of the way of a relocation, as (target,backup)
+		self.backups = []
+		self.ended = False
+		self.undone = False
+
+	## @brief Gets the relocations not marked as done
+	def GetPending(self):
+		return [move for move in self.moves if not move[3]]
+
+	## @brief Gets the relocations marked as done
+	def GetDone(self):
+		return [move for move in self.moves if move[3]]
+
+## @brief Reads the journal at @a filename
+#
+#  @details A record cut short by a crash, which can only be the last one, is ignored.
+#
+#  @return a @c list of @c JournalRun, in the order they were started
+#
+def ReadJournal(filename):
+	runs = []
+	by_id = {}
+	if not os.path.exists(filename):
+		return runs
+	handle = open(filename,'r')
+	try:
+		for line in handle:
+			try:
+				record = json.loads(line)
+			except ValueError:
+				continue
+			run = by_id.get(record.get('run'))
+			if record['op'] == 'begin':
+				run = by_id[record['run']] = JournalRun(record['run'])
+				runs.append(run)
+			elif run == None:
+				continue
+			elif record['op'] in ('move','dedup-remove'):
+				move = run.sources.pop(record['source'].encode('latin-1'),None)
+				if move != None:
+					run.moves.remove(move)
+				if record['op'] == 'move':
+					move = [record['source'].encode('latin-1'),record['target'].encode('latin-1'),record['mode'],False,
+						record.get('link','hard'),record.get('overwrite',True),record.get('same_content')]
+				else:
+					# Done as soon as it's recorded: undoing it when the file is still there changes nothing
+					move = [record['source'].encode('latin-1'),record['target'].encode('latin-1'),'dedup-remove',True,None,
+						True,None]
+				run.sources[move[0]] = move
+				run.moves.append(move)
+			elif record['op'] == 'overwrite':
+				run.backups.append((record['target'].encode('latin-1'),record['backup'].encode('latin-1')))
+			elif record['op'] == 'done':
+				move = run.sources.get(record['source'].encode('latin-1'))
+				if move != None:
+					move[3] = True
+			elif record['op'] == 'cancel':
+				move = run.sources.pop(record['source'].encode('latin-1'),None)
+				if move != None:
+					run.moves.remove(move)
+			elif record['op'] == 'end':
+				run.ended = True
+			elif record['op'] == 'undo':
+				run.undone = True
+	finally:
+		handle.close()
+	return runs
+
+## @class MoveJournal
+#
+#  @brief The journal of the current run
+#
+#  @details It can be shared by several threads.
+class MoveJournal(object):
+
+	## @brief Opens the journal at @a filename, and records the beginning of a run
+	def __init__(self,filename):
+		self.filename = os.path.abspath(filename)
+		self.lock = threading.Lock()
+		self.handle = open(self.filename,'a')
+		self.pending = 0
+		self.synced = time.time()
+		self.run = time.strftime('%Y%m%d-%H%M%S')+'-'+str(os.getpid())
+		self.backups = 0
+		self._Write({'op' : 'begin','run' : self.run,'time' : time.time()})
+
+	def _Write(self,record):
+		self.lock.acquire()
+		try:
+			self.handle.write(json.dumps(record)+'\n')
+			# Handed to the system right away, so it survives the process; forced to disk now and then
+			self.handle.flush()
+			self.pending += 1
+			STATS.Count('journal_records')
+			if self.pending >= FSYNC_EVERY or time.time()-self.synced >= FSYNC_INTERVAL:
+				self._Sync()
+		finally:
+			self.lock.release()
+
+	def _Sync(self):
+		os.fsync(self.handle.fileno())
+		self.pending = 0
+		self.synced = time.time()
+		STATS.Count('journal_syncs')
+
+	## @brief Records that the file at @a source is about to be relocated to @a target
+	#
+	#  @param mode how it's relocated, one of @c JOURNAL_MODES
+	#  @param link the kind of link, @c 'hard' or @c 'reflink', when @a mode is @c 'link'
+	#  @param overwrite whether @a target is overwritten if it exists
+	#  @param same_content what's done if @a target holds the same contents: @c 'remove' the source,
+	#  @c 'keep' it, or @c None if that's not checked
+	#
+	def Intent(self,source,target,mode = 'move',link = 'hard',overwrite = True,same_content = None):
+		record = {'op' : 'move','run' : self.run,'source' : source.decode('latin-1'),'target' : target.decode('latin-1'),'mode' : mode,
+			'overwrite' : bool(overwrite),'same_content' : same_content}
+		if mode == 'link':
+			record['link'] = link
+		self._Write(record)
+
+	## @brief Records that the file at @a source is about to be removed, since @a target holds the same contents
+	def DedupRemove(self,source,target):
+		self._Write({'op' : 'dedup-remove','run' : self.run,'source' : source.decode('latin-1'),'target' : target.decode('latin-1')})
+
+	## @brief Moves the file at @a target out of the way, since a relocation is about to overwrite it
+	#
+	#  @details It's kept in @c FILE.backup/RUN/, next to the journal, so Undo() can put it back.
+	#
+	#  @exception IOError, OSError if it can't be moved
+	#
+	def Backup(self,target):
+		from wp_transfer import MoveFile
+		directory = os.path.join(self.filename+'.backup',self.run)
+		self.lock.acquire()
+		try:
+			self.backups += 1
+			backup = os.path.join(directory,str(self.backups)+'-'+os.path.basename(target))
+			if not os.path.isdir(directory):
+				os.makedirs(directory)
+		finally:
+			self.lock.release()
+		self._Write({'op' : 'overwrite','run' : self.run,'target' : target.decode('latin-1'),'backup' : backup.decode('latin-1')})
+		MoveFile(target,backup)
+
+	## @brief Records that the relocation of the file at @a source is done
+	def Done(self,source):
+		self._Write({'op' : 'done','run' : self.run,'source' : source.decode('latin-1')})
+
+	## @brief Records that the file at @a source was not relocated after all
+	def Cancel(self,source):
+		self._Write({'op' : 'cancel','run' : self.run,'source' : source.decode('latin-1')})
+
+	## @brief Records that the run @a run was undone
+	def Undone(self,run):
+		self._Write({'op' : 'undo','run' : run})
+
+	## @brief Records the end of the run, and closes the journal
+	def Close(self):
+		if self.handle == None:
+			return
+		self._Write({'op' : 'end','run' : self.run})
+		self.lock.acquire()
+		try:
+			self._Sync()
+			self.handle.close()
+			self.handle = None
+		finally:
+			self.lock.release()
+
+## @brief Relocates the file at @a source to @a target, the way @a mode says
+#
+#  @exception IOError, OSError if it can't be done
+#
+#  @param link the kind of link, when @a mode is @c 'link'
+#
+def Replay(source,target,mode,link = 'hard'):
+	from wp_transfer import CopyFile, LinkFile, MoveFile
+	directory = os.path.dirname(target)
+	if not os.path.isdir(directory):
+		os.makedirs(directory)
+	if mode == 'copy':
+		CopyFile(source,target)
+	elif mode == 'link':
+		LinkFile(source,target,link)
+	else:
+		MoveFile(source,target)
+
+## @brief Finishes the relocations left by the last run, if it was interrupted
+#
+#  @details A relocation is done again when its source is still there, since a copy could have been cut
+#  short. Otherwise, if the target exists, it was done but not marked as done.
+#
+#  A target that exists already is dealt with as the run would have: left alone when it holds the same
+#  contents or it's not to be overwritten, and moved out of the way (see MoveJournal.Backup()) otherwise.
+#
+#  @param journal the @c MoveJournal of the current run, where the relocations are recorded again
+#  @param report a function called with a message for each relocation
+#
+#  @return the number of relocations finished
+#
+def Resume(journal,report = None):
+	runs = [run for run in ReadJournal(journal.filename) if run.run != journal.run]
+	if not runs or runs[-1].ended:
+		return 0
+	finished = 0
+	pending = runs[-1].GetPending()
+	# Recorded all at once first, so they're not lost if this is interrupted as well
+	for source,target,mode,done,link,overwrite,same_content in pending:
+		journal.Intent(source,target,mode,link,overwrite,same_content)
+	for source,target,mode,done,link,overwrite,same_content in pending:
+		if os.path.lexists(source):
+			try:
+				if os.path.lexists(target) and not SameFile(source,target):
+					if same_content != None and filecmp.cmp(source,target,False):
+						if same_content == 'remove' and mode == 'move':
+							journal.DedupRemove(source,target)
+							os.remove(source)
+						else:
+							journal.Cancel(source)
+						if report != None:
+							report(source+' is already in '+os.path.dirname(target))
+						continue
+					if not overwrite:
+						print 'Resume(): '+target+' exists already, leaving '+source+' where it is'
+						journal.Cancel(source)
+						continue
+					journal.Backup(target)
+				Replay(source,target,mode,link)
+			except EnvironmentError,err:
+				print 'Resume(): Error relocating '+source+':',err
+				continue
+			if report != None:
+				report('Relocating '+source+' to '+target)
+		elif not os.path.lexists(target):
+			print 'Resume(): '+source+' is gone'
+			journal.Cancel(source)
+			continue
+		journal.Done(source)
+		finished += 1
+	return finished
+
+## @brief Reverses every relocation of the last run not undone yet
+#
+#  @details Moved files are moved back, and copies and links are removed. Files removed since their
+#  destination held the same contents are copied back from it. The directories emptied are removed as well.
+#  Last, the files the run overwrote are moved back from their backups.
+#
+#  @param journal the @c MoveJournal of the current run
+#  @param report a function called with a message for each relocation reversed
+#
+#  @return the number of relocations reversed
+#
+#  @retval None if there's no run to undo
+#
+def Undo(journal,report = None):
+	from wp_transfer import MoveFile, CopyFile
+	runs = [run for run in ReadJournal(journal.filename) if run.run != journal.run and not run.undone and run.GetDone()]
+	if not runs:
+		return None
+	run = runs[-1]
+	reversed_count = 0
+	for source,target,mode,done,link,overwrite,same_content in reversed(run.GetDone()):
+		try:
+			if mode in ('move','dedup-remove'):
+				if os.path.lexists(source):
+					if mode == 'move':
+						print 'Undo(): '+source+' exists already, leaving '+target+' where it is'
+					continue
+				directory = os.path.dirname(source)
+				if not os.path.isdir(directory):
+					os.makedirs(directory)
+				if mode == 'move':
+					MoveFile(target,source)
+				else:
+					CopyFile(target,source)
+			else:
+				os.remove(target)
+		except EnvironmentError,err:
+			print 'Undo(): Error reversing '+target+':',err
+			continue
+		reversed_count += 1
+		if report != None:
+			report('Reversing '+target+' to '+source)
+		if mode == 'dedup-remove':
+			continue
+		# The directories created for the run are gone once they're empty again
+		directory = os.path.dirname(target)
+		while not source.startswith(directory+os.sep):
+			try:
+				os.rmdir(directory)
+			except OSError:
+				break
+			directory = os.path.dirname(directory)
+	# Only once the relocations are reversed, so the files that took their place are gone
+	for target,backup in reversed(run.backups):
+		if not os.path.lexists(backup):
+			continue
+		if os.path.lexists(target):
+			print 'Undo(): '+target+' exists already, leaving its backup in '+backup
+			continue
+		try:
+			directory = os.path.dirname(target)
+			if not os.path.isdir(directory):
+				os.makedirs(directory)
+			MoveFile(backup,target)
+		except EnvironmentError,err:
+			print 'Undo(): Error restoring '+target+':',err
+			continue
+		reversed_count += 1
+		if report != None:
+			report('Restoring '+target+' from '+backup)
+	if run.backups:
+		try:
+			os.rmdir(os.path.join(journal.filename+'.backup',run.run))
+		except OSError:
+			pass
+	journal.Undone(run.run)
+	return reversed_count
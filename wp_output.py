@@ -0,0 +1,333 @@
+## @file wp_output.py
+#  @brief Printing from a thread of its own, in batches, to the terminal and to a log file
+#
+#  @details Printing a line per image relocated means a write to the terminal per image, and a slow
+#  terminal (or one over SSH) holds the whole run back while it catches up. An @c Output takes the place
+#  of @c sys.stdout: what's printed is only added to a buffer, and a thread of its own writes it every
+#  @c FLUSH_INTERVAL seconds, all at once, so the run never waits for the terminal.
+#
+#  The messages about each image and directory (see PrintMsg() in sortpaper.py) can be left out of the
+#  terminal, and replaced by a progress line, redrawn at most every @c PROGRESS_INTERVAL seconds. Both
+#  the messages and everything else printed can be written to a log file as well, which is rotated once
+#  it grows too big.
+#
+#  The thread is only started by Start(), so the processes forked beforehand (see @c ThumbnailCache)
+#  don't inherit it halfway through a write. At most @c PENDING_LIMIT writes are kept waiting: past
+#  that, whoever prints waits for the thread to catch up, so a terminal that's stuck can't fill the memory.
+#
+
+import os
+import time
+import threading
+from collections import deque
+from wp_stats import STATS
+
+## @var FLUSH_INTERVAL
+#  @brief Seconds between two writes of what was printed
+#
+FLUSH_INTERVAL = 0.1
+
+## @var PENDING_LIMIT
+#  @brief Number of writes kept waiting for the thread, past which printing waits for it
+#
+PENDING_LIMIT = 16384
+
+## @var PROGRESS_INTERVAL
+#  @brief Seconds between two redraws of the progress line on a terminal
+#
+PROGRESS_INTERVAL = 0.5
+
+## @var PLAIN_PROGRESS_INTERVAL
+#  @brief Seconds between two progress lines when the output is not a terminal, and can't be redrawn
+#
+PLAIN_PROGRESS_INTERVAL = 10.0
+
+## @var RATE_WINDOW
+#  @brief Seconds the speed shown in the progress line is averaged over
+#
+RATE_WINDOW = 5.0
+
+## @var CLEAR_LINE
+#  @brief Goes back to the start of the line and clears it, on a terminal
+#
+CLEAR_LINE = '\r\x1b[K'
+
+## @brief Gets @a size, in bytes, the way a person would read it
+def FormatSize(size):
+	for unit in ('B','KiB','MiB','GiB'):
+		if size < 1024:
+			break
+		size /= 1024.0
+	else:
+		unit = 'TiB'
+	if unit == 'B':
+		return '%d B' % size
+	return '%.1f %s' % (size,unit)
+
+## @brief Gets @a seconds as @c H:MM:SS
+def FormatTime(seconds):
+	seconds = int(seconds)
+	return '%d:%02d:%02d' % (seconds//3600,seconds//60%60,seconds%60)
+
+## @class Progress
+#
+#  @brief What the run did so far, read from @c STATS
+#
+#  @details Nothing is counted here, so keeping track of the progress costs nothing to the run: the images
+#  are counted as they're classified, and the bytes as they're copied, by the counters already in @c STATS.
+class Progress(object):
+
+	## @param total the number of images the run will go through, if known
+	def __init__(self,total = None,stats = STATS):
+		self.total = total
+		self.stats = stats
+		# Counting from when it's made, so a short run still gets a speed
+		self.samples = deque([(time.time(),0)])
+
+	## @brief Gets the progress line, as of @a now
+	def Format(self,now = None):
+		if now == None:
+			now = time.time()
+		stats = self.stats
+		processed = stats.Total('classified')
+		relocated = stats.Get('files_renamed')+stats.Get('files_copied')+stats.Get('files_linked')
+		# The speed is that of the last few seconds, so it follows the run as it speeds up or slows down
+		samples = self.samples
+		samples.append((now,processed))
+		while len(samples) > 2 and samples[1][0] <= now-RATE_WINDOW:
+			samples.popleft()
+		elapsed = now-samples[0][0]
+		rate = 0.0
+		if elapsed > 0:
+			rate = (processed-samples[0][1])/elapsed
+		if self.total:
+			parts = ['%d/%d images (%d%%)' % (processed,self.total,100*processed//max(self.total,1))]
+		else:
+			parts = ['%d images' % processed]
+		parts.append('%.0f/s' % rate)
+		parts.append('%d relocated' % relocated)
+		parts.append(FormatSize(stats.Get('bytes_copied'))+' copied')
+		if self.total and rate > 0 and processed < self.total:
+			parts.append('ETA '+FormatTime((self.total-processed)/rate))
+		return ', '.join(parts)
+
+## @class RotatingLog
+#
+#  @brief A log file, renamed to @c FILE.1 (and the older ones to @c FILE.2 and so on) once it's too big
+class RotatingLog(object):
+
+	## @param filename the path of the log
+	#  @param limit the size, in bytes, past which it's rotated
+	#  @param count the number of old logs kept. With none, the log is emptied instead.
+	#
+	#  @exception IOError if it can't be opened
+	#
+	def __init__(self,filename,limit = 10 << 20,count = 3):
+		self.filename = filename
+		self.limit = limit
+		self.count = count
+		self.handle = open(filename,'a')
+		self.size = self.handle.tell()
+		self.line_start = True
+
+	def _Rotate(self):
+		self.handle.close()
+		for number in xrange(self.count-1,0,-1):
+			older = self.filename+'.'+str(number)
+			if os.path.exists(older):
+				os.rename(older,self.filename+'.'+str(number+1))
+		if self.count > 0:
+			os.rename(self.filename,self.filename+'.1')
+		self.handle = open(self.filename,'w')
+		self.size = 0
+
+	## @brief Writes @a text, each line of it starting with the time it's written at
+	def Write(self,text):
+		if self.size > 0 and self.size+len(text) > self.limit:
+			if not self.line_start:
+				# The line already started ends in this file, so none is split across two
+				end = text.find('\n')+1
+				if end == 0:
+					self._Write(text)
+					return
+				self._Write(text[:end])
+				text = text[end:]
+				if not text:
+					return
+			self._Rotate()
+		self._Write(text)
+
+	def _Write(self,text):
+		if not text:
+			return
+		stamp = time.strftime('%Y-%m-%d %H:%M:%S ')
+		lines = []
+		for line in text.splitlines(True):
+			if self.line_start:
+				lines.append(stamp)
+			lines.append(line)
+			self.line_start = line.endswith('\n')
+		text = ''.join(lines)
+		self.handle.write(text)
+		self.handle.flush()
+		self.size += len(text)
+
+	def Close(self):
+		self.handle.close()
+
+## @class Output
+#
+#  @brief Stands for @c sys.stdout, writing what's printed from a thread of its own
+#
+#  @details It can be shared by several threads: each @c write() is kept whole, and Message() keeps a
+#  whole line.
+class Output(object):
+
+	## @param stream where to print, usually @c sys.stdout
+	#  @param messages whether the messages given to Message() are printed, or only logged
+	#  @param log a @c RotatingLog to write everything to as well, if any
+	#  @param progress a @c Progress to show along with what's printed, if any
+	#
+	def __init__(self,stream,messages = True,log = None,progress = None):
+		self.stream = stream
+		self.messages = messages
+		self.log = log
+		self.progress = progress
+		self.encoding = getattr(stream,'encoding',None)
+		self.softspace = 0
+		try:
+			self.terminal = stream.isatty()
+		except AttributeError:
+			self.terminal = False
+		self.lock = threading.Lock()
+		self.drained = threading.Condition(self.lock)
+		self.pending = []
+		self.line = None
+		self.next_progress = 0.0
+		self.wake = threading.Event()
+		self.closing = threading.Event()
+		self.closed = False
+		self.thread = None
+
+	## @brief Starts the thread writing what's printed
+	#
+	#  @details Until then, it's only kept. No process should be forked afterwards.
+	#
+	def Start(self):
+		if self.thread != None or self.closed:
+			return
+		self.thread = threading.Thread(target = self._Run)
+		# Closed by whoever made it, but a run that's interrupted must not wait for it
+		self.thread.daemon = True
+		self.thread.start()
+
+	def _Add(self,text,shown):
+		self.lock.acquire()
+		try:
+			while len(self.pending) >= PENDING_LIMIT and self.thread != None and not self.closing.is_set():
+				self.wake.set()
+				self.drained.wait()
+			self.pending.append((text,shown))
+		finally:
+			self.lock.release()
+
+	## @brief Prints @a text, as @c sys.stdout would
+	def write(self,text):
+		if isinstance(text,unicode):
+			text = text.encode(self.encoding or 'utf-8','replace')
+		self._Add(text,True)
+
+	def writelines(self,lines):
+		for line in lines:
+			self.write(line)
+
+	## @brief Does nothing: what's printed is written in the background anyway
+	def flush(self):
+		pass
+
+	def isatty(self):
+		return self.terminal
+
+	## @brief Prints the line @a msg, unless the messages are only logged
+	def Message(self,msg):
+		if not self.messages and self.log == None:
+			return
+		if isinstance(msg,unicode):
+			msg = msg.encode(self.encoding or 'utf-8','replace')
+		self._Add(msg+'\n',self.messages)
+
+	def _Run(self):
+		while True:
+			# Woken up early when the writes waiting reach PENDING_LIMIT
+			self.wake.wait(FLUSH_INTERVAL)
+			self.wake.clear()
+			final = self.closing.is_set()
+			self._Flush(final)
+			if final:
+				break
+
+	def _Flush(self,final = False):
+		self.lock.acquire()
+		try:
+			pending,self.pending = self.pending,[]
+			self.drained.notify_all()
+		finally:
+			self.lock.release()
+		if self.log != None and pending:
+			try:
+				self.log.Write(''.join(text for text,shown in pending))
+			except (IOError,OSError):
+				# Losing the log is no reason to stop the run
+				pass
+		shown = ''.join(text for text,shown in pending if shown)
+		now = time.time()
+		line = None
+		if self.progress != None and (final or now >= self.next_progress):
+			line = self.progress.Format(now)
+			if self.terminal:
+				self.next_progress = now+PROGRESS_INTERVAL
+			else:
+				self.next_progress = now+PLAIN_PROGRESS_INTERVAL
+		if self.terminal and self.progress != None:
+			if not shown and line == None:
+				return
+			if line != None:
+				self.line = line
+			text = CLEAR_LINE+shown+self.line
+			if final:
+				text += '\n'
+		else:
+			text = shown
+			if line != None:
+				text += line+'\n'
+		if not text:
+			return
+		try:
+			self.stream.write(text)
+			self.stream.flush()
+		except (IOError,OSError):
+			# The terminal went away, but the run goes on
+			pass
+
+	## @brief Writes whatever is left to print, along with the last progress line, and stops the thread
+	#
+	#  @details It can be called more than once; @c sys.stdout should be put back first.
+	#
+	def Close(self):
+		if self.closed:
+			return
+		self.closed = True
+		self.lock.acquire()
+		try:
+			self.closing.set()
+			# Nobody waits for the thread anymore: whatever is printed from now on is written below
+			self.drained.notify_all()
+		finally:
+			self.lock.release()
+		self.wake.set()
+		if self.thread != None:
+			self.thread.join()
+		else:
+			self._Flush(True)
+		if self.log != None:
+			self.log.Close()
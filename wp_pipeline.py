@@ -0,0 +1,158 @@
+## @file wp_pipeline.py
+#  @brief Pipeline of stages, each one with its own pool of threads, handing items to the next one
+#
+#  @details On a network filesystem, every @c listdir(), @c open() or @c rename() is a round trip to the
+#  server, and doing them one after another means waiting for each of them in turn. A @c Pipeline
+#  splits the work in stages (listing, probing, classifying, relocating), and gives each one as many
+#  threads as it needs, so hundreds of calls can be waiting for the server at the same time, while the
+#  cheap stages keep a single thread. The blocking calls release the GIL, so the threads do run at the
+#  same time.
+#
+#  The queues between the stages are bounded: when a stage falls behind, the one before it waits,
+#  instead of piling up every item in memory.
+#
+
+import time
+import Queue
+import threading
+from wp_stats import STATS
+
+## @var FINISHED
+#  @brief Item telling a worker there's nothing else to do
+#
+FINISHED = object()
+
+## @class Stage
+#
+#  @brief A step of a @c Pipeline, run by a pool of threads
+#
+#  @details Each item put in the stage is handed to @a function, as @c function(item,emit), where
+#  @c emit() puts an item in the next stage. It can be called any number of times, so an item can be
+#  turned into several items, or dropped. The stage is finished once the previous one is, and every
+#  item put in it has been handled.
+class Stage(object):
+
+	## @param name the name of the stage, used for its timer in @c STATS
+	#  @param function the function handling each item
+	#  @param workers the number of threads running @a function
+	#  @param queue_size how many items can be waiting in the stage; 0 for no limit
+	def __init__(self,name,function,workers = 1,queue_size = 0):
+		self.name = name
+		self.function = function
+		self.workers = workers
+		self.queue = Queue.Queue(queue_size)
+		self.next = None
+		self.lock = threading.Lock()
+		self.pending = 0
+		self.closed = False
+		self.finished = False
+		self.threads = []
+
+	## @brief Puts @a item in the stage, waiting for room if the queue is full
+	#
+	#  @details Items can be put by the stage itself (a directory listing its subdirectories, for
+	#  instance), as long as its queue has no limit: otherwise every worker could end up waiting for
+	#  room in its own queue.
+	#
+	def Put(self,item):
+		self.lock.acquire()
+		try:
+			# Counted before it's queued, so the stage can't be found finished in the meantime
+			self.pending += 1
+		finally:
+			self.lock.release()
+		self.queue.put(item)
+
+	## @brief Tells the stage nothing else will come from the previous one
+	def Close(self):
+		self.lock.acquire()
+		try:
+			self.closed = True
+			finished = self._Finishing()
+		finally:
+			self.lock.release()
+		if finished:
+			self._Finish()
+
+	def _Finishing(self):
+		if self.closed and self.pending == 0 and not self.finished:
+			self.finished = True
+			return True
+		return False
+
+	def _Finish(self):
+		for number in xrange(self.workers):
+			self.queue.put(FINISHED)
+		if self.next != None:
+			self.next.Close()
+
+	def _Emit(self,item):
+		if self.next != None:
+			self.next.Put(item)
+
+	def _Work(self):
+		import traceback
+		while True:
+			item = self.queue.get()
+			if item is FINISHED:
+				return
+			start = time.time()
+			try:
+				self.function(item,self._Emit)
+			except Exception:
+				print 'Pipeline: error in stage '+self.name+':'
+				traceback.print_exc()
+			STATS.AddTime('Pipeline.'+self.name,time.time()-start)
+			self.lock.acquire()
+			try:
+				self.pending -= 1
+				finished = self._Finishing()
+			finally:
+				self.lock.release()
+			if finished:
+				self._Finish()
+
+	def Start(self):
+		for number in xrange(self.workers):
+			thread = threading.Thread(target = self._Work,name = self.name+'-'+str(number))
+			thread.daemon = True
+			self.threads.append(thread)
+			thread.start()
+
+	def Join(self):
+		for thread in self.threads:
+			# With a timeout, so Ctrl+C still gets through
+			while thread.is_alive():
+				thread.join(0.5)
+		self.threads = []
+
+## @class Pipeline
+#
+#  @brief A chain of @c Stage objects, each one feeding the next
+class Pipeline(object):
+
+	def __init__(self):
+		self.stages = []
+
+	## @brief Adds a stage at the end of the pipeline
+	#
+	#  @details See @c Stage for the parameters.
+	#
+	#  @return the @c Stage added
+	#
+	def AddStage(self,name,function,workers = 1,queue_size = 0):
+		stage = Stage(name,function,workers,queue_size)
+		if self.stages:
+			self.stages[-1].next = stage
+		self.stages.append(stage)
+		return stage
+
+	## @brief Puts each of @a items in the first stage, and waits for every stage to finish
+	def Run(self,items):
+		for stage in self.stages:
+			stage.Start()
+		for item in items:
+			self.stages[0].Put(item)
+		self.stages[0].Close()
+		for stage in self.stages:
+			stage.Join()
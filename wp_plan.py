@@ -0,0 +1,223 @@
+## @file wp_plan.py
+#  @brief Relocation of the images in two phases: planning first, and then moving
+#
+#  @details Relocating images one at a time means checking, for every single image, that each
+#  directory of its destination exists, and that the destination is an existing directory, different
+#  from the one the image is in. A @c MovePlan is built with every relocation of the run instead, so
+#  the distinct destinations are known beforehand: they're created once, and then each image is moved
+#  with a single @c rename(), or copied by a pool of threads when it's going to another device.
+#
+
+import os
+from wp_stats import Timed
+
+## @class MovePlan
+#
+#  @brief The list of relocations of a run, and the destination directories they need
+class MovePlan(object):
+
+	def __init__(self):
+		self.moves = []
+		self.directories = set()
+
+	def __len__(self):
+		return len(self.moves)
+
+	## @brief Adds the relocation of @a image to @a destination to the plan
+	#
+	#  @details The filesystem is not touched: @a destination is expected to be an absolute, normalized
+	#  path, such as the ones built by BuildDirTree() or @c os.path.join()
+	#
+	#  @param image the @c ImageFile to relocate
+	#  @param destination the directory to relocate @a image to
+	#  @param link_to an @c ImageFile with the same contents as @a image. If given, @a image is
+	#  hard linked to it in @a destination, instead of being moved or copied there.
+	#
+	#  @retval True if the relocation was added
+	#  @retval False if @a image is already in @a destination
+	#
+	def Add(self,image,destination,link_to = None):
+		if destination == image.dir_path:
+			return False
+		self.moves.append((image,destination,link_to))
+		self.directories.add(destination)
+		return True
+
+	## @brief Changes the destination of some images of the plan
+	#
+	#  @param destinations a @c dict with the new destination of each @c ImageFile, or @c None to leave
+	#  it where it is. Images not in the plan yet are added to it.
+	#
+	def Redirect(self,destinations):
+		destinations = dict(destinations)
+		moves = []
+		for image,destination,link_to in self.moves:
+			if image in destinations:
+				destination = destinations.pop(image)
+				if destination == None or destination == image.dir_path:
+					continue
+			moves.append((image,destination,link_to))
+		self.moves = moves
+		self.directories = set(destination for image,destination,link_to in moves)
+		for image,destination in destinations.iteritems():
+			if destination != None:
+				self.Add(image,destination)
+
+	## @brief Creates the destination directories of the plan that don't exist yet
+	#
+	#  @details The directories are created in order, so the parents of a directory are always known
+	#  to exist by the time it's created, and each one costs a single @c mkdir().
+	#
+	def CreateDirectories(self):
+		import errno
+		created = set()
+		for directory in sorted(self.directories):
+			try:
+				if os.path.split(directory)[0] in created:
+					os.mkdir(directory)
+				else:
+					os.makedirs(directory)
+			except OSError,err:
+				if err.errno != errno.EEXIST:
+					raise
+			created.add(directory)
+
+	## @brief Relocates every image of the plan
+	#
+	#  @details The destinations must exist already, see CreateDirectories(). Images moved within the
+	#  same device are renamed right away; the rest (moves to another device, and copies) are handed to
+	#  a @c TransferPool of @a jobs threads, when there's more than one.
+	#
+	#  @param copy whether to copy the images instead of moving them
+	#  @param overwrite whether to overwrite the files already in the destination
+	#  @param done a function called as @c done(image,previous_path) after each image is relocated.
+	#  It's called by one thread at a time.
+	#  @param link when copying, link the images instead (@c 'hard' or @c 'reflink'), if possible
+	#  @param jobs how many copies can run at the same time
+	#  @param same_content a function telling whether two files have the same contents, such as
+	#  DuplicateFinder.SameContent(). If given, an image whose destination already holds the same
+	#  contents is not transferred again: it's only removed, if @a remove_same and @a overwrite are set and
+	#  it's not being copied, or left where it is otherwise.
+	#  @param journal the @c MoveJournal to record the relocations in, if any. The whole plan is recorded
+	#  before anything is relocated.
+	#  @param remove_same whether to remove the images whose destination already holds the same contents
+	#  @param same a function called as @c same(image,destination_file) for each of those images, if any
+	#
+	#  @return the number of images relocated
+	#
+	@Timed('MovePlan.Execute')
+	def Execute(self,copy = False,overwrite = True,done = None,link = None,jobs = 1,same_content = None,journal = None,
+		remove_same = True,same = None):
+		import threading
+		from wp_transfer import CopyFile, LinkFile, MoveFile, SameDevice, TransferPool
+		lock = threading.Lock()
+		relocated = [0]
+		pool = None
+		if jobs > 1:
+			pool = TransferPool(jobs)
+		if journal != None:
+			# What's done when the destination holds the same contents, so a resumed run does the same
+			if same_content == None:
+				same_action = None
+			elif not copy and remove_same and overwrite:
+				same_action = 'remove'
+			else:
+				same_action = 'keep'
+			for image,destination,link_to in self.moves:
+				kind = 'hard'
+				if copy and (link != None or link_to != None):
+					mode = 'link'
+					if link_to == None:
+						kind = link
+				elif copy:
+					mode = 'copy'
+				else:
+					mode = 'move'
+				journal.Intent(image.path,os.path.join(destination,image.filename),mode,kind,overwrite,same_action)
+		def Finished(image,prev_path,dest_file,result,err):
+			lock.acquire()
+			try:
+				if err != None:
+					print 'MovePlan.Execute(): Error moving/copying '+prev_path+':',getattr(err,'strerror',None) or err
+					if journal != None:
+						journal.Cancel(prev_path)
+					return
+				image.path = dest_file
+				relocated[0] += 1
+				if journal != None:
+					journal.Done(prev_path)
+				if done != None:
+					done(image,prev_path)
+			finally:
+				lock.release()
+		def Relocate(image,destination,link_to,pooling):
+			dest_file = os.path.join(destination,image.filename)
+			if (not overwrite or same_content != None) and os.path.lexists(dest_file):
+				if same_content != None and same_content(image.path,dest_file):
+					if same != None:
+						same(image,dest_file)
+					if not copy and remove_same and overwrite:
+						if journal != None:
+							journal.DedupRemove(image.path,dest_file)
+						os.remove(image.path)
+						image.path = dest_file
+					elif journal != None:
+						journal.Cancel(image.path)
+					return
+				if not overwrite:
+					if journal != None:
+						journal.Cancel(image.path)
+					return
+			prev_path = image.path
+			if os.path.lexists(dest_file):
+				if os.path.abspath(dest_file) == os.path.abspath(prev_path):
+					if journal != None:
+						journal.Cancel(prev_path)
+					return
+				# Like ImageFile.Relocate(), what's overwritten is removed first, so nothing is written
+				# through it: it could be a hard link of the image itself. With a journal, it's kept so the
+				# run can be undone
+				try:
+					if journal != None:
+						journal.Backup(dest_file)
+					else:
+						os.remove(dest_file)
+				except EnvironmentError,err:
+					Finished(image,prev_path,dest_file,None,err)
+					return
+			pooled = False
+			if link_to != None:
+				transfer = lambda source,target,link_to = link_to: LinkFile(link_to.path,target,'hard')
+			elif copy and link != None:
+				transfer = lambda source,target: LinkFile(source,target,link)
+			elif copy:
+				transfer = CopyFile
+				pooled = True
+			else:
+				transfer = MoveFile
+				pooled = not SameDevice(prev_path,dest_file)
+			if pooled and pooling:
+				pool.Submit(transfer,(prev_path,dest_file),
+					lambda result,err,image = image,prev_path = prev_path,dest_file = dest_file: Finished(image,prev_path,dest_file,result,err))
+			else:
+				result,error = None,None
+				try:
+					result = transfer(prev_path,dest_file)
+					if link_to != None and not copy:
+						os.remove(prev_path)
+				except EnvironmentError,err:
+					error = err
+				Finished(image,prev_path,dest_file,result,error)
+		# The links are made once the images they link to are where they're going, so none points to where
+		# an original was before its copy finished
+		linked = []
+		for image,destination,link_to in self.moves:
+			if link_to != None and pool != None:
+				linked.append((image,destination,link_to))
+			else:
+				Relocate(image,destination,link_to,pool != None)
+		if pool != None:
+			pool.Join()
+		for image,destination,link_to in linked:
+			Relocate(image,destination,link_to,False)
+		return relocated[0]
@@ -0,0 +1,123 @@
+## @file wp_planfile.py
+#  @brief Plans saved to a file by a dry run (--spider), to be applied later (--apply-plan)
+#
+#  @details A plan file is a text file with a JSON record per line. The first one holds the options the
+#  plan was made with; each of the others, a relocation, along with the dimensions of the image and the
+#  identity of the file (size, modification time and inode) when it was planned. Applying the plan
+#  takes nothing else: the TARGETs are not scanned and the images are not probed again. Only the files
+#  still matching their identity are relocated, so the ones changed since are left alone.
+#
+#  Like in the journal (see wp_journal.py), paths are stored as if they were Latin-1 text.
+#
+
+import os
+import json
+import threading
+from wp_stats import STATS
+
+## @var PLAN_VERSION
+#  @brief Version of the format of the plan files written
+#
+PLAN_VERSION = 1
+
+## @class PlanWriter
+#
+#  @brief Writes the relocations of a dry run to a plan file
+#
+#  @details It can be shared by several threads.
+class PlanWriter(object):
+
+	## @param filename the path of the plan file, which is overwritten
+	#  @param targets the paths of the TARGETs
+	#  @param copy whether the images are copied instead of moved
+	#  @param overwrite whether the files already in the destination are overwritten
+	#  @param link how the copies are linked, if they are (see @c LINK_MODES)
+	def __init__(self,filename,targets,copy = False,overwrite = True,link = None):
+		self.lock = threading.Lock()
+		self.handle = open(filename,'w')
+		self._Write({'version' : PLAN_VERSION,'targets' : [os.path.abspath(target).decode('latin-1') for target in targets],
+			'copy' : bool(copy),'overwrite' : bool(overwrite),'link' : link})
+
+	def _Write(self,record):
+		self.lock.acquire()
+		try:
+			self.handle.write(json.dumps(record,separators = (',',':'))+'\n')
+		finally:
+			self.lock.release()
+
+	## @brief Adds the relocation of @a image to the directory @a destination
+	#
+	#  @param link_to the @c ImageFile @a image is to be hard linked to, if any (see --dedup)
+	#
+	def Add(self,image,destination,link_to = None):
+		stat = os.stat(image.path)
+		record = {'source' : image.path.decode('latin-1'),'target' : destination.decode('latin-1'),
+			'width' : image.width,'height' : image.height,
+			'size' : stat.st_size,'mtime' : stat.st_mtime,'inode' : stat.st_ino}
+		if link_to != None:
+			record['link_to'] = link_to.path.decode('latin-1')
+		self._Write(record)
+		STATS.Count('planned')
+
+	def Close(self):
+		if self.handle != None:
+			self.handle.close()
+			self.handle = None
+
+## @brief Reads the plan file at @a filename into a @c MovePlan
+#
+#  @details The identity of each file is checked against the one it had when it was planned: the ones
+#  that changed, or are gone, are reported and left out.
+#
+#  @param report a function called with a message for each relocation left out
+#
+#  @return a @c tuple @c (plan,options,skipped), with the @c MovePlan, the options the plan was made with
+#  (@c targets, @c copy, @c overwrite and @c link), and the number of relocations left out
+#
+#  @exception ValueError if @a filename is not a plan file
+#
+def LoadPlan(filename,report = None):
+	from wp_class import ImageFile
+	from wp_plan import MovePlan
+	plan = MovePlan()
+	images = {}
+	skipped = 0
+	handle = open(filename,'r')
+	try:
+		try:
+			header = json.loads(handle.readline())
+		except ValueError:
+			header = None
+		if not isinstance(header,dict) or header.get('version') != PLAN_VERSION:
+			raise ValueError(filename+' is not a plan file')
+		options = {'targets' : [target.encode('latin-1') for target in header['targets']],
+			'copy' : header['copy'],'overwrite' : header['overwrite'],'link' : header['link']}
+		for line in handle:
+			record = json.loads(line)
+			source = record['source'].encode('latin-1')
+			try:
+				stat = os.stat(source)
+				changed = (stat.st_size,stat.st_mtime,stat.st_ino) != (record['size'],record['mtime'],record['inode'])
+			except OSError:
+				changed = True
+			if changed:
+				skipped += 1
+				if report != None:
+					report(source+' changed or is gone since it was planned, skipping it')
+				continue
+			image = images[source] = ImageFile.FromMetadata(os.path.dirname(source),os.path.basename(source),record['width'],record['height'])
+			link_to = record.get('link_to')
+			if link_to != None:
+				link_to = link_to.encode('latin-1')
+				if link_to in images:
+					link_to = images[link_to]
+				elif os.path.lexists(link_to):
+					# The original was not relocated: it has the same contents, and so the same dimensions
+					link_to = ImageFile.FromMetadata(os.path.dirname(link_to),os.path.basename(link_to),record['width'],record['height'])
+				else:
+					# The original is gone, so it's relocated like any other image
+					link_to = None
+			plan.Add(image,record['target'].encode('latin-1'),link_to)
+	finally:
+		handle.close()
+	return (plan,options,skipped)
@@ -0,0 +1,147 @@
+## @file wp_probe.py
+#  @brief Header-only probing of image dimensions
+#
+#  @details Opening a file with PIL just to know its width and height means building a full decoder
+#  object for it. For the common wallpaper formats (JPEG, PNG, GIF, BMP and WebP) the dimensions are
+#  stored in the first bytes of the file, so we read them straight from there, and only fall back to
+#  PIL for the formats we don't know about.
+#
+
+import struct
+
+## @var PROBE_CHUNK
+#  @brief Number of bytes read from the start of a file to identify it
+#
+#  @details It's enough to hold the signature and the dimensions of every format handled here, except
+#  for JPEG, whose frame header can be anywhere after the metadata segments.
+#
+PROBE_CHUNK = 32
+
+## @var JPEG_SOF_MARKERS
+#  @brief JPEG "start of frame" markers, the ones carrying the dimensions of the image
+#
+#  @details 0xC4 (DHT), 0xC8 (JPG) and 0xCC (DAC) are in the same range, but are not frame headers.
+#
+JPEG_SOF_MARKERS = frozenset([0xC0,0xC1,0xC2,0xC3,0xC5,0xC6,0xC7,0xC9,0xCA,0xCB,0xCD,0xCE,0xCF])
+
+def _ProbeJPEG(handle):
+	handle.seek(2)
+	while True:
+		byte = handle.read(1)
+		# Markers can be padded with any number of 0xFF
+		while byte == '\xff':
+			marker = handle.read(1)
+			if marker != '\xff':
+				break
+		else:
+			return None
+		marker = ord(marker) if marker else None
+		if marker == None or marker == 0xD9 or marker == 0xDA:
+			# End of image or start of scan, and no frame header found
+			return None
+		if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+			# Standalone markers, no length
+			continue
+		data = handle.read(2)
+		if len(data) < 2:
+			return None
+		length = struct.unpack('>H',data)[0]
+		if marker in JPEG_SOF_MARKERS:
+			data = handle.read(5)
+			if len(data) < 5:
+				return None
+			height,width = struct.unpack('>xHH',data)
+			return (width,height)
+		handle.seek(length-2,1)
+
+def _ProbePNG(header):
+	if header[12:16] == 'IHDR':
+		return struct.unpack('>II',header[16:24])
+	return None
+
+def _ProbeGIF(header):
+	return struct.unpack('<HH',header[6:10])
+
+def _ProbeBMP(header):
+	dib_size = struct.unpack('<I',header[14:18])[0]
+	if dib_size == 12: # OS/2 BITMAPCOREHEADER
+		return struct.unpack('<HH',header[18:22])
+	elif dib_size >= 40:
+		width,height = struct.unpack('<ii',header[18:26])
+		# A negative height means the rows are stored top-down
+		return (width,abs(height))
+	return None
+
+def _ProbeWebP(header):
+	chunk = header[12:16]
+	if chunk == 'VP8 ':
+		if header[23:26] != '\x9d\x01\x2a':
+			return None
+		width,height = struct.unpack('<HH',header[26:30])
+		return (width & 0x3fff,height & 0x3fff)
+	elif chunk == 'VP8L':
+		if header[20] != '\x2f':
+			return None
+		b0,b1,b2,b3 = map(ord,header[21:25])
+		width = 1 + (((b1 & 0x3F) << 8) | b0)
+		height = 1 + (((b3 & 0x0F) << 10) | (b2 << 2) | ((b1 & 0xC0) >> 6))
+		return (width,height)
+	elif chunk == 'VP8X':
+		width = 1 + struct.unpack('<I',header[24:27]+'\x00')[0]
+		height = 1 + struct.unpack('<I',header[27:30]+'\x00')[0]
+		return (width,height)
+	return None
+
+## @brief Reads the dimensions of an image from its header, without decoding it
+#
+#  @param handle a file object opened in binary mode, positioned anywhere
+#
+#  @return the @c tuple @c (width,height) of the image
+#
+#  @retval None if the format is not one of the formats handled here, or the header is broken
+#
+def ProbeHeader(handle):
+	handle.seek(0)
+	header = handle.read(PROBE_CHUNK)
+	size = None
+	try:
+		if header[:2] == '\xff\xd8':
+			size = _ProbeJPEG(handle)
+		elif header[:8] == '\x89PNG\r\n\x1a\n':
+			size = _ProbePNG(header)
+		elif header[:6] in ('GIF87a','GIF89a'):
+			size = _ProbeGIF(header)
+		elif header[:2] == 'BM':
+			size = _ProbeBMP(header)
+		elif header[:4] == 'RIFF' and header[8:12] == 'WEBP':
+			size = _ProbeWebP(header)
+	except (struct.error,IndexError):
+		size = None
+	if size != None:
+		size = tuple(map(int,size))
+	return size
+
+## @brief Gets the dimensions of the image at @a path
+#
+#  @details The header of the file is read first, and PIL is only used when the format
+#  is unknown to ProbeHeader(). Either way the file is opened once, and closed before returning, so
+#  no handle is left behind for the garbage collector.
+#
+#  @param path the path of the image
+#
+#  @return the @c tuple @c (width,height) of the image
+#
+#  @exception IOError if the file cannot be read, or it's not an image PIL can identify
+#
+def ProbeDimensions(path):
+	handle = open(path,'rb')
+	try:
+		size = ProbeHeader(handle)
+		if size == None:
+			import Image
+			handle.seek(0)
+			# Only the header is parsed: the image is never decoded
+			size = Image.open(handle).size
+	finally:
+		handle.close()
+	return size
@@ -0,0 +1,87 @@
+## @file wp_prune.py
+#  @brief Removal of the directories emptied by a run, driven by the number of entries left in each one
+#
+#  @details Checking whether a directory is empty means listing it again, and doing it for every
+#  directory of the tree lists the whole tree twice. An @c EntryCounter takes the number of entries of
+#  each directory from the listing already made when it was loaded, and counts them down as the images
+#  leave. Only the directories whose count reaches zero are listed again (in case something else was
+#  put in them meanwhile) and removed, deepest first; removing one counts down its parent as well. The
+#  cost of the cleanup is then proportional to the directories actually emptied.
+#
+
+import os
+import heapq
+import threading
+
+## @class EntryCounter
+#
+#  @brief Number of entries left in each directory of the run
+#
+#  @details It can be shared by several threads.
+class EntryCounter(object):
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.counts = {}
+		# The directories whose count reached zero, deepest first
+		self.emptied = []
+
+	def _Emptied(self,directory):
+		heapq.heappush(self.emptied,(-directory.count(os.sep),directory))
+
+	## @brief Adds every directory of the tree of @a directorio, with the number of entries it was listed with
+	#
+	#  @param directorio a @c Directory
+	#
+	def AddTree(self,directorio):
+		if directorio.path == None:
+			return
+		self.lock.acquire()
+		try:
+			self.counts[directorio.path] = directorio.entries
+			if directorio.entries == 0:
+				self._Emptied(directorio.path)
+		finally:
+			self.lock.release()
+		directories = directorio.GetDictionary('directories')
+		if directories != None:
+			for dirs in directories.values():
+				self.AddTree(dirs)
+
+	## @brief Counts down an entry that left @a directory
+	#
+	#  @details Directories not added to the counter are ignored.
+	#
+	def Release(self,directory):
+		self.lock.acquire()
+		try:
+			count = self.counts.get(directory)
+			if count == None:
+				return
+			self.counts[directory] = count-1
+			if count == 1:
+				self._Emptied(directory)
+		finally:
+			self.lock.release()
+
+	## @brief Removes the directories emptied, deepest first
+	#
+	#  @param remove a function called with the path of each directory emptied, which removes it, if it's
+	#  still empty, and tells whether it did. The parent of each directory removed is counted down.
+	#
+	#  @return the number of directories removed
+	#
+	def Prune(self,remove):
+		removed = 0
+		while True:
+			self.lock.acquire()
+			try:
+				if not self.emptied:
+					break
+				depth,directory = heapq.heappop(self.emptied)
+			finally:
+				self.lock.release()
+			if remove(directory):
+				removed += 1
+				self.Release(os.path.dirname(directory))
+		return removed
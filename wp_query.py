@@ -0,0 +1,271 @@
+## @file wp_query.py
+#  @brief Read-only queries over the dimensions of the images of the collection
+#
+#  @details A @c QueryIndex answers questions like "how many 21:9 images are there" or "which images are
+#  below 2560x1440" without relocating anything. It's built from an @c ImageBatch, filled by scanning the
+#  TARGETs, and keeps the positions of the images sorted by width, by height and by ratio: each condition
+#  of a query is a range of one of them, found with a binary search, so only the images within the
+#  narrowest range are looked at.
+#
+#  An @c IndexQuery answers the same questions straight from the @c MetadataIndex, which keeps its own
+#  indexes on those columns: the conditions, the counts and the top entries are all left to SQLite, so
+#  nothing is loaded or sorted beforehand.
+#
+#  A query is a comma separated list of conditions, each one a field, an operator (@c <, @c <=, @c >,
+#  @c >= or @c =) and a value:
+#  - @c width and @c height, compared to a number of pixels
+#  - @c ratio, compared to a number or a @c W:H ratio. With @c =, the threshold of the ratios applies.
+#  - @c size, compared to a @c WxH resolution: both the width and the height are compared
+#
+#  For instance, @c "size<2560x1440,ratio>=16:10".
+#
+
+import re
+from array import array
+from bisect import bisect_left, bisect_right
+from wp_batch import ImageBatch
+
+## @var QUERY_FIELDS
+#  @brief The fields a query can have conditions on
+#
+QUERY_FIELDS = ('width','height','ratio','size')
+
+## @var QUERY_REPORTS
+#  @brief What can be reported about the images matching a query
+#
+QUERY_REPORTS = ('count','ratios','resolutions','directories','files')
+
+## @var CONDITION
+#  @brief A condition of a query: field, operator and value
+#
+CONDITION = re.compile(r'^\s*(\w+)\s*(<=|>=|<|>|=)\s*(\S+)\s*$')
+
+## @brief Reads a ratio, given as a number or as @c W:H
+def ParseRatio(value):
+	if ':' in value:
+		width,height = value.split(':',1)
+		return float(width)/float(height)
+	return float(value)
+
+## @brief Reads the @a query into a @c list of ranges
+#
+#  @param threshold how far from the value of @c ratio=VALUE a ratio can be to match
+#
+#  @return a @c list of @c (field,low,high) tuples, with @c field one of @c width, @c height or @c ratio.
+#  Each bound is a @c (value,inclusive) tuple, or @c None if there's none.
+#
+#  @exception ValueError if @a query is not a proper query
+#
+def ParseQuery(query,threshold = 0.0):
+	ranges = []
+	for condition in query.split(','):
+		if not condition.strip():
+			continue
+		match = CONDITION.match(condition)
+		if match == None or match.group(1) not in QUERY_FIELDS:
+			raise ValueError('Not a proper condition: '+condition+'. Fields are '+', '.join(QUERY_FIELDS))
+		field,operator,value = match.groups()
+		try:
+			if field == 'size':
+				width,height = value.lower().split('x')
+				values = [('width',int(width)),('height',int(height))]
+			elif field == 'ratio':
+				values = [(field,ParseRatio(value))]
+			else:
+				values = [(field,int(value))]
+		except (ValueError,ZeroDivisionError):
+			raise ValueError('Not a proper value for '+field+': '+value)
+		for field,value in values:
+			if operator == '=':
+				if field == 'ratio':
+					ranges.append((field,(value-threshold,True),(value+threshold,True)))
+				else:
+					ranges.append((field,(value,True),(value,True)))
+			elif operator == '<':
+				ranges.append((field,None,(value,False)))
+			elif operator == '<=':
+				ranges.append((field,None,(value,True)))
+			elif operator == '>':
+				ranges.append((field,(value,False),None))
+			else:
+				ranges.append((field,(value,True),None))
+	return ranges
+
+## @class QueryIndex
+#
+#  @brief The images of an @c ImageBatch, sorted by width, height and ratio
+class QueryIndex(object):
+
+	def __init__(self,batch):
+		self.batch = batch
+		widths = batch.widths
+		heights = batch.heights
+		ratios = array('d',(float(width)/height if height else 0.0 for width,height in zip(widths,heights)))
+		self.columns = {'width' : widths,'height' : heights,'ratio' : ratios}
+		self.order = {}
+		self.keys = {}
+		for field,column in self.columns.items():
+			order = sorted(xrange(len(column)),key = column.__getitem__)
+			self.order[field] = array('I',order)
+			self.keys[field] = array(column.typecode,(column[position] for position in order))
+
+	def __len__(self):
+		return len(self.batch)
+
+	## @brief Counts the images in the @a selection given by Select()
+	def Count(self,selection):
+		return len(selection)
+
+	def _Span(self,field,low,high):
+		keys = self.keys[field]
+		start = 0
+		if low != None:
+			value,inclusive = low
+			if inclusive:
+				start = bisect_left(keys,value)
+			else:
+				start = bisect_right(keys,value)
+		end = len(keys)
+		if high != None:
+			value,inclusive = high
+			if inclusive:
+				end = bisect_right(keys,value)
+			else:
+				end = bisect_left(keys,value)
+		return (start,max(start,end))
+
+	## @brief Gets the positions in the batch of the images within the @a ranges (see ParseQuery())
+	#
+	#  @details The narrowest range is taken from its sorted column; the images in it are then checked
+	#  against the rest.
+	#
+	#  @return a sorted @c list of positions
+	#
+	def Select(self,ranges):
+		if not ranges:
+			return range(len(self))
+		spans = [(self._Span(field,low,high),field) for field,low,high in ranges]
+		(start,end),field = min(spans,key = lambda span: span[0][1]-span[0][0])
+		positions = self.order[field][start:end]
+		for field,low,high in ranges:
+			column = self.columns[field]
+			positions = [position for position in positions if Within(column[position],low,high)]
+		return sorted(positions)
+
+	## @brief Counts the images at @a positions by the ratio they belong to, according to @a classifier
+	#
+	#  @return a @c list of @c (name,count) tuples, the biggest count first. Images not belonging to any
+	#  ratio are counted under @c None.
+	#
+	def CountRatios(self,positions,classifier):
+		widths = self.columns['width']
+		heights = self.columns['height']
+		paths = [self.batch.GetPath(position) for position in positions]
+		names = classifier.ClassifyBatch([widths[position] for position in positions],[heights[position] for position in positions],paths)
+		return CountValues(names)
+
+	## @brief Counts the images at @a positions by resolution
+	#
+	#  @param top how many resolutions to get, if not all of them
+	#
+	#  @return a @c list of @c ((width,height),count) tuples, the biggest count first
+	#
+	def CountResolutions(self,positions,top = None):
+		widths = self.columns['width']
+		heights = self.columns['height']
+		return CountValues((widths[position],heights[position]) for position in positions)[:top]
+
+	## @brief Counts the images at @a positions by directory
+	#
+	#  @param top how many directories to get, if not all of them
+	#
+	#  @return a @c list of @c (directory,count) tuples, the biggest count first
+	#
+	def CountDirectories(self,positions,top = None):
+		directories = self.batch.directories
+		dir_table = self.batch.dir_table
+		counts = CountValues(directories[position] for position in positions)[:top]
+		return [(dir_table[dir_id],count) for dir_id,count in counts]
+
+	## @brief Gets the path, width and height of each image at @a positions
+	def GetFiles(self,positions):
+		batch = self.batch
+		return [(batch.GetPath(position),batch.widths[position],batch.heights[position]) for position in positions]
+
+## @class IndexQuery
+#
+#  @brief The wallpapers of a @c MetadataIndex, queried in place
+#
+#  @details It has the methods of a @c QueryIndex, but a selection is the ranges themselves: each report
+#  is a query of its own, with the conditions and the top entries handled by SQLite, using the indexes
+#  on width, height and ratio. Nothing is read but the index: files gone since they were indexed are
+#  still there, see --prune-index.
+class IndexQuery(object):
+
+	def __init__(self,index):
+		self.index = index
+
+	def __len__(self):
+		return self.index.CountImages()
+
+	## @brief Gets the selection of the images within the @a ranges (see ParseQuery())
+	def Select(self,ranges):
+		return list(ranges)
+
+	def Count(self,selection):
+		return self.index.CountImages(selection)
+
+	## @brief Counts the images in the @a selection by the ratio they belong to, according to @a classifier
+	#
+	#  @details Only each resolution is classified, once, unless the classifier looks at the files too.
+	#
+	def CountRatios(self,selection,classifier):
+		if getattr(classifier,'uses_paths',False):
+			images = self.index.GetImages(selection)
+			names = classifier.ClassifyBatch([width for path,width,height in images],[height for path,width,height in images],
+				[path for path,width,height in images])
+			return CountValues(names)
+		resolutions = self.index.CountResolutions(selection)
+		names = classifier.ClassifyBatch([width for (width,height),count in resolutions],[height for (width,height),count in resolutions])
+		counts = {}
+		for name,(resolution,count) in zip(names,resolutions):
+			counts[name] = counts.get(name,0)+count
+		return sorted(counts.items(),key = lambda item: (-item[1],item[0]))
+
+	def CountResolutions(self,selection,top = None):
+		return self.index.CountResolutions(selection,top)
+
+	def CountDirectories(self,selection,top = None):
+		return self.index.CountDirectories(selection,top)
+
+	def GetFiles(self,selection):
+		return self.index.GetImages(selection)
+
+## @brief Tells whether @a value is within @a low and @a high, as given by ParseQuery()
+def Within(value,low,high):
+	if low != None and (value < low[0] or (value == low[0] and not low[1])):
+		return False
+	if high != None and (value > high[0] or (value == high[0] and not high[1])):
+		return False
+	return True
+
+## @brief Counts how many times each value of @a values comes up
+#
+#  @return a @c list of @c (value,count) tuples, the biggest count first, and then by value
+#
+def CountValues(values):
+	counts = {}
+	for value in values:
+		counts[value] = counts.get(value,0)+1
+	return sorted(counts.items(),key = lambda item: (-item[1],item[0]))
+
+## @brief Builds an @c ImageBatch with the images of the @a trees
+#
+#  @param trees the @c Directory of each TARGET
+#
+def BatchFromTrees(trees):
+	batch = ImageBatch()
+	for tree in trees:
+		for image in tree.GetImages():
+			batch.Append(image)
+	return batch
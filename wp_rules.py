@@ -0,0 +1,336 @@
+## @file wp_rules.py
+#  @brief Classification of images by a set of rules, each one sending the images it matches to its own destination
+#
+#  @details The rules are read from a JSON file (or a TOML one, if the @c toml module is installed) like:
+#
+#  @code
+#  {
+#  	"ratios": {"16:9": "HDTV", "21:9": "Ultrawide"},
+#  	"rules": [
+#  		{"ratio": "Ultrawide", "min_width": 3440, "destination": "{ratio}"},
+#  		{"orientation": "portrait", "format": ["jpg","png"], "destination": "Phone/{resolution}"},
+#  		{"ratio": ["HDTV"], "min_resolution": "1920x1080", "max_size": "20M", "destination": "{ratio}/{resolution}"}
+#  	]
+#  }
+#  @endcode
+#
+#  An image goes to the destination of the first rule it meets all the conditions of, or is left
+#  unmatched if there's none. The conditions are:
+#  - @c ratio: the name of the ratio (or a list of them) the image belongs to, among the @c ratios of the
+#  file (the ones given with --ratio, or the stock ones, if it has none). The threshold applies as usual.
+#  - @c orientation: @c landscape, @c portrait or @c square (or a list of them)
+#  - @c format: the extension of the file (or a list of them), @c jpeg being the same as @c jpg
+#  - @c min_width, @c max_width, @c min_height, @c max_height, in pixels; @c min_resolution and
+#  @c max_resolution, as @c WxH, set both at once
+#  - @c min_aspect and @c max_aspect, the width divided by the height, as a number or @c W:H
+#  - @c min_size and @c max_size, the size of the file in bytes, or in @c K, @c M or @c G
+#
+#  Every bound is inclusive. The destination is a folder, or several separated by @c /, and can use
+#  @c {ratio}, @c {width}, @c {height}, @c {resolution}, @c {orientation} and @c {format}. A folder left
+#  empty (@c {format}, for a file with no extension) is named @c EMPTY_FOLDER instead.
+#
+#  The rules are compiled once into a table per condition: a dictionary for those taking names, and the
+#  sorted bounds of every rule for those taking numbers. Each entry of a table holds, as the bits of an
+#  integer, the rules an image with that value meets that condition of. An image is then classified by
+#  looking up each condition (a binary search for the numbers) and taking the lowest bit left in all of
+#  them, which costs about the same no matter how many rules there are.
+#
+
+import os
+import re
+import json
+from bisect import bisect_left
+from wp_class import STOCK_RATIOS
+from wp_classify import RatioClassifier
+
+## @var toml
+#  @brief The @c toml module, if installed
+#
+try:
+	import toml
+except ImportError:
+	toml = None
+
+## @var CHOICE_FIELDS
+#  @brief The conditions taking names, and the names each one can take (@c None meaning any)
+#
+CHOICE_FIELDS = {'ratio' : None,'orientation' : ('landscape','portrait','square'),'format' : None}
+
+## @var RANGE_FIELDS
+#  @brief The conditions taking numbers
+#
+RANGE_FIELDS = ('width','height','aspect','size')
+
+## @var FORMAT_ALIASES
+#  @brief Extensions standing for the same format as another one
+#
+FORMAT_ALIASES = {'jpeg' : 'jpg','jpe' : 'jpg','tif' : 'tiff'}
+
+## @var SIZE
+#  @brief A size in bytes, with an optional unit
+#
+SIZE = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*([kmg]?)b?\s*$',re.IGNORECASE)
+
+## @var TEMPLATE_FIELDS
+#  @brief Sample values of the fields a destination can use, to check the destinations when they're read
+#
+TEMPLATE_FIELDS = {'ratio' : 'HDTV','width' : 1920,'height' : 1080,'resolution' : '1920x1080','orientation' : 'landscape','format' : 'jpg'}
+
+## @var EMPTY_FOLDER
+#  @brief Name of a folder of a destination whose fields turned out empty, so the image isn't left a level above
+#
+EMPTY_FOLDER = 'Unknown'
+
+## @brief Reads the rules saved to @a filename
+#
+#  @details Files ending in @c .toml are read as TOML, and everything else as JSON.
+#
+#  @return a @c dict like the one described in wp_rules.py
+#
+#  @exception ValueError if @a filename can't be read, or is not a proper JSON or TOML file
+#
+def LoadRules(filename):
+	try:
+		handle = open(filename,'r')
+	except IOError,err:
+		raise ValueError('Can\'t read '+filename+': '+str(err.strerror))
+	try:
+		if filename.lower().endswith('.toml'):
+			if toml == None:
+				raise ValueError('Reading '+filename+' requires the toml module')
+			try:
+				rules = toml.load(handle)
+			except Exception,err:
+				raise ValueError('Not a proper TOML file: '+filename+': '+str(err))
+		else:
+			rules = json.load(handle)
+	finally:
+		handle.close()
+	if not isinstance(rules,dict) or not isinstance(rules.get('rules'),list):
+		raise ValueError(filename+' has no list of rules')
+	return rules
+
+## @brief Gets the format of the file at @a path, from its extension
+def GetFormat(path):
+	extension = os.path.splitext(path)[1][1:].lower()
+	return FORMAT_ALIASES.get(extension,extension)
+
+## @brief Gets the orientation of an image of @a width x @a height
+def GetOrientation(width,height):
+	if width > height:
+		return 'landscape'
+	elif width < height:
+		return 'portrait'
+	return 'square'
+
+def _ParseNumber(field,value):
+	try:
+		if field == 'size':
+			if isinstance(value,(int,long,float)):
+				return int(value)
+			match = SIZE.match(str(value))
+			if match == None:
+				raise ValueError
+			number,unit = match.groups()
+			return int(float(number)*(1 << (10*' kmg'.index(unit.lower() or ' '))))
+		elif field == 'aspect':
+			if isinstance(value,basestring) and ':' in value:
+				width,height = value.split(':',1)
+				return float(width)/float(height)
+			return float(value)
+		return int(value)
+	except (ValueError,TypeError,ZeroDivisionError):
+		raise ValueError('Not a proper value for '+field+': '+str(value))
+
+## @brief Reads one of the rules, as found in the file, into its conditions and destination
+#
+#  @return a @c tuple @c (choices,ranges,destination): @c choices a @c dict with the set of names of each
+#  condition taking names, @c ranges a @c dict with the @c (low,high) bounds of each condition taking
+#  numbers (@c None for no bound), and @c destination the @c list of folders, as templates
+#
+#  @exception ValueError if the rule is not a proper one
+#
+def ParseRule(rule,ratio_names):
+	if not isinstance(rule,dict):
+		raise ValueError('Not a proper rule: '+str(rule))
+	choices = {}
+	ranges = {}
+	destination = None
+	for key,value in rule.items():
+		if key == 'destination':
+			destination = [folder for folder in unicode(value).split('/') if folder not in ('','.')]
+			if destination == [] or '..' in destination:
+				raise ValueError('Not a proper destination: '+unicode(value))
+			try:
+				for folder in destination:
+					folder.format(**TEMPLATE_FIELDS)
+			except (KeyError,IndexError,ValueError),err:
+				raise ValueError('Not a proper destination: '+unicode(value)+' ('+str(err)+')')
+		elif key in CHOICE_FIELDS:
+			if isinstance(value,basestring):
+				value = [value]
+			names = set(unicode(name) for name in value)
+			if key == 'format':
+				names = set(FORMAT_ALIASES.get(name.lower().lstrip('.'),name.lower().lstrip('.')) for name in names)
+			allowed = key == 'ratio' and ratio_names or CHOICE_FIELDS[key]
+			if allowed != None and not names <= set(allowed):
+				raise ValueError('Not a proper '+key+': '+', '.join(sorted(names-set(allowed)))+'. It can be '+', '.join(sorted(allowed)))
+			choices[key] = names
+		elif key in ('min_resolution','max_resolution'):
+			try:
+				width,height = str(value).lower().split('x')
+			except ValueError:
+				raise ValueError('Not a proper resolution for '+key+': '+str(value))
+			for field,number in (('width',width),('height',height)):
+				_SetBound(ranges,key[:3],field,_ParseNumber(field,number))
+		elif key[:4] in ('min_','max_') and key[4:] in RANGE_FIELDS:
+			_SetBound(ranges,key[:3],key[4:],_ParseNumber(key[4:],value))
+		else:
+			raise ValueError('Unknown condition: '+key)
+	if destination == None:
+		raise ValueError('Rule without destination: '+str(rule))
+	return (choices,ranges,destination)
+
+def _SetBound(ranges,side,field,value):
+	low,high = ranges.get(field,(None,None))
+	if side == 'min':
+		low = value
+	else:
+		high = value
+	ranges[field] = (low,high)
+
+## @class RulesClassifier
+#
+#  @brief Sends each image to the destination of the first rule it meets, as described in wp_rules.py
+class RulesClassifier(object):
+
+	## @brief Compiles the @a rules
+	#
+	#  @param rules a @c dict like the one given by LoadRules()
+	#  @param ratios the ratios the rules refer to when they don't have their own, like @c STOCK_RATIOS
+	#  @param threshold how far from a ratio an image can be to still belong to it
+	#
+	#  @exception ValueError if the @a rules are not proper ones
+	#
+	def __init__(self,rules,ratios,threshold = 0.0):
+		if rules.get('ratios'):
+			ratios = dict((_ParseNumber('aspect',ratio),name) for ratio,name in rules.get('ratios').items())
+		self.ratios = RatioClassifier(ratios,threshold)
+		ratio_names = set(self.ratios.names)
+		ratio_names.add(STOCK_RATIOS[None])
+		parsed = [ParseRule(rule,ratio_names) for rule in rules.get('rules')]
+		self.destinations = [destination for choices,ranges,destination in parsed]
+		self.everything = (1 << len(parsed))-1
+		## Per condition taking names, the rules met by each name, and by any other
+		self.choices = {}
+		for field in CHOICE_FIELDS:
+			if any(field in choices for choices,ranges,destination in parsed):
+				table = {}
+				others = 0
+				for position,(choices,ranges,destination) in enumerate(parsed):
+					if field not in choices:
+						others |= 1 << position
+				for position,(choices,ranges,destination) in enumerate(parsed):
+					for name in choices.get(field,()):
+						table[name] = table.get(name,others) | 1 << position
+				self.choices[field] = (table,others)
+		## Per condition taking numbers, its bounds and the rules met between and on each of them
+		self.ranges = {}
+		for field in RANGE_FIELDS:
+			if any(field in ranges for choices,ranges,destination in parsed):
+				bounds = [ranges.get(field,(None,None)) for choices,ranges,destination in parsed]
+				points = sorted(set(bound for bound_pair in bounds for bound in bound_pair if bound != None))
+				# Entry 2*i is for the values between points[i-1] and points[i], and 2*i+1 for points[i] itself
+				table = []
+				for entry in xrange(2*len(points)+1):
+					mask = 0
+					for position,(low,high) in enumerate(bounds):
+						if entry % 2:
+							value = points[entry//2]
+							met = (low == None or low <= value) and (high == None or value <= high)
+						else:
+							below = above = None
+							if entry//2 > 0:
+								below = points[entry//2-1]
+							if entry//2 < len(points):
+								above = points[entry//2]
+							met = (low == None or (below != None and low <= below)) and (high == None or (above != None and above <= high))
+						if met:
+							mask |= 1 << position
+					table.append(mask)
+				others = 0
+				for position,(low,high) in enumerate(bounds):
+					if low == None and high == None:
+						others |= 1 << position
+				self.ranges[field] = (points,table,others)
+		self.uses_ratio = 'ratio' in self.choices or any('{ratio' in folder for destination in self.destinations for folder in destination)
+		## Whether the destination can depend on more than the resolution, so the path is needed
+		self.uses_paths = 'format' in self.choices or 'size' in self.ranges or \
+			any('{format' in folder for destination in self.destinations for folder in destination)
+
+	def _Lookup(self,field,value):
+		points,table,others = self.ranges[field]
+		if value == None:
+			# Only the rules with no bounds on it are met by an unknown value
+			return others
+		position = bisect_left(points,value)
+		if position < len(points) and points[position] == value:
+			return table[2*position+1]
+		return table[2*position]
+
+	## @brief Gets the destination of an image of @a width x @a height, as a relative path
+	#
+	#  @param path the path of the image, for the rules on its format and size. Without it, those rules are
+	#  only met by images of any format and size.
+	#
+	#  @retval None if it doesn't meet any rule
+	#
+	def Classify(self,width,height,path = None):
+		rules = self.everything
+		ranges = self.ranges
+		choices = self.choices
+		ratio = None
+		if self.uses_ratio:
+			ratio = self.ratios.Classify(width,height)
+			if ratio == None:
+				ratio = STOCK_RATIOS[None]
+		orientation = GetOrientation(width,height)
+		image_format = path != None and GetFormat(path) or None
+		for field,value in (('ratio',ratio),('orientation',orientation),('format',image_format)):
+			if field in choices:
+				table,others = choices[field]
+				rules &= table.get(value,others)
+		if 'width' in ranges:
+			rules &= self._Lookup('width',width)
+		if 'height' in ranges:
+			rules &= self._Lookup('height',height)
+		if 'aspect' in ranges:
+			rules &= self._Lookup('aspect',height and float(width)/height or 0.0)
+		if 'size' in ranges and rules:
+			# An empty file has a size too, even if it's 0
+			size = None
+			if path != None:
+				try:
+					size = os.path.getsize(path)
+				except OSError:
+					pass
+			rules &= self._Lookup('size',size)
+		if not rules:
+			return None
+		# The first rule met is the lowest bit left
+		destination = self.destinations[(rules & -rules).bit_length()-1]
+		fields = {'ratio' : ratio,'width' : width,'height' : height,'resolution' : str(width)+'x'+str(height),
+			'orientation' : orientation,'format' : image_format or ''}
+		return '/'.join(folder.format(**fields) or EMPTY_FOLDER for folder in destination).encode('utf-8')
+
+	## @brief Classifies a whole batch of images in one go
+	#
+	#  @param paths the paths of the images, in the same order as @a widths, if known
+	#
+	#  @return a @c list with the destination of each image, or @c None for those not meeting any rule
+	#
+	def ClassifyBatch(self,widths,heights,paths = None):
+		if paths == None:
+			paths = [None]*len(widths)
+		classify = self.Classify
+		return [classify(width,height,path) for width,height,path in zip(widths,heights,paths)]
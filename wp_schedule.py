@@ -0,0 +1,138 @@
+## @file wp_schedule.py
+#  @brief Running the TARGETs at the same time, with a limit of concurrent work per device
+#
+#  @details TARGETs on different disks can be processed at the same time, each disk working for its own.
+#  Several of them on the same hard disk, though, make its heads jump back and forth between them, and
+#  the whole is slower than one after another. A @c DeviceScheduler groups the work by device (the
+#  @c st_dev of the paths it touches) and lets each device run as many items at a time as its limit says:
+#  one for a hard disk, more for an SSD or a network share.
+#
+#  Items that depend on each other (two TARGETs writing to the same files, or one inside the other) are
+#  put in the same chain, and a chain is run in order, so the end result is the same as running every
+#  item one after another.
+#
+
+import os
+import sys
+import threading
+
+## @class DeviceScheduler
+#
+#  @brief Runs items at the same time, at most a given number at a time on each device
+class DeviceScheduler(object):
+
+	## @param limit the number of items that can run at the same time on each device
+	#  @param limits a @c dict with the limit of some devices, by @c st_dev, overriding @a limit
+	def __init__(self,limit = 1,limits = None):
+		self.limit = limit
+		self.limits = dict(limits or {})
+		self.lock = threading.Lock()
+		self.slots = {}
+		self.devices = {}
+
+	## @brief Gets the device holding @a path
+	#
+	#  @details If @a path doesn't exist yet (a destination, say), it's the device of its closest
+	#  existing parent, where it will be created.
+	#
+	def GetDevice(self,path):
+		path = os.path.abspath(path)
+		device = self.devices.get(path)
+		if device == None:
+			directory = path
+			while True:
+				try:
+					device = os.stat(directory).st_dev
+					break
+				except OSError:
+					parent = os.path.dirname(directory)
+					if parent == directory:
+						raise
+					directory = parent
+			self.devices[path] = device
+		return device
+
+	def _GetSlots(self,device):
+		self.lock.acquire()
+		try:
+			slots = self.slots.get(device)
+			if slots == None:
+				slots = self.slots[device] = threading.BoundedSemaphore(self.limits.get(device,self.limit))
+			return slots
+		finally:
+			self.lock.release()
+
+	## @brief Runs @a function with each of @a items, and waits for all of them
+	#
+	#  @param function the function to call with each item
+	#  @param items the items
+	#  @param paths a function giving the paths each item touches; it holds a slot on each of their devices
+	#  while it runs
+	#  @param chains a @c list of chains, each one a @c list of positions in @a items, run one after another
+	#  in that order. The items not in any chain run on their own.
+	#
+	#  @return the results of the calls, in the same order as @a items
+	#
+	#  @exception Exception whatever a call raised, once every thread is done. If several did, the one of
+	#  the first item is raised, as it would have been running them one after another. The rest of the
+	#  chain of a call that raised is not run.
+	#
+	def Run(self,function,items,paths,chains = None):
+		results = [None]*len(items)
+		errors = []
+		chained = set()
+		chains = [list(chain) for chain in chains or []]
+		for chain in chains:
+			chained.update(chain)
+		chains.extend([position] for position in xrange(len(items)) if position not in chained)
+		# The devices are found beforehand, so the threads don't stat() the same paths over and over
+		devices = [sorted(set(self.GetDevice(path) for path in paths(item))) for item in items]
+		def RunChain(chain):
+			for position in chain:
+				# Always taken in the same order, so two items can't wait for each other's slots
+				held = [self._GetSlots(device) for device in devices[position]]
+				for slots in held:
+					slots.acquire()
+				try:
+					results[position] = function(items[position])
+				except BaseException:
+					# Raised again once every thread is done, by the one waiting for them
+					errors.append((position,sys.exc_info()))
+					return
+				finally:
+					for slots in reversed(held):
+						slots.release()
+		threads = [threading.Thread(target = RunChain,args = (chain,)) for chain in chains]
+		for thread in threads:
+			thread.start()
+		for thread in threads:
+			thread.join()
+		if errors:
+			position,(error_type,error,traceback) = min(errors,key = lambda error: error[0])
+			raise error_type,error,traceback
+		return results
+
+## @brief Puts together the items that depend on each other
+#
+#  @param keys a @c list with the set of keys of each item: two items sharing a key depend on each other
+#
+#  @return a @c list of chains, each one a sorted @c list of positions in @a keys, for the items depending
+#  on some other
+#
+def GetChains(keys):
+	parents = range(len(keys))
+	def Find(position):
+		while parents[position] != position:
+			parents[position] = parents[parents[position]]
+			position = parents[position]
+		return position
+	owners = {}
+	for position,item_keys in enumerate(keys):
+		for key in item_keys:
+			owner = owners.setdefault(key,position)
+			if owner != position:
+				parents[Find(position)] = Find(owner)
+	chains = {}
+	for position in xrange(len(keys)):
+		chains.setdefault(Find(position),[]).append(position)
+	return [chain for chain in chains.values() if len(chain) > 1]
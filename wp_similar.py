@@ -0,0 +1,187 @@
+## @file wp_similar.py
+#  @brief Detection of images that look the same, even at different resolutions or in different formats
+#
+#  @details Each image gets a perceptual hash (a dHash): it's shrunk to a tiny grayscale thumbnail, and
+#  each bit of the hash tells whether a pixel is brighter than the one to its right. Resizing or
+#  recompressing an image barely changes it, so images that look the same have hashes differing in a
+#  few bits only. JPEG files are decoded at a fraction of their size (PIL's draft mode), so the full
+#  image is never decoded.
+#
+#  The hashes are kept in a BK-tree, which finds every hash within a given distance of another one
+#  without comparing it against all of them. Like the hashes of wp_dedup.py, they're cached by the
+#  identity of the file, so each file is hashed once when the cache is a @c MetadataIndex.
+#
+
+import os
+from wp_stats import STATS
+
+## @var SIMILAR_ACTIONS
+#  @brief What can be done with the images looking like a bigger one: move them to a side folder, or
+#  leave them where they are
+#
+SIMILAR_ACTIONS = ('aside','keep')
+
+## @var HASH_SIZE
+#  @brief Width and height of the grid of bits of the hash, which has @c HASH_SIZE*HASH_SIZE bits
+#
+HASH_SIZE = 8
+
+## @brief Gets the perceptual hash of the image at @a path
+#
+#  @return the hash, as an @c int of @c HASH_SIZE*HASH_SIZE bits
+#
+#  @exception IOError if the image can't be read or decoded
+#
+def PerceptualHash(path):
+	import Image
+	handle = open(path,'rb')
+	try:
+		image = Image.open(handle)
+		# Only JPEG supports it, but then the decoder skips most of the work by scaling the image down
+		image.draft('L',(HASH_SIZE*8,HASH_SIZE*8))
+		image = image.convert('L').resize((HASH_SIZE+1,HASH_SIZE),Image.ANTIALIAS)
+	finally:
+		# Closed right away, instead of whenever the decoder is collected
+		handle.close()
+	pixels = list(image.getdata())
+	value = 0
+	for row in xrange(HASH_SIZE):
+		offset = row*(HASH_SIZE+1)
+		for column in xrange(offset,offset+HASH_SIZE):
+			value = (value << 1) | (pixels[column] > pixels[column+1])
+	STATS.Count('files_perceptually_hashed')
+	return value
+
+## @brief Gets the number of bits that differ between the hashes @a value and @a other
+def Distance(value,other):
+	return bin(value ^ other).count('1')
+
+## @class BKTree
+#
+#  @brief Burkhard-Keller tree of hashes, to look up the ones close to a given hash
+#
+#  @details Each node keeps its children by their distance to it. Thanks to the triangle inequality,
+#  a lookup within @a distance of a hash only has to go down the children whose distance to the
+#  node is within @a distance of the distance between the node and the hash.
+class BKTree(object):
+
+	def __init__(self):
+		# Every node is a list: [hash,item,{distance: child}]
+		self.root = None
+		self.size = 0
+
+	def __len__(self):
+		return self.size
+
+	## @brief Adds @a item to the tree, with the hash @a value
+	def Add(self,value,item):
+		self.size += 1
+		if self.root == None:
+			self.root = [value,item,{}]
+			return
+		node = self.root
+		while True:
+			distance = Distance(value,node[0])
+			child = node[2].get(distance)
+			if child == None:
+				node[2][distance] = [value,item,{}]
+				return
+			node = child
+
+	## @brief Finds the items whose hash is within @a distance of @a value
+	#
+	#  @return a @c list of @c (distance,item), closest first
+	#
+	def Find(self,value,distance):
+		found = []
+		if self.root == None:
+			return found
+		pending = [self.root]
+		while pending:
+			node = pending.pop()
+			current = Distance(value,node[0])
+			if current <= distance:
+				found.append((current,node[1]))
+			for child_distance,child in node[2].iteritems():
+				if current-distance <= child_distance <= current+distance:
+					pending.append(child)
+		found.sort(key = lambda pair: pair[0])
+		return found
+
+## @class SimilarFinder
+#
+#  @brief Groups the images that look the same
+#
+#  @details The images are added while they're processed, and grouped once they've all been seen, so the
+#  biggest image of each group is known.
+class SimilarFinder(object):
+
+	## @param distance how many bits the hashes of two images can differ by, for them to be grouped
+	#  @param cache where the hashes are cached: a @c MetadataIndex, or a @c MemoryHashCache by default
+	def __init__(self,distance = 6,cache = None):
+		import threading
+		from wp_dedup import MemoryHashCache
+		if cache == None:
+			cache = MemoryHashCache()
+		self.distance = distance
+		self.cache = cache
+		self.images = []
+		self.lock = threading.Lock()
+
+	## @brief Adds @a image to the images to group
+	def Add(self,image):
+		self.lock.acquire()
+		try:
+			self.images.append(image)
+		finally:
+			self.lock.release()
+
+	## @brief Gets the perceptual hash of @a image, from the cache if the file didn't change
+	#
+	#  @retval None if @a image can't be decoded
+	#
+	def GetHash(self,image):
+		try:
+			stat = os.stat(image.path)
+			digest = self.cache.LookupHash(stat,'perceptual')
+			if digest == None:
+				digest = '%016x' % PerceptualHash(image.path)
+				self.cache.StoreHash(stat,digest,'perceptual')
+			return int(digest,16)
+		except (IOError,OSError),err:
+			print 'SimilarFinder.GetHash(): Error hashing '+image.path+':',err
+			return None
+
+	## @brief Groups the images added so far
+	#
+	#  @details Each image joins the group of the closest image added before it, if it's within the
+	#  distance given; otherwise it starts a group of its own.
+	#
+	#  @param pool a pool of workers (with a @c map() method) computing the hashes, if given
+	#
+	#  @return a @c list of groups of more than one image, each one a @c list of @c ImageFile with the
+	#  biggest image first
+	#
+	def GetGroups(self,pool = None):
+		if pool != None:
+			hashes = pool.map(self.GetHash,self.images)
+		else:
+			hashes = map(self.GetHash,self.images)
+		tree = BKTree()
+		groups = []
+		for image,value in zip(self.images,hashes):
+			if value == None:
+				continue
+			found = tree.Find(value,self.distance)
+			if found:
+				found[0][1].append(image)
+			else:
+				group = [image]
+				groups.append(group)
+				tree.Add(value,group)
+		groups = [group for group in groups if len(group) > 1]
+		for group in groups:
+			# sort() is stable, so the first image seen wins among the biggest ones
+			group.sort(key = lambda image: image.width*image.height,reverse = True)
+			STATS.Count('similar',len(group)-1)
+		return groups
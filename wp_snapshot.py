@@ -0,0 +1,189 @@
+## @file wp_snapshot.py
+#  @brief Binary snapshot of the trees loaded, so the next run only lists the directories that changed
+#
+#  @details Loading a TARGET lists every directory and looks at every file in it, which takes minutes on
+#  a big library, even when nothing changed since the last run. A snapshot keeps the trees loaded by a
+#  run in a compact binary file, which the next run maps in memory: a directory whose modification time
+#  is still the same holds the same entries, so it's built straight from the snapshot, and only the
+#  directories changed since are listed again. Loading an unchanged library then costs one @c stat() per
+#  directory, and none per file.
+#
+#  The modification time of a directory only changes when entries are added, removed or renamed in it:
+#  an image rewritten in place, keeping its name, is not noticed until its directory changes.
+#
+#  The file is made of a header (@c HEADER), a table of directories (@c DIRECTORY records), a table of
+#  images (@c FILE records) and a table of strings, which the records point into. The directories are
+#  stored parents first, and the images of each directory one after another. TARGETs are stored with
+#  their absolute path, and everything else with its name.
+#
+
+import os
+import mmap
+import struct
+from collections import deque
+from wp_stats import STATS
+
+## @var SNAPSHOT_MAGIC
+#  @brief First bytes of a snapshot, along with the version of the format
+#
+SNAPSHOT_MAGIC = 'WPSNAP\x00\x01'
+
+## @var HEADER
+#  @brief Magic, whether the trees were loaded recursively, number of directories, number of images, size
+#  of the table of strings
+#
+HEADER = struct.Struct('<8sIIIQ')
+
+## @var DIRECTORY
+#  @brief Parent (-1 for a TARGET), name (offset and length), modification time, number of entries, first
+#  image and number of images
+#
+DIRECTORY = struct.Struct('<iQIdIII')
+
+## @var FILE
+#  @brief Name (offset and length), width and height of an image
+#
+FILE = struct.Struct('<QIII')
+
+## @brief Saves the @a trees to a snapshot at @a filename
+#
+#  @details The snapshot is written under another name first, and then renamed, so a run interrupted
+#  meanwhile leaves the previous one as it was.
+#
+#  @param trees the @c Directory of each TARGET
+#  @param recursive whether the @a trees were loaded recursively
+#
+def SaveSnapshot(filename,trees,recursive):
+	directories = []
+	files = []
+	strings = []
+	size = [0]
+	def AddString(string):
+		offset = size[0]
+		strings.append(string)
+		size[0] += len(string)
+		return (offset,len(string))
+	pending = deque((-1,tree) for tree in trees if tree.path != None and tree.mtime != None)
+	while pending:
+		# Parents first, so the directories are built in order when the snapshot is loaded
+		parent,directorio = pending.popleft()
+		if parent == -1:
+			name = AddString(directorio.path)
+		else:
+			name = AddString(directorio.dir_name)
+		images = directorio.GetDictionary('files') or {}
+		position = len(directories)
+		directories.append(DIRECTORY.pack(parent,name[0],name[1],directorio.mtime,directorio.entries,len(files),len(images)))
+		for image in images.values():
+			image_name = AddString(image.filename)
+			files.append(FILE.pack(image_name[0],image_name[1],image.width,image.height))
+		for subdirectory in (directorio.GetDictionary('directories') or {}).values():
+			if subdirectory.path != None and subdirectory.mtime != None:
+				pending.append((position,subdirectory))
+	temporary = filename+'.tmp'
+	handle = open(temporary,'wb')
+	try:
+		handle.write(HEADER.pack(SNAPSHOT_MAGIC,int(bool(recursive)),len(directories),len(files),size[0]))
+		handle.write(''.join(directories))
+		handle.write(''.join(files))
+		handle.write(''.join(strings))
+	finally:
+		handle.close()
+	os.rename(temporary,filename)
+
+## @class Snapshot
+#
+#  @brief A snapshot saved by a previous run, mapped in memory
+class Snapshot(object):
+
+	## @brief Maps the snapshot at @a filename
+	#
+	#  @param recursive whether the trees are to be loaded recursively
+	#
+	#  @exception ValueError if @a filename is not a snapshot, or it was saved with a different @a recursive
+	#  @exception IOError, EnvironmentError if it can't be read
+	#
+	def __init__(self,filename,recursive):
+		handle = open(filename,'rb')
+		try:
+			self.map = mmap.mmap(handle.fileno(),0,access = mmap.ACCESS_READ)
+		finally:
+			# The mapping stays valid once the file is closed
+			handle.close()
+		if len(self.map) < HEADER.size:
+			self.Close()
+			raise ValueError(filename+' is not a snapshot')
+		magic,snapshot_recursive,self.directory_count,self.file_count,strings_size = HEADER.unpack_from(self.map,0)
+		self.files_start = HEADER.size+self.directory_count*DIRECTORY.size
+		self.strings_start = self.files_start+self.file_count*FILE.size
+		if magic != SNAPSHOT_MAGIC or len(self.map) != self.strings_start+strings_size:
+			self.Close()
+			raise ValueError(filename+' is not a snapshot')
+		if bool(snapshot_recursive) != bool(recursive):
+			self.Close()
+			raise ValueError(filename+' was saved '+(recursive and 'without' or 'with')+' -r')
+		self.recursive = recursive
+		# Only the paths and the tree of the directories are read up front, everything else when it's needed
+		self.positions = {}
+		self.children = {}
+		paths = []
+		for position in xrange(self.directory_count):
+			parent,name_offset,name_length = DIRECTORY.unpack_from(self.map,HEADER.size+position*DIRECTORY.size)[:3]
+			name = self._GetString(name_offset,name_length)
+			if parent == -1:
+				path = name
+			else:
+				path = os.path.join(paths[parent],name)
+				self.children.setdefault(parent,[]).append(position)
+			paths.append(path)
+			self.positions[path] = position
+
+	def _GetString(self,offset,length):
+		start = self.strings_start+offset
+		return self.map[start:start+length]
+
+	## @brief Loads the @c Directory at @a path, going through the snapshot
+	#
+	#  @details If the directory didn't change since the snapshot was saved, it's built from it, and so are
+	#  its subdirectories that didn't change either. Otherwise, it's listed again, along with its new
+	#  subdirectories. The files listed again are probed as usual.
+	#
+	#  @param index the @c MetadataIndex to probe the files listed again through, if any
+	#  @param pool the pool of workers to probe them with, if any
+	#
+	#  @retval None if @a path is not in the snapshot
+	#
+	def Load(self,path,index = None,pool = None):
+		from wp_class import Directory, ImageFile
+		position = self.positions.get(path)
+		if position == None:
+			return None
+		parent,name_offset,name_length,mtime,entries,first_file,file_count = \
+			DIRECTORY.unpack_from(self.map,HEADER.size+position*DIRECTORY.size)
+		try:
+			changed = os.stat(path).st_mtime != mtime
+		except OSError:
+			return None
+		if changed:
+			STATS.Count('snapshot_directories_changed')
+			return Directory(path,self.recursive,index,pool,self)
+		STATS.Count('snapshot_directories_reused')
+		files = {}
+		for file_position in xrange(first_file,first_file+file_count):
+			name_offset,name_length,width,height = FILE.unpack_from(self.map,self.files_start+file_position*FILE.size)
+			filename = self._GetString(name_offset,name_length)
+			files[filename] = ImageFile.FromMetadata(path,filename,width,height)
+		directories = {}
+		for child in self.children.get(position,[]):
+			name_offset,name_length = DIRECTORY.unpack_from(self.map,HEADER.size+child*DIRECTORY.size)[1:3]
+			name = self._GetString(name_offset,name_length)
+			directory = self.Load(os.path.join(path,name),index,pool)
+			if directory != None and directory.path != None:
+				directories[name] = directory
+		return Directory.FromListing(path,files,directories,entries,mtime)
+
+	## @brief Unmaps the snapshot
+	def Close(self):
+		if self.map != None:
+			self.map.close()
+			self.map = None
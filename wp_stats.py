@@ -0,0 +1,153 @@
+## @file wp_stats.py
+#  @brief Counters and timers of what a run does, and where it spends its time
+#
+#  @details Every module records what it does in @c STATS: directories scanned, files probed, images
+#  classified per ratio, bytes copied, and so on; and the time spent in the main functions, through the
+#  Timed() decorator. At the end of the run, the figures can be printed as a table, or saved as JSON or
+#  in the Prometheus textfile format.
+#
+
+import time
+import threading
+
+## @class Stats
+#
+#  @brief A set of counters and timers, safe to use from several threads
+#
+#  @details Counters are identified by a name and an optional label (the ratio, for instance). Timers
+#  add up the time spent and the number of calls.
+class Stats(object):
+
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.local = threading.local()
+		self.counters = {}
+		self.timers = {}
+		self.started = time.time()
+
+	## @brief Adds @a amount to the counter @a name, with the label @a label
+	def Count(self,name,amount = 1,label = None):
+		self.lock.acquire()
+		try:
+			key = (name,label)
+			self.counters[key] = self.counters.get(key,0)+amount
+		finally:
+			self.lock.release()
+
+	## @brief Adds @a seconds spent in @a name to its timer
+	def AddTime(self,name,seconds):
+		self.lock.acquire()
+		try:
+			total,calls = self.timers.get(name,(0.0,0))
+			self.timers[name] = (total+seconds,calls+1)
+		finally:
+			self.lock.release()
+
+	## @brief Gets the value of the counter @a name, with the label @a label
+	def Get(self,name,label = None):
+		return self.counters.get((name,label),0)
+
+	## @brief Gets the sum of the counters @a name, whatever their label
+	def Total(self,name):
+		self.lock.acquire()
+		try:
+			return sum(value for (counter,label),value in self.counters.items() if counter == name)
+		finally:
+			self.lock.release()
+
+	## @brief Gets the figures as a @c dict, ready to be saved as JSON
+	def GetDictionary(self):
+		counters = {}
+		for (name,label),value in self.counters.items():
+			if label == None:
+				counters[name] = value
+			else:
+				counters.setdefault(name,{})[str(label)] = value
+		timers = {}
+		for name,(total,calls) in self.timers.items():
+			timers[name] = {'seconds' : total,'calls' : calls}
+		return {'elapsed' : time.time()-self.started,'counters' : counters,'timers' : timers}
+
+	## @brief Gets the figures as a table, to be printed at the end of the run
+	def GetSummary(self):
+		lines = ['%-40s %15s' % ('counter','value')]
+		for (name,label),value in sorted(self.counters.items()):
+			if label != None:
+				name = '%s[%s]' % (name,label)
+			lines.append('%-40s %15d' % (name,value))
+		lines.append('')
+		lines.append('%-40s %15s %10s' % ('timer','seconds','calls'))
+		for name,(total,calls) in sorted(self.timers.items()):
+			lines.append('%-40s %15.3f %10d' % (name,total,calls))
+		lines.append('%-40s %15.3f' % ('elapsed',time.time()-self.started))
+		return '\n'.join(lines)
+
+	## @brief Gets the figures in the Prometheus textfile format
+	#
+	#  @param prefix the prefix of the metric names
+	#
+	def GetPrometheus(self,prefix = 'sortpaper'):
+		lines = []
+		for (name,label),value in sorted(self.counters.items()):
+			if label == None:
+				lines.append('%s_%s_total %d' % (prefix,name,value))
+			else:
+				label = str(label).replace('\\','\\\\').replace('"','\\"')
+				lines.append('%s_%s_total{bucket="%s"} %d' % (prefix,name,label,value))
+		for name,(total,calls) in sorted(self.timers.items()):
+			metric = name.replace('.','_')
+			lines.append('%s_%s_seconds_total %f' % (prefix,metric,total))
+			lines.append('%s_%s_calls_total %d' % (prefix,metric,calls))
+		lines.append('%s_elapsed_seconds %f' % (prefix,time.time()-self.started))
+		return '\n'.join(lines)+'\n'
+
+	## @brief Saves the figures to @a filename, as JSON
+	def SaveJSON(self,filename):
+		import json
+		handle = open(filename,'w')
+		try:
+			json.dump(self.GetDictionary(),handle,indent=1,sort_keys=True)
+		finally:
+			handle.close()
+
+	## @brief Saves the figures to @a filename, in the Prometheus textfile format
+	#
+	#  @details The file is written under another name and then renamed, so the collector never
+	#  reads half of it.
+	#
+	def SavePrometheus(self,filename):
+		import os
+		temporary = filename+'.tmp'
+		handle = open(temporary,'w')
+		try:
+			handle.write(self.GetPrometheus())
+		finally:
+			handle.close()
+		os.rename(temporary,filename)
+
+## @var STATS
+#  @brief The figures of the current run
+#
+STATS = Stats()
+
+## @brief Decorator adding the time spent in a function to the timer @a name of @c STATS
+#
+#  @details When the function calls itself (directly or not), only the outermost call is timed, so
+#  recursive functions are not counted more than once.
+#
+def Timed(name):
+	def Decorator(function):
+		def Wrapper(*args,**kwargs):
+			depth = getattr(STATS.local,name,0)
+			setattr(STATS.local,name,depth+1)
+			start = time.time()
+			try:
+				return function(*args,**kwargs)
+			finally:
+				setattr(STATS.local,name,depth)
+				if depth == 0:
+					STATS.AddTime(name,time.time()-start)
+		Wrapper.__name__ = function.__name__
+		Wrapper.__doc__ = function.__doc__
+		return Wrapper
+	return Decorator
@@ -0,0 +1,196 @@
+## @file wp_thumbs.py
+#  @brief Cache of preview thumbnails, made while the images are sorted
+#
+#  @details The thumbnails are made by a pool of processes, so decoding the images doesn't hold back
+#  the sorting, and uses every core. JPEG images are decoded straight at a fraction of their size (PIL's
+#  draft mode), which is most of the work saved.
+#
+#  The cache is addressed by contents: each thumbnail is named after the SHA-1 of its image, so copies of
+#  an image share the same thumbnail, and moving an image doesn't make a new one. The hash of each file
+#  is kept by its identity (device, inode, size and modification time) in a @c MetadataIndex, so an
+#  image that didn't change is not read again; once it changes, its identity does too, and a new
+#  thumbnail is made.
+#
+#  The cache is kept under a size limit: when it goes over, the thumbnails used least recently are
+#  removed first. Using a thumbnail updates its modification time, which is what tells how recently it
+#  was used (access times are often not kept up to date).
+#
+
+import os
+import errno
+import threading
+from wp_stats import STATS
+
+## @var THUMBNAIL_QUALITY
+#  @brief JPEG quality of the thumbnails
+#
+THUMBNAIL_QUALITY = 85
+
+## @var EVICT_TO
+#  @brief Fraction of the size limit the cache is brought down to when it goes over it
+#
+#  @details Going a bit further than the limit means the cache isn't trimmed again with every new thumbnail.
+#
+EVICT_TO = 0.9
+
+## @brief Gets the path of the thumbnail of the image with the SHA-1 @a digest, in the cache @a directory
+def ThumbnailPath(directory,digest):
+	return os.path.join(directory,digest[:2],digest+'.jpg')
+
+## @brief Makes the thumbnail of the image at @a path, unless there's one already
+#
+#  @details It runs in the worker processes, so it only takes and returns plain values.
+#
+#  @param path the path of the image
+#  @param directory the cache directory
+#  @param size the largest width or height of the thumbnail
+#
+#  @return a @c tuple @c (digest,written), with the SHA-1 of the image and the size of the thumbnail
+#  written (0 if it was there already)
+#
+#  @retval (None,error) if the image can't be read or decoded, with the error message
+#
+def MakeThumbnail(path,directory,size):
+	import hashlib
+	import cStringIO
+	try:
+		handle = open(path,'rb')
+		try:
+			data = handle.read()
+		finally:
+			handle.close()
+		digest = hashlib.sha1(data).hexdigest()
+		target = ThumbnailPath(directory,digest)
+		if os.path.exists(target):
+			return (digest,0)
+		import Image
+		image = Image.open(cStringIO.StringIO(data))
+		# Only JPEG supports it, but then the image is decoded at the smallest scale still above size
+		image.draft('RGB',(size,size))
+		image = image.convert('RGB')
+		image.thumbnail((size,size),Image.ANTIALIAS)
+		try:
+			os.mkdir(os.path.dirname(target))
+		except OSError,err:
+			if err.errno != errno.EEXIST:
+				raise
+		# Written under another name first, so a thumbnail is never seen half written
+		temporary = target+'.'+str(os.getpid())+'.tmp'
+		image.save(temporary,'JPEG',quality = THUMBNAIL_QUALITY)
+		os.rename(temporary,target)
+		return (digest,os.path.getsize(target))
+	except Exception,err:
+		# Anything, since PIL raises all sorts of errors on broken images, and the result must come back
+		return (None,str(err))
+
+## @class ThumbnailCache
+#
+#  @brief Directory of thumbnails, filled by a pool of processes
+class ThumbnailCache(object):
+
+	## @param directory the cache directory, created if it doesn't exist
+	#  @param size the largest width or height of the thumbnails
+	#  @param limit the largest size of the cache, in bytes
+	#  @param processes the number of processes making thumbnails; one per core by default
+	#  @param index the @c MetadataIndex holding the hashes of the images. By default, the cache keeps
+	#  one of its own, inside @a directory.
+	def __init__(self,directory,size = 256,limit = 1 << 30,processes = None,index = None):
+		from multiprocessing import Pool, cpu_count
+		self.directory = os.path.abspath(directory)
+		if not os.path.isdir(self.directory):
+			os.makedirs(self.directory)
+		self.own_index = index == None
+		if self.own_index:
+			from wp_index import MetadataIndex
+			index = MetadataIndex(os.path.join(self.directory,'thumbnails.db'))
+		self.index = index
+		self.size = size
+		self.limit = limit
+		if processes == None:
+			processes = cpu_count()
+		self.lock = threading.Lock()
+		# At most a few images per process waiting, so the sorting doesn't get too far ahead
+		self.slots = threading.BoundedSemaphore(processes*4)
+		self.total = sum(size for mtime,size,path in self._GetEntries())
+		self.pool = Pool(processes)
+
+	def _GetEntries(self):
+		entries = []
+		for subdirectory in os.listdir(self.directory):
+			subdirectory = os.path.join(self.directory,subdirectory)
+			if not os.path.isdir(subdirectory):
+				continue
+			for name in os.listdir(subdirectory):
+				if name.endswith('.jpg'):
+					path = os.path.join(subdirectory,name)
+					try:
+						stat = os.stat(path)
+					except OSError:
+						continue
+					entries.append((stat.st_mtime,stat.st_size,path))
+		return entries
+
+	## @brief Makes sure there's a thumbnail of the image at @a path
+	#
+	#  @details If the image didn't change since its thumbnail was made, the thumbnail is only marked
+	#  as used. Otherwise, it's handed to the pool of processes.
+	#
+	def Add(self,path):
+		try:
+			stat = os.stat(path)
+		except OSError:
+			return
+		digest = self.index.LookupHash(stat)
+		if digest != None:
+			target = ThumbnailPath(self.directory,digest)
+			try:
+				os.utime(target,None)
+				STATS.Count('thumbnail_hits')
+				return
+			except OSError:
+				# It was evicted, or removed by hand
+				pass
+		self.slots.acquire()
+		self.pool.apply_async(MakeThumbnail,(path,self.directory,self.size),
+			callback = lambda result,path = path,stat = stat: self._Made(path,stat,result))
+
+	def _Made(self,path,stat,result):
+		self.slots.release()
+		digest,written = result
+		if digest == None:
+			print 'ThumbnailCache.Add(): Error making the thumbnail of '+path+':',written
+			return
+		self.index.StoreHash(stat,digest)
+		STATS.Count('thumbnails_made')
+		self.lock.acquire()
+		try:
+			self.total += written
+			if self.total > self.limit:
+				self.Evict()
+		finally:
+			self.lock.release()
+
+	## @brief Removes the thumbnails used least recently, until the cache is under its limit
+	def Evict(self):
+		entries = self._GetEntries()
+		entries.sort()
+		self.total = sum(size for mtime,size,path in entries)
+		for mtime,size,path in entries:
+			if self.total <= self.limit*EVICT_TO:
+				break
+			try:
+				os.remove(path)
+			except OSError:
+				continue
+			self.total -= size
+			STATS.Count('thumbnails_evicted')
+
+	## @brief Waits for every thumbnail to be made
+	def Close(self):
+		if self.pool == None:
+			return
+		self.pool.close()
+		self.pool.join()
+		self.pool = None
+		if self.own_index:
+			self.index.Close()
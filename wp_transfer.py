@@ -0,0 +1,313 @@
+## @file wp_transfer.py
+#  @brief Moving, copying and linking files, the fastest way the system allows
+#
+#  @details A move within the same device is a @c rename(), which costs the same no matter how big the
+#  file is. Between devices, the file has to be copied: on Linux that's done inside the kernel, with
+#  @c copy_file_range() or @c sendfile(), instead of reading and writing it through Python. When the
+#  original has to be kept (--nd), a hard link or a reflink is almost free compared to a copy.
+#
+#  @c TransferPool runs the copies on a bounded pool of threads, so several of them are in flight at once.
+#
+
+import os
+import sys
+import errno
+from wp_stats import STATS
+
+## @var COPY_CHUNK
+#  @brief Largest amount of bytes copied per call
+#
+COPY_CHUNK = 1 << 24
+
+## @var FICLONE
+#  @brief @c ioctl() request to make a reflink of a file (Linux)
+#
+FICLONE = 0x40049409
+
+## @var LINK_MODES
+#  @brief The ways a file can be linked instead of copied
+#
+LINK_MODES = ('hard','reflink')
+
+## @var UNSUPPORTED
+#  @brief Error numbers meaning a call is not supported for the files given, rather than a real failure
+#
+UNSUPPORTED = frozenset([errno.EINVAL,errno.ENOSYS,errno.EXDEV,errno.EOPNOTSUPP,errno.ENOTTY,errno.EPERM,errno.EBADF])
+
+def _LibcCall(name,argtypes,arguments):
+	import ctypes
+	import ctypes.util
+	try:
+		libc = ctypes.CDLL(ctypes.util.find_library('c'),use_errno = True)
+		function = getattr(libc,name)
+	except (OSError,AttributeError):
+		return None
+	function.argtypes = argtypes
+	function.restype = ctypes.c_ssize_t
+	def Call(source,target,count):
+		result = function(*arguments(source,target,count))
+		if result < 0:
+			number = ctypes.get_errno()
+			raise OSError(number,os.strerror(number))
+		return result
+	return Call
+
+def _ZeroCopyCalls():
+	calls = []
+	if not sys.platform.startswith('linux'):
+		return calls
+	import ctypes
+	if hasattr(os,'copy_file_range'):
+		calls.append(lambda source,target,count: os.copy_file_range(source,target,count))
+	else:
+		call = _LibcCall('copy_file_range',[ctypes.c_int,ctypes.c_void_p,ctypes.c_int,ctypes.c_void_p,ctypes.c_size_t,ctypes.c_uint],
+			lambda source,target,count: (source,None,target,None,count,0))
+		if call != None:
+			calls.append(call)
+	if hasattr(os,'sendfile'):
+		calls.append(lambda source,target,count: os.sendfile(target,source,None,count))
+	else:
+		call = _LibcCall('sendfile',[ctypes.c_int,ctypes.c_int,ctypes.c_void_p,ctypes.c_size_t],
+			lambda source,target,count: (target,source,None,count))
+		if call != None:
+			calls.append(call)
+	return calls
+
+## @var ZERO_COPY_CALLS
+#  @brief The in-kernel copy functions available, in order of preference
+#
+#  @details Each one is called as @c call(source_fd,target_fd,count), copies from the current offset of
+#  both descriptors, and returns the number of bytes copied.
+#
+ZERO_COPY_CALLS = _ZeroCopyCalls()
+
+## @var device_cache
+#  @brief Device of the directories already looked up by GetDevice()
+#
+device_cache = {}
+
+## @brief Gets the device the directory @a directory is in
+#
+#  @details Each directory is only @c stat()'ed once per run.
+#
+def GetDevice(directory):
+	device = device_cache.get(directory)
+	if device == None:
+		device = device_cache[directory] = os.stat(directory).st_dev
+	return device
+
+## @brief Tells whether @a source and @a destination are in the same device
+#
+#  @param source the path of a file
+#  @param destination the path the file is going to be relocated to
+#
+def SameDevice(source,destination):
+	return GetDevice(os.path.dirname(source)) == GetDevice(os.path.dirname(destination))
+
+## @brief Tells whether @a destination exists and is the file @a source, under another name or the same
+def SameFile(source,destination):
+	try:
+		return os.path.samefile(source,destination)
+	except OSError:
+		return False
+
+def _CheckSameFile(source,destination):
+	import shutil
+	if SameFile(source,destination):
+		raise shutil.Error('`%s` and `%s` are the same file' % (source,destination))
+
+## @brief Opens a new, empty file next to @a destination, to be renamed over it once it's complete
+#
+#  @details Writing into @a destination itself would truncate it first: if it were a hard link of the
+#  source, the source would be emptied along with it. Nor is a half-written file ever left in its place.
+#
+#  @return a @c (descriptor,path) tuple
+#
+def _OpenTemporary(destination):
+	import tempfile
+	directory,filename = os.path.split(destination)
+	return tempfile.mkstemp(prefix = '.'+filename+'.',dir = directory or '.')
+
+## @brief Copies the file @a source to @a destination, along with its permissions and times
+#
+#  @details The data is copied by the kernel when possible (see @c ZERO_COPY_CALLS), and through
+#  Python otherwise, into a temporary file renamed to @a destination once it's complete. Like
+#  @c shutil.copy2(), @a destination is overwritten if it exists, unless it's the same file as @a source.
+#
+#  @return the number of bytes copied
+#
+#  @exception IOError, OSError if the file can't be copied
+#  @exception shutil.Error if @a destination is the same file as @a source
+#
+def CopyFile(source,destination):
+	import shutil
+	_CheckSameFile(source,destination)
+	copied = 0
+	source_fd = os.open(source,os.O_RDONLY)
+	try:
+		target_fd,temporary = _OpenTemporary(destination)
+		try:
+			remaining = os.fstat(source_fd).st_size
+			for call in ZERO_COPY_CALLS:
+				try:
+					while remaining > 0:
+						count = call(source_fd,target_fd,min(remaining,COPY_CHUNK))
+						if count == 0:
+							break
+						copied += count
+						remaining -= count
+				except OSError,err:
+					if err.errno not in UNSUPPORTED:
+						raise
+				# Whatever was copied, the offsets of both files moved along, so the next
+				# way of copying picks up from there
+				if remaining <= 0:
+					break
+			while True:
+				data = os.read(source_fd,COPY_CHUNK)
+				if not data:
+					break
+				while data:
+					written = os.write(target_fd,data)
+					copied += written
+					data = data[written:]
+			os.close(target_fd)
+			target_fd = None
+			shutil.copystat(source,temporary)
+			os.rename(temporary,destination)
+		except BaseException:
+			if target_fd != None:
+				os.close(target_fd)
+			os.remove(temporary)
+			raise
+	finally:
+		os.close(source_fd)
+	STATS.Count('files_copied')
+	STATS.Count('bytes_copied',copied)
+	return copied
+
+## @brief Links @a destination to the file @a source, or copies it if it can't be linked
+#
+#  @param source the path of the file
+#  @param destination the path of the link
+#  @param mode @c 'hard' for a hard link, @c 'reflink' for a copy-on-write clone of the file
+#
+#  @return the number of bytes copied, which is 0 when the link was made, or when @a destination was
+#  already a hard link of @a source
+#
+#  @exception shutil.Error if @a destination is the same file as @a source, for a reflink
+#
+def LinkFile(source,destination,mode = 'hard'):
+	if mode not in LINK_MODES:
+		raise ValueError('LinkFile(): mode must be one of '+', '.join(LINK_MODES)+', got '+str(mode))
+	if mode == 'hard':
+		# Removing it first would leave nothing to link to if both are the same path
+		if SameFile(source,destination):
+			return 0
+		if os.path.lexists(destination):
+			os.remove(destination)
+		try:
+			os.link(source,destination)
+			STATS.Count('files_linked')
+			return 0
+		except OSError,err:
+			if err.errno not in UNSUPPORTED:
+				raise
+	else:
+		import fcntl
+		import shutil
+		_CheckSameFile(source,destination)
+		source_fd = os.open(source,os.O_RDONLY)
+		try:
+			target_fd,temporary = _OpenTemporary(destination)
+			cloned = False
+			try:
+				try:
+					fcntl.ioctl(target_fd,FICLONE,source_fd)
+				except IOError,err:
+					if err.errno not in UNSUPPORTED:
+						raise
+				else:
+					shutil.copystat(source,temporary)
+					cloned = True
+				finally:
+					os.close(target_fd)
+				if cloned:
+					os.rename(temporary,destination)
+			except BaseException:
+				cloned = False
+				raise
+			finally:
+				if not cloned:
+					os.remove(temporary)
+		finally:
+			os.close(source_fd)
+		if cloned:
+			STATS.Count('files_linked')
+			return 0
+	return CopyFile(source,destination)
+
+## @brief Moves the file @a source to @a destination
+#
+#  @details Within the same device, it's a @c rename(). Otherwise, the file is copied with CopyFile()
+#  and then removed.
+#
+#  @return the number of bytes copied, which is 0 when the file was renamed
+#
+def MoveFile(source,destination):
+	if SameDevice(source,destination):
+		try:
+			os.rename(source,destination)
+			STATS.Count('files_renamed')
+			return 0
+		except OSError,err:
+			# Bind mounts share the device, but can't be renamed across
+			if err.errno != errno.EXDEV:
+				raise
+	copied = CopyFile(source,destination)
+	os.remove(source)
+	return copied
+
+## @class TransferPool
+#
+#  @brief Bounded pool of threads copying files
+#
+#  @details At most twice as many transfers as workers are queued at a time: Submit() waits for
+#  one to finish otherwise, so the caller can't get too far ahead of the copies.
+class TransferPool(object):
+
+	def __init__(self,jobs = 4):
+		from multiprocessing.pool import ThreadPool
+		import threading
+		self.pool = ThreadPool(jobs)
+		self.slots = threading.BoundedSemaphore(jobs*2)
+
+	## @brief Runs @a function with @a args in the pool
+	#
+	#  @param function the transfer to run, such as MoveFile() or CopyFile()
+	#  @param args the arguments of @a function
+	#  @param done a function called as @c done(result,error) once the transfer is over, where
+	#  @a error is the exception raised, if any
+	#
+	def Submit(self,function,args,done = None):
+		def Run():
+			try:
+				return (function(*args),None)
+			except Exception,err:
+				return (None,err)
+		def Finished(outcome):
+			# Whatever happens in done(), the slot is given back, or Submit() would end up waiting forever
+			try:
+				if done != None:
+					done(*outcome)
+			except Exception,err:
+				print 'TransferPool.Submit(): Error finishing a transfer:',err
+			finally:
+				self.slots.release()
+		self.slots.acquire()
+		self.pool.apply_async(Run,callback = Finished)
+
+	## @brief Waits for every transfer submitted to finish
+	def Join(self):
+		self.pool.close()
+		self.pool.join()
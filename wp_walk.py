@@ -0,0 +1,89 @@
+## @file wp_walk.py
+#  @brief Streaming walk over a directory tree, yielding the images as they're found
+#
+#  @details Building a @c Directory loads the whole tree in memory before anything else can be done.
+#  WalkImages() instead goes through the tree one directory at a time, handing each image to the
+#  caller as soon as it's been probed, so the first image can be relocated right away, and only the
+#  listing of the directory being walked is kept in memory.
+#
+
+import os
+from itertools import izip
+from wp_stats import STATS
+
+## @var scandir
+#  @brief The @c scandir() function to list directories with, if there's one available
+#
+#  @details @c scandir() returns the type of every entry along with its name (the @c d_type of the
+#  directory entry), so there's no need to @c stat() every entry to know if it's a directory. It's
+#  in the @c os module since Python 3.5, and in the @c scandir package for older versions.
+#
+scandir = getattr(os,'scandir',None)
+if scandir == None:
+	try:
+		from scandir import scandir
+	except ImportError:
+		scandir = None
+
+## @brief Lists the directory at @a path
+#
+#  @param path the path of the directory
+#
+#  @return a @c list of @c (name,is_dir) tuples, one per entry of the directory
+#
+#  @exception OSError if the directory cannot be listed
+#
+def ScanDir(path):
+	if scandir != None:
+		return [(entry.name,entry.is_dir()) for entry in scandir(path)]
+	return [(name,os.path.isdir(os.path.join(path,name))) for name in os.listdir(path)]
+
+## @brief Walks the tree at @a path, yielding the images in it
+#
+#  @details The images of a directory are yielded before its subdirectories are walked, which is
+#  the order ProcessFolder() follows. The callbacks let the caller know when a directory is entered
+#  and left; by the time @a leave is called, every image under that directory has been yielded,
+#  and handled by the caller.
+#
+#  @param path the directory to walk
+#  @param recursive whether to walk the subdirectories as well
+#  @param index the @c MetadataIndex to go through, if any
+#  @param pool a pool of workers to probe the files of each directory with, if any
+#  @param enter a function called with the path of each directory before walking it
+#  @param leave a function called with the path of each directory once it's been walked
+#
+#  @return a generator of @c ImageFile objects
+#
+def WalkImages(path,recursive = False,index = None,pool = None,enter = None,leave = None):
+	from wp_class import LoadImage, ReportLoadError
+	path = os.path.abspath(path)
+	if index != None:
+		probe = index.Probe
+	else:
+		probe = None
+	try:
+		entries = ScanDir(path)
+	except OSError,err:
+		print 'WalkImages():',err
+		return
+	STATS.Count('directories_scanned')
+	if enter != None:
+		enter(path)
+	files = [name for name,is_dir in entries if not is_dir]
+	paths = [os.path.join(path,name) for name in files]
+	if pool != None:
+		results = pool.imap(lambda file_path: LoadImage(file_path,probe),paths)
+	else:
+		results = (LoadImage(file_path,probe) for file_path in paths)
+	for filename,(image,err) in izip(files,results):
+		if image != None:
+			yield image
+		else:
+			ReportLoadError(filename,err)
+	if recursive:
+		for name,is_dir in entries:
+			if is_dir:
+				for image in WalkImages(os.path.join(path,name),recursive,index,pool,enter,leave):
+					yield image
+	if leave != None:
+		leave(path)
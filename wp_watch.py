@@ -0,0 +1,304 @@
+## @file wp_watch.py
+#  @brief Watching directory trees for new files, to sort them as soon as they're dropped in
+#
+#  @details On Linux, the kernel tells us about every change through inotify, so nothing has to be
+#  listed again: a file is handed over once it's been closed after writing (@c IN_CLOSE_WRITE), or
+#  when it's moved in, complete, from elsewhere (@c IN_MOVED_TO). Elsewhere, or if inotify can't be
+#  used, the directories are polled instead: only the ones whose modification time changed are listed,
+#  and a new file is handed over once its size and modification time stayed the same for a whole
+#  interval, so files still being written are left alone.
+#
+
+import os
+import sys
+import time
+import errno
+import struct
+from wp_walk import ScanDir
+from wp_stats import STATS
+
+## @var IN_CLOSE_WRITE
+#  @brief inotify event: a file opened for writing was closed
+#
+IN_CLOSE_WRITE = 0x00000008
+
+## @var IN_MOVED_TO
+#  @brief inotify event: a file was moved into the directory
+#
+IN_MOVED_TO = 0x00000080
+
+## @var IN_CREATE
+#  @brief inotify event: a file or directory was created in the directory
+#
+IN_CREATE = 0x00000100
+
+## @var IN_DELETE_SELF
+#  @brief inotify event: the directory itself was removed
+#
+IN_DELETE_SELF = 0x00000400
+
+## @var IN_MOVE_SELF
+#  @brief inotify event: the directory itself was moved
+#
+IN_MOVE_SELF = 0x00000800
+
+## @var IN_Q_OVERFLOW
+#  @brief inotify event: events were lost, because too many of them were queued
+#
+IN_Q_OVERFLOW = 0x00004000
+
+## @var IN_IGNORED
+#  @brief inotify event: the watch was removed
+#
+IN_IGNORED = 0x00008000
+
+## @var IN_ISDIR
+#  @brief inotify flag: the event is about a directory
+#
+IN_ISDIR = 0x40000000
+
+## @var WATCH_MASK
+#  @brief The inotify events each directory is watched for
+#
+WATCH_MASK = IN_CLOSE_WRITE|IN_MOVED_TO|IN_CREATE|IN_DELETE_SELF|IN_MOVE_SELF
+
+## @var EVENT_HEADER
+#  @brief Layout of the header of an inotify event: @c wd, @c mask, @c cookie and @c len, followed by
+#  @c len bytes of name
+#
+EVENT_HEADER = struct.Struct('iIII')
+
+## @var POLL_INTERVAL
+#  @brief Seconds between two polls of the directories, when inotify is not available
+#
+POLL_INTERVAL = 1.0
+
+## @class InotifyWatcher
+#
+#  @brief Watches directory trees through Linux's inotify
+#
+#  @exception OSError if inotify is not available
+class InotifyWatcher(object):
+
+	def __init__(self,recursive = True):
+		import ctypes
+		import ctypes.util
+		if not sys.platform.startswith('linux'):
+			raise OSError(errno.ENOSYS,'inotify is only available on Linux')
+		self.libc = ctypes.CDLL(ctypes.util.find_library('c'),use_errno = True)
+		try:
+			self.libc.inotify_add_watch.argtypes = [ctypes.c_int,ctypes.c_char_p,ctypes.c_uint32]
+		except AttributeError:
+			raise OSError(errno.ENOSYS,'inotify is not available')
+		self.fd = self.libc.inotify_init()
+		if self.fd < 0:
+			number = ctypes.get_errno()
+			raise OSError(number,os.strerror(number))
+		self.recursive = recursive
+		# Path of the directory of each watch descriptor
+		self.directories = {}
+		self.ignored = set()
+		self.buffer = ''
+
+	## @brief Starts watching the directory at @a path, and its subdirectories if recursive
+	#
+	#  @details The files already in it are not handed over: they're expected to have been sorted
+	#  before the watch started.
+	#
+	def Add(self,path):
+		self._Watch(os.path.abspath(path),False)
+
+	## @brief Watches the directory at @a path and its subdirectories
+	#
+	#  @param new whether the directory appeared while watching. Its files can't be told apart from
+	#  the ones written to it before the watch was added, so they're all handed over.
+	#
+	#  @return the paths of the files in the directories, if @a new
+	#
+	def _Watch(self,path,new):
+		import ctypes
+		wd = self.libc.inotify_add_watch(self.fd,path,WATCH_MASK)
+		if wd < 0:
+			number = ctypes.get_errno()
+			print 'InotifyWatcher.Add(): Error watching '+path+':',os.strerror(number)
+			return []
+		self.directories[wd] = path
+		STATS.Count('directories_watched')
+		found = []
+		try:
+			entries = ScanDir(path)
+		except OSError:
+			return found
+		for name,is_dir in entries:
+			entry = os.path.join(path,name)
+			if is_dir:
+				if self.recursive:
+					found.extend(self._Watch(entry,new))
+			elif new:
+				found.append(entry)
+		return found
+
+	## @brief Drops the next event about the file at @a path
+	#
+	#  @details It's meant for the files relocated into a watched directory, so they're not handed
+	#  over again.
+	#
+	def Ignore(self,path):
+		self.ignored.add(path)
+
+	## @brief Waits for files to be ready
+	#
+	#  @param timeout how many seconds to wait at most, or @c None to wait as long as it takes
+	#
+	#  @return a @c list with the paths of the files written or moved in
+	#
+	def Wait(self,timeout = None):
+		import select
+		try:
+			readable = select.select([self.fd],[],[],timeout)[0]
+		except select.error,err:
+			if err.args[0] == errno.EINTR:
+				return []
+			raise
+		if not readable:
+			return []
+		self.buffer += os.read(self.fd,65536)
+		ready = []
+		while len(self.buffer) >= EVENT_HEADER.size:
+			wd,mask,cookie,length = EVENT_HEADER.unpack_from(self.buffer)
+			end = EVENT_HEADER.size+length
+			if len(self.buffer) < end:
+				break
+			name = self.buffer[EVENT_HEADER.size:end].rstrip('\0')
+			self.buffer = self.buffer[end:]
+			STATS.Count('watch_events')
+			if mask & IN_Q_OVERFLOW:
+				# Some events were lost: the only way to find out what changed is to list everything
+				for directory in self.directories.values():
+					ready.extend(ListFiles(directory))
+				continue
+			directory = self.directories.get(wd)
+			if directory == None:
+				continue
+			if mask & (IN_IGNORED|IN_DELETE_SELF|IN_MOVE_SELF):
+				if mask & IN_IGNORED:
+					del self.directories[wd]
+				continue
+			path = os.path.join(directory,name)
+			if mask & IN_ISDIR:
+				if self.recursive and mask & (IN_CREATE|IN_MOVED_TO):
+					ready.extend(self._Watch(path,True))
+			elif mask & (IN_CLOSE_WRITE|IN_MOVED_TO):
+				ready.append(path)
+		return DropIgnored(ready,self.ignored)
+
+	def Close(self):
+		if self.fd != None:
+			os.close(self.fd)
+			self.fd = None
+
+## @class PollingWatcher
+#
+#  @brief Watches directory trees by polling them, when inotify can't be used
+class PollingWatcher(object):
+
+	def __init__(self,recursive = True,interval = POLL_INTERVAL):
+		self.recursive = recursive
+		self.interval = interval
+		# The modification time and the names of the files of each directory, last time it was listed
+		self.directories = {}
+		# The (size,mtime) of the new files, last time they were seen
+		self.pending = {}
+		self.ignored = set()
+
+	def Add(self,path):
+		self._Scan(os.path.abspath(path),False)
+
+	## @brief Lists the directory at @a path, and its new subdirectories if recursive
+	#
+	#  @param new whether the directory appeared while watching, so every file in it is new
+	#
+	def _Scan(self,path,new):
+		try:
+			mtime = os.stat(path).st_mtime
+			entries = ScanDir(path)
+		except OSError:
+			self.directories.pop(path,None)
+			return
+		STATS.Count('directories_polled')
+		known = self.directories.get(path,(None,frozenset()))[1]
+		files = set()
+		for name,is_dir in entries:
+			entry = os.path.join(path,name)
+			if is_dir:
+				if self.recursive and entry not in self.directories:
+					self._Scan(entry,new)
+			else:
+				files.add(name)
+				if new and name not in known:
+					self.pending[entry] = None
+		self.directories[path] = (mtime,files)
+
+	def Ignore(self,path):
+		self.ignored.add(path)
+
+	def Wait(self,timeout = None):
+		if timeout == None or timeout > self.interval:
+			timeout = self.interval
+		time.sleep(timeout)
+		for directory,(mtime,files) in self.directories.items():
+			try:
+				changed = os.stat(directory).st_mtime != mtime
+			except OSError:
+				changed = True
+			if changed:
+				self._Scan(directory,True)
+		ready = []
+		for path,seen in self.pending.items():
+			try:
+				stat = os.stat(path)
+			except OSError:
+				del self.pending[path]
+				continue
+			current = (stat.st_size,stat.st_mtime)
+			if current != seen:
+				# Still being written, or just found: it's checked again next time
+				self.pending[path] = current
+				continue
+			del self.pending[path]
+			ready.append(path)
+		return DropIgnored(ready,self.ignored)
+
+	def Close(self):
+		pass
+
+## @brief Removes from @a paths the ones in the set @a ignored, which are dropped from it as well
+def DropIgnored(paths,ignored):
+	if not ignored:
+		return paths
+	kept = []
+	for path in paths:
+		if path in ignored:
+			ignored.discard(path)
+		else:
+			kept.append(path)
+	return kept
+
+## @brief Lists the files (not the directories) in the directory at @a path
+def ListFiles(path):
+	try:
+		return [os.path.join(path,name) for name,is_dir in ScanDir(path) if not is_dir]
+	except OSError:
+		return []
+
+## @brief Creates the best watcher available
+#
+#  @param recursive whether to watch the subdirectories of the directories added as well
+#
+#  @return an @c InotifyWatcher, or a @c PollingWatcher if inotify can't be used
+#
+def CreateWatcher(recursive = True):
+	try:
+		return InotifyWatcher(recursive)
+	except OSError:
+		return PollingWatcher(recursive)